@@ -0,0 +1 @@
+"""Performance benchmarks of the pkpd_sian engines on synthetic datasets, run with "python -m benchmarks"."""
@@ -0,0 +1,33 @@
+import argparse
+import json
+import sys
+
+from benchmarks.cases import BENCHMARKS
+from benchmarks.runner import compare_results, run_benchmarks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Time the pkpd_sian engines on synthetic datasets.')
+    parser.add_argument('names', nargs='*', help=f'Benchmarks to run, among {", ".join(BENCHMARKS)}. Defaults to all.')
+    parser.add_argument('--full', action='store_true', help='Sweep the full grids instead of the quick ones.')
+    parser.add_argument('-r', '--repeats', type=int, default=3, help='Number of timed calls per point.')
+    parser.add_argument('-o', '--output', help='Write the results as JSON, e.g. to store a new baseline.')
+    parser.add_argument('-c', '--compare', help='Baseline JSON to compare with. The exit status is 1 if a point regresses.')
+    parser.add_argument('--time-tolerance', type=float, default=0.25, help='Allowed relative increase of the time.')
+    parser.add_argument('--memory-tolerance', type=float, default=0.10, help='Allowed relative increase of the peak memory.')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.names, 'full' if args.full else 'quick', args.repeats, log=sys.stderr)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as handle:
+            json.dump(results, handle, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as handle:
+            comparison = compare_results(results, json.load(handle), args.time_tolerance, args.memory_tolerance)
+        print(comparison.round(3).to_string(index=False))
+        return int(comparison['Regression'].any())
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+
+from pkpd_sian.analysis import non_compartmental_analysis, one_compartmental_im_analysis
+from pkpd_sian.regimen import Regimen
+from pkpd_sian.simulation import (
+    multiple_compartment_regimen_simulation,
+    multiple_compartment_simulation,
+    population_pk_simulation,
+)
+
+
+def synthetic_trial(n_subjects, n_samples, n_doses=3, seed=0):
+    '''This function helps to generate an oral single-dose trial in the unified format, with log-normal variability of ka, ke and Vd,
+    a proportional residual error and n_doses dose groups.
+
+    Parameters:
+        n_subjects (int): Number of individuals.
+        n_samples (int): Number of samples per individual, log-spaced between 0.25 and 48 h.
+        n_doses (int): Number of dose groups (50, 100, 150, ...).
+        seed (int): Seed of the random generator.
+
+    Returns:
+        df (PandasDataFrame): A data frame with the columns "ID", "Time", "Conc" and "Dose".
+    '''
+    rng = np.random.default_rng(seed)
+    time = np.geomspace(0.25, 48, n_samples)
+    dose = 50.0 * (1 + np.arange(n_subjects) % n_doses)
+    ka = 1.2 * np.exp(rng.normal(0, 0.3, n_subjects))[:, None]
+    ke = 0.15 * np.exp(rng.normal(0, 0.3, n_subjects))[:, None]
+    Vd = 40.0 * np.exp(rng.normal(0, 0.2, n_subjects))[:, None]
+    conc = dose[:, None] * ka / (Vd * (ka - ke)) * (np.exp(-ke * time) - np.exp(-ka * time))
+    conc *= rng.lognormal(0, 0.1, conc.shape)
+    return pd.DataFrame({
+        'ID': np.repeat(np.arange(1, n_subjects + 1), n_samples),
+        'Time': np.tile(time, n_subjects),
+        'Conc': conc.ravel(),
+        'Dose': np.repeat(dose, n_samples),
+    })
+
+
+def compartment_parameters(n_compartments):
+    """Central compartment with absorption and a chain of peripheral compartments, in the format of multiple_compartment_simulation."""
+    parameters = {
+        'Compartment 0': {'C0': 0, 'k_in': None, 'k_out': 1.0, 'V': 40.0},
+        'Compartment 1': {'C0': 0, 'k_in': 1.0, 'k_out': 0.15, 'V': 40.0},
+    }
+    for i in range(2, n_compartments):
+        parameters[f'Compartment {i}'] = {'C0': 0, 'k_in': 0.3 / i, 'k_out': 0.2 / i, 'V': 40.0}
+    return parameters
+
+
+def _population_pk(n_patients, n_doses):
+    np.random.seed(0)
+    dose = 100 if n_doses == 1 else Regimen.repeated(100, 12, n_doses, route='non_iv')
+    parameters = {
+        'Dose': dose, 'Population Clearance': 6.0, 'Population Volume of Distribution': 40.0, 'Population ka': 1.2,
+        'Population Bioavailability': 0.9, 'Number of Patients': n_patients, 'Omega CL': 0.3, 'Omega V': 0.2, 'Omega ka': 0.3,
+        'Omega F': 0.1, 'Sigma Residual': 0.05, 'C Limit': None, 'sampling_points': 12 * n_doses + 24, 'logit': False,
+    }
+    return lambda: population_pk_simulation(parameters, plot=False)
+
+
+def _multiple_compartment(n_compartments, n_time):
+    parameters = compartment_parameters(n_compartments)
+    time = np.linspace(0, 72, n_time)
+    return lambda: multiple_compartment_simulation(parameters, time, 100.0, 0.9, iv=False)
+
+
+def _multiple_compartment_regimen(n_compartments, n_doses):
+    parameters = compartment_parameters(n_compartments)
+    time = np.linspace(0, 12 * n_doses + 24, 2000)
+    regimen = Regimen(12.0 * np.arange(n_doses), 50.0 * (1 + np.arange(n_doses) % 2), routes='non_iv')
+    return lambda: multiple_compartment_regimen_simulation(parameters, time, regimen)
+
+
+def _nca(n_subjects, n_samples):
+    df = synthetic_trial(n_subjects, n_samples)
+    return lambda: non_compartmental_analysis(df, extended=True)
+
+
+def _im_fit(n_subjects, n_samples):
+    df = synthetic_trial(n_subjects, n_samples)
+    return lambda: one_compartmental_im_analysis(df, 1.0, n_jobs=1)
+
+
+# Each benchmark builds its inputs from a point of the grid and returns the call to measure.
+# The quick grids keep a whole run under a minute, the full grids sweep up to production sizes.
+BENCHMARKS = {
+    'population_pk_simulation': {
+        'setup': _population_pk,
+        'quick': {'n_patients': [100, 1_000], 'n_doses': [1, 7]},
+        'full': {'n_patients': [100, 1_000, 10_000], 'n_doses': [1, 7, 28]},
+    },
+    'multiple_compartment_simulation': {
+        'setup': _multiple_compartment,
+        'quick': {'n_compartments': [2, 4], 'n_time': [1_000]},
+        'full': {'n_compartments': [2, 3, 5, 8], 'n_time': [1_000, 10_000]},
+    },
+    'multiple_compartment_regimen_simulation': {
+        'setup': _multiple_compartment_regimen,
+        'quick': {'n_compartments': [3], 'n_doses': [1, 10]},
+        'full': {'n_compartments': [2, 5], 'n_doses': [1, 10, 50]},
+    },
+    'non_compartmental_analysis': {
+        'setup': _nca,
+        'quick': {'n_subjects': [100, 10_000], 'n_samples': [8, 24]},
+        'full': {'n_subjects': [100, 10_000, 100_000], 'n_samples': [8, 24, 48]},
+    },
+    'one_compartmental_im_analysis': {
+        'setup': _im_fit,
+        'quick': {'n_subjects': [30, 300], 'n_samples': [8, 24]},
+        'full': {'n_subjects': [30, 300, 3_000], 'n_samples': [8, 24, 48]},
+    },
+}
@@ -0,0 +1,136 @@
+import gc
+import itertools
+import json
+import os
+import platform
+import statistics
+import time
+import tracemalloc
+import warnings
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import scipy
+
+from benchmarks.cases import BENCHMARKS
+
+
+def _grid(grid):
+    """Every combination of the grid values, as dictionaries."""
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+
+
+def _measure(run, repeats):
+    """Wall times of repeated calls, then the peak traced memory of one more call."""
+    # The synthetic data hit the usual log(0) and negative concentration warnings, which are not what is measured
+    with warnings.catch_warnings(), np.errstate(all='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return _measure_quietly(run, repeats)
+
+
+def _measure_quietly(run, repeats):
+    times = []
+    for _ in range(repeats):
+        gc.collect()
+        started = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - started)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return times, peak
+
+
+def environment():
+    '''This function helps to describe the machine and the library versions that the results were measured with.'''
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'scipy': scipy.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+    }
+
+
+def run_benchmarks(names=None, size='quick', repeats=3, benchmarks=BENCHMARKS, log=None):
+    '''This function helps to time the engines over their grid of synthetic dataset sizes.
+    Each point of the grid is set up once, called repeats times for the wall time, and called once more under tracemalloc for the
+    peak memory allocated by Python and NumPy during the call.
+
+    Parameters:
+        names (list): The benchmarks to run, None runs all of them.
+        size (str): 'quick' or 'full' grids.
+        repeats (int): Number of timed calls per point.
+        benchmarks (dict): The benchmark definitions, see benchmarks.cases.BENCHMARKS.
+        log (file-like): Where to print one line per point, e.g. sys.stderr.
+
+    Returns:
+        results (dict): "environment" and "results", a list with the benchmark, its parameters, time_min, time_median (s), repeats and
+        peak_memory_mb of every point.
+    '''
+    unknown = sorted(set(names or ()) - set(benchmarks))
+    if unknown:
+        raise ValueError(f'Unknown benchmarks {unknown}. Use some of {list(benchmarks)}.')
+    results = []
+    for name in names or benchmarks:
+        for params in _grid(benchmarks[name][size]):
+            times, peak = _measure(benchmarks[name]['setup'](**params), repeats)
+            results.append({
+                'benchmark': name,
+                'params': params,
+                'time_min': min(times),
+                'time_median': statistics.median(times),
+                'repeats': repeats,
+                'peak_memory_mb': peak / 2 ** 20,
+            })
+            if log is not None:
+                print(f"{name} {params}: {min(times) * 1e3:.1f} ms, {peak / 2 ** 20:.1f} MB", file=log, flush=True)
+    return {'environment': environment(), 'results': results}
+
+
+def _key(result):
+    return result['benchmark'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare_results(results, baseline, time_tolerance=0.25, memory_tolerance=0.10):
+    '''This function helps to compare benchmark results with a stored baseline, point by point.
+    A point regresses when its minimum time exceeds the baseline by more than time_tolerance, or its peak memory by more than
+    memory_tolerance (relative). Points missing from the baseline are reported as new and never regress.
+
+    Parameters:
+        results (dict): The output of run_benchmarks.
+        baseline (dict): A previous output of run_benchmarks.
+        time_tolerance (float): Allowed relative increase of the minimum time.
+        memory_tolerance (float): Allowed relative increase of the peak memory.
+
+    Returns:
+        comparison (PandasDataFrame): One row per point, with the benchmark, its parameters, the time and memory of both runs,
+        their ratios and a "Regression" flag.
+    '''
+    reference = {_key(result): result for result in baseline['results']}
+    rows = []
+    for result in results['results']:
+        base = reference.get(_key(result))
+        time_ratio = result['time_min'] / base['time_min'] if base else np.nan
+        memory_ratio = result['peak_memory_mb'] / base['peak_memory_mb'] if base and base['peak_memory_mb'] > 0 else np.nan
+        rows.append({
+            'Benchmark': result['benchmark'],
+            'Parameters': json.dumps(result['params'], sort_keys=True),
+            'Time (ms)': result['time_min'] * 1e3,
+            'Baseline Time (ms)': base['time_min'] * 1e3 if base else np.nan,
+            'Time Ratio': time_ratio,
+            'Peak Memory (MB)': result['peak_memory_mb'],
+            'Baseline Peak Memory (MB)': base['peak_memory_mb'] if base else np.nan,
+            'Memory Ratio': memory_ratio,
+            'Regression': bool(time_ratio > 1 + time_tolerance or memory_ratio > 1 + memory_tolerance),
+        })
+    return pd.DataFrame(rows)
@@ -5,13 +5,16 @@ import streamlit as st
 import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
-from pkpd_sian.simulation import pk_iv_dose, pk_prolonged_iv_dose, pk_non_iv_dose,multiple_compartment_simulation
+from pkpd_sian.regimen import Regimen
+from pkpd_sian.simulation import regimen_simulation, multiple_compartment_regimen_simulation
+from pkpd_sian.profiling import performance_panel
 
 IMG_DIR = Path(os.getenv("IMG_DIR", Path(__file__).resolve().parents[1] / "images"))
 
 
 # Page setup
 st.set_page_config(page_title='PK Simulation', page_icon='💊', layout="wide", initial_sidebar_state="auto", menu_items=None)
+performance_panel()
 st.title("💊 PK Simulation")
 one_compartment, multiple_compartment, physiology_compartment = st.tabs(['One Compartmental Simulation','Multiple Compartmental Simulation','Physiology-based Simulation'])
 
@@ -86,33 +89,19 @@ It also enables to define different dosing regimens by the buttons "Add IV Dose"
 
     # Run the simulation
     if run_simulation:
-        conc = {}
-        add_conc = {}
-        conc_each_dose = {}
-    
-        for i,dose_regimen in enumerate(st.session_state.dose_times):
-            dose = dose_regimen['dose']
-            start_time = dose_regimen['time']
-            if dose_regimen['label'] == 'iv':
-                if dose_regimen['infusion_duration'] == None:
-                    conc[i] = pk_iv_dose(dose=dose, time = np.arange(0,simulation_range-start_time+0.1, 0.1), ke=ke, Vd=Vd)
-                elif dose_regimen['infusion_duration'] is not None:
-                    conc[i] = pk_prolonged_iv_dose(dose=dose, time = np.arange(0,simulation_range-start_time+0.1, 0.1), ke=ke, Vd=Vd,infusion_duration=dose_regimen['infusion_duration'])
-            
-            elif dose_regimen['label'] == 'non_iv':
-                if ka is not None:
-                    conc[i] = pk_non_iv_dose(dose=dose, F=dose_regimen['F'], time = np.arange(0,simulation_range-start_time+0.1, 0.1), ke=ke, Vd=Vd,ka=ka)
-                else:
-                    conc[i] = np.zeros((np.arange(0,simulation_range-start_time+0.1, 0.1).shape))
-                    st.error('**Parameter Mismatch:** You need to define ka for the simulation of Non-IV Drug.')
-                    break
-        
-            add_conc[i] = np.zeros((int(start_time/0.1)))
-            conc_each_dose[i] = np.concatenate((add_conc[i],conc[i]),axis=0)
-    
-        simulate_conc = np.zeros((np.arange(0,simulation_range+0.1, 0.1).shape))
-        for key, conc in conc_each_dose.items():
-            simulate_conc += conc
+        try:
+            regimen = Regimen.from_records(st.session_state.dose_times)
+        except ValueError as error:
+            regimen = None
+            st.error(f'**Parameter Mismatch:** {error}')
+        if regimen is not None and regimen.is_non_iv.any() and ka is None:
+            regimen = None
+            st.error('**Parameter Mismatch:** You need to define ka for the simulation of Non-IV Drug.')
+
+    if run_simulation and regimen is not None:
+        simulation_time = np.arange(0, simulation_range + 0.1, 0.1)
+        simulate_conc, dose_profiles = regimen_simulation(regimen, simulation_time, ke=ke, Vd=Vd, ka=ka, each_dose=True)
+        conc_each_dose = {i: conc_array for i, conc_array in enumerate(dose_profiles)}
 
         fig = go.Figure()
         if each_dose_pk_profile: 
@@ -240,36 +229,21 @@ It also enables to define different dosing regimens by the buttons "Add IV Dose"
 
     
     # Run the simulation
-    if st.button("Run Simulation", key='Multiple_Simulation'):
-        conc = {}
-        conc_each_dose = {}
-        total_concentration = {f'C{i}': np.zeros_like(time) for i in range(len(st.session_state.parameters))}
-
-        # Simulate each dose
-        for i, dose_regimen in enumerate(st.session_state.dose_regimens):
-            dose = dose_regimen['dose']
-            start_time = dose_regimen['time']
-            if dose_regimen['label'] == 'iv':
-                conc[f'regimen{i}'] = multiple_compartment_simulation(st.session_state.parameters, time, dose, F, iv=True) 
-            elif dose_regimen['label'] == 'non_iv':
-                if ka is not None:
-                    conc[f'regimen{i}'] = multiple_compartment_simulation(st.session_state.parameters, time, dose, F, iv=False)
-                else:
-                    conc[f'regimen{i}'] = {f'C{comp}': np.zeros_like(time) for comp in range(len(st.session_state.parameters))}
-                    st.error('**Parameter Mismatch:** You need to define ka for the simulation of Non-IV Drug.')
-                    break
-            
-            # Store compartments concentration into each dose
-            for compartment in range(len(st.session_state.parameters)):
-                if f'regimen{i}' not in conc_each_dose:
-                    conc_each_dose[f'regimen{i}'] = {}
-                conc_each_dose[f'regimen{i}'][f'C{compartment}'] = np.zeros_like(time)
-                conc_each_dose[f'regimen{i}'][f'C{compartment}'][int(start_time / 0.1):] = conc[f'regimen{i}'][f'C{compartment}'][:len(time) - int(start_time / 0.1)]
-
-        # Calculate concentration for each compartment during the whole regimen
-        for dose_regimen in conc_each_dose.values():
-            for compartment, values in dose_regimen.items():
-                total_concentration[compartment] += values[:len(time)]
+    run_multiple_simulation = st.button("Run Simulation", key='Multiple_Simulation')
+    if run_multiple_simulation:
+        # All doses share the bioavailability defined for the central compartment
+        try:
+            multiple_regimen = Regimen.from_records([{**record, 'F': F} for record in st.session_state.dose_regimens])
+        except ValueError as error:
+            multiple_regimen = None
+            st.error(f'**Parameter Mismatch:** {error}')
+        if multiple_regimen is not None and multiple_regimen.is_non_iv.any() and ka is None:
+            multiple_regimen = None
+            st.error('**Parameter Mismatch:** You need to define ka for the simulation of Non-IV Drug.')
+
+    if run_multiple_simulation and multiple_regimen is not None:
+        # Simulate the whole regimen
+        total_concentration = multiple_compartment_regimen_simulation(st.session_state.parameters, time, multiple_regimen)
 
         # Visualize the results
         fig = go.Figure()
@@ -1,10 +1,14 @@
 # Import modules/packages
 import streamlit as st
-from pkpd_sian.simulation import population_pk_simulation
+from pkpd_sian.simulation import population_pk_plot, population_pk_simulation
+from pkpd_sian.storage import simulation_to_long, write_study
+from pkpd_sian.profiling import performance_panel
+from pkpd_sian.jobs import job_progress, session_jobs
 
 
 #Page setup
 st.set_page_config(page_title='Population PK Simulation', page_icon='💊', layout="wide", initial_sidebar_state="auto", menu_items=None)
+performance_panel()
 st.title("💊 Population PK Simulation")
 
 st.write("""This page helps to visualize PK profile of the drug, using the one-compartmental model.
@@ -48,7 +52,7 @@ parameters = {'Dose': dose,
               'sampling_points': sampling_points,
               'logit':logit}
 
-# Simulate the PK profile 
+# Simulate the PK profile in the background, so that the page keeps responding and its reruns do not restart the simulation
 warning_values = []
 if st.button("Run Simulation",key='One Compartment Simulation'):
     for name, value in parameters.items():
@@ -58,15 +62,24 @@ if st.button("Run Simulation",key='One Compartment Simulation'):
             warning_values.append(name)
     
     if len(warning_values) == 0:
-        df_C, df_C_ln = population_pk_simulation(parameters)
-        st.subheader('Simulation Data')
-        if parameters['logit']:
-            st.data_editor(df_C_ln)
-        else:
-            st.data_editor(df_C)
+        session_jobs().submit('population_pk', population_pk_simulation, parameters=parameters, plot=False)
     else: 
         st.error(f'**Parameter Mismatch:** {", ".join(warning_values)} is/are below 0. All defined parameters must be higher than 0.')
 
+job = job_progress('population_pk', label='Population simulation', unit='patients')
+if job is not None:
+    df_C, df_C_ln = job.result
+    simulated_parameters = job.kwargs['parameters']
+    population_pk_plot(df_C, df_C_ln, simulated_parameters)
+    st.subheader('Simulation Data')
+    if simulated_parameters['logit']:
+        st.data_editor(df_C_ln)
+    else:
+        st.data_editor(df_C)
 
-
-    
\ No newline at end of file
+    # Export the simulated population for the PK Analysis page, serialised once per simulation rather than on every rerun
+    if st.session_state.get('population_pk_study_job') is not job:
+        st.session_state.population_pk_study = write_study(simulation_to_long(df_C, simulated_parameters['Dose']))
+        st.session_state.population_pk_study_job = job
+    st.download_button('Download as study file', data=st.session_state.population_pk_study,
+                       file_name='population_pk_simulation.arrow', mime='application/octet-stream')
@@ -1,9 +1,11 @@
 # Import modules/packages
 import streamlit as st
 from pkpd_sian.simulation import population_pd_simulation
+from pkpd_sian.profiling import performance_panel
 
 # Page setup 
 st.set_page_config(page_title='Population PD Simulation', page_icon='💊', layout="wide", initial_sidebar_state="auto", menu_items=None)
+performance_panel()
 st.title("💊 PD Simulation")
 st.write("""This page helps to visualize PD profile of the drug, using the Emax-hill model.
 
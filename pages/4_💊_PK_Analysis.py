@@ -6,13 +6,18 @@ import streamlit as st
 import pandas as pd 
 import numpy as np
 from pkpd_sian.visualization import distribution_plots, id_count_by_dose, pk_profile_by_dose
-from pkpd_sian.analysis import non_compartmental_analysis, non_compartmental_plots, one_compartmental_iv_analysis, one_compartmental_im_analysis
-from pkpd_sian.preprocessing import data_preprocessing
+from pkpd_sian.analysis import non_compartmental_analysis, multiple_dose_non_compartmental_analysis, non_compartmental_batch_plots, one_compartmental_iv_analysis, one_compartmental_im_analysis
+from pkpd_sian.preprocessing import INFORMATIONAL_CHECKS, PKDataset, data_preprocessing, read_trial_csv
+from pkpd_sian.report import generate_report
+from pkpd_sian.storage import open_study
+from pkpd_sian.profiling import performance_panel
+from pkpd_sian.jobs import job_progress, process_workers, session_jobs
 
 DATA_DIR = Path(os.getenv("DATA_DIR", Path(__file__).resolve().parents[1] / "testdata"))
 
 # Page setup
 st.set_page_config(page_title='PK Analysis', page_icon='💊', layout="wide", initial_sidebar_state="auto", menu_items=None)
+performance_panel()
 st.title("💊 PK Analysis Tools")
 introduction, file_characteristic, visualization, non_compartment, one_compartment = st.tabs(["Introduction",'File Characteristic','Data Visualization',"Non-compartmental Analysis", "One-compartmental Analysis"])
 
@@ -27,7 +32,7 @@ with introduction:
  - **One-compartmental Analysis**: the analysis fits the observed data to the predefined model and then derive PK parameters from the model.''')
 
 # File uploader
-    uploaded_file = st.file_uploader('Import your CSV dataset here')
+    uploaded_file = st.file_uploader('Import your CSV dataset (or a study file exported by the simulation pages) here', type=['csv', 'arrow'])
 
     st.caption('These two demo datasets could be used as application trial:')
     col1, col2 = st.columns(2)
@@ -54,7 +59,10 @@ with introduction:
 
 # Read and store the data in session state
     if file is not None:
-        st.session_state.df = pd.read_csv(file)
+        if str(getattr(file, 'name', file)).endswith('.arrow'):
+            st.session_state.df = open_study(file).to_pandas()
+        else:
+            st.session_state.df = read_trial_csv(file)
         st.success('File importing success')
         st.caption('Next step is characterising the data with File Characteristic tab.')
 
@@ -79,9 +87,25 @@ with file_characteristic:
 
         # Update the session state with the edited dataframe
         st.session_state.edited_extract_df = edited_extract_df
+
+        # Sort and index the dataset once for the analysis and the plots
+        dataset = PKDataset(edited_extract_df)
+
+        # Report the data problems of every individual at once
+        subject_flags = dataset.validation.subject_flags
+        flags = subject_flags.drop(columns=['ID', *INFORMATIONAL_CHECKS]).astype(bool)
+        if flags.to_numpy().any():
+            problems = [f'{check} ({count} ID)' for check, count in flags.sum().items() if count > 0]
+            st.warning(f'**Data check:** {", ".join(problems)}. Rows with missing mandatory values or negative concentrations are excluded from the analysis.')
+            with st.expander('Individuals with data issues'):
+                st.dataframe(subject_flags[flags.any(axis=1).to_numpy()], hide_index=True)
+        zero_conc = int((subject_flags['Zero Conc'] > 0).sum())
+        if zero_conc:
+            st.info(f'Zero concentrations after time 0 in {zero_conc} ID, e.g. below the limit of quantification. They are kept in the analysis.')
     else:
         st.info('You should upload the file first')
         edited_extract_df = None
+        dataset = None
 
 
 
@@ -122,7 +146,8 @@ with visualization:
       dose_profile = st.toggle('Display PK profile by Dose', value = False)
       
       if dose_profile:
-        pk_profile_by_dose(edited_extract_df)
+        dose_summary = st.toggle('Display the median and 90% interval', value = False)
+        pk_profile_by_dose(dataset, summary=dose_summary)
     
     else:
         st.info('You should upload the file first')
@@ -145,7 +170,9 @@ with non_compartment:
     
     if edited_extract_df is not None:
         # Export the analysis resutls
-        non_compartment_df, unqualified_id = non_compartmental_analysis(edited_extract_df)
+        auc_method = st.radio('AUC method', ['linear', 'linear-up/log-down'], horizontal=True,
+                              help='The linear-up/log-down method uses logarithmic trapezoids where the concentration decreases.')
+        non_compartment_df, unqualified_id = non_compartmental_analysis(dataset, extended=True, auc_method=auc_method)
         
         # Print warning with the unqualified ID
         if len(unqualified_id) > 0:
@@ -153,32 +180,39 @@ with non_compartment:
 
         # Add covariates to the final results dataframe
         if not non_compartment_df.empty:
-            covariate_df = edited_extract_df.drop(['Time','Conc','Dose'],axis = 1).drop_duplicates(subset='ID')
+            covariate_df = dataset.covariates()
             analysis_covariate_df = non_compartment_df.merge(covariate_df, on = 'ID')
             non_compartment_df_final = st.data_editor(analysis_covariate_df)
             
+            # Analyse each dosing interval of repeated-dose studies
+            multiple_dose = st.toggle('Multiple-dose Analysis')
+            if multiple_dose:
+                tau_col, n_doses_col = st.columns(2)
+                tau = tau_col.number_input('Dosing interval (tau)', min_value=0.01, value=12.0)
+                n_doses = n_doses_col.number_input('Number of doses', min_value=1, value=1, step=1)
+                interval_df, unqualified_interval_id = multiple_dose_non_compartmental_analysis(dataset, tau, n_doses=int(n_doses), auc_method=auc_method)
+                if len(unqualified_interval_id) > 0:
+                    st.error(f'**Insufficient data:** ID {", ".join(str(id) for id in unqualified_interval_id)} have no dosing interval with at least 2 data points.')
+                st.dataframe(interval_df)
+
             #Display the selection profile:
             plots = st.toggle('Display the individual profiles')
             counts = non_compartment_df_final['ID'].nunique()
             
             if plots:
-                col1, col2 = st.columns(2)
-                for id, lambda_points,count in zip(non_compartment_df_final['ID'],non_compartment_df_final['Number of Lambda Points'],range(counts)):
-                    # Extract whole PK profile 
-                    df_whole_profile = edited_extract_df[edited_extract_df['ID']==id].dropna()
-                    df_whole_profile['log_conc'] = np.log(df_whole_profile['Conc'])
-                    
-                    # Extract PK profile with selected lambda points
-                    df_lambda_profile = df_whole_profile.iloc[-lambda_points:,:].dropna()
-                    df_lambda_profile['log_conc'] = np.log(df_lambda_profile['Conc'])
-
-                    # Plot with the 2 columns layout
-                    if count%2 == 0:
-                        with col1:
-                            non_compartmental_plots(df_whole_profile,df_lambda_profile)
-                    else:
-                        with col2:
-                            non_compartmental_plots(df_whole_profile,df_lambda_profile)
+                # Draw the individuals page by page, each page as one figure
+                page_size = 20
+                n_pages = max(-(-counts // page_size), 1)
+                page = st.number_input(f'Page (of {n_pages})', min_value=1, max_value=n_pages, value=1, step=1) if n_pages > 1 else 1
+                fig = non_compartmental_batch_plots(dataset, non_compartment_df_final, page=page - 1, page_size=page_size)
+                config_nca = {
+                    'toImageButtonOptions': {
+                    'format': 'png', 
+                    'filename': 'nca_analysis',
+                    'height': None,
+                    'width': None,
+                    'scale': 5 }}
+                st.plotly_chart(fig, config=config_nca)
     
         else:
             st.error('**Insufficient Data:** For non-compartmental analysis, there should be at least 3 data points for each individuals. Double check your input data.')
@@ -212,7 +246,7 @@ with one_compartment:
         if iv_analysis:
             st.subheader("IV Drug Analysis")
             # Export the analysis resutls
-            iv_analysis_final, unqualified_id = one_compartmental_iv_analysis(edited_extract_df)
+            iv_analysis_final, unqualified_id = one_compartmental_iv_analysis(dataset)
             
             # Print warning for unqualified id
             if len(unqualified_id) > 0:
@@ -220,7 +254,7 @@ with one_compartment:
 
             # Add the covariates to the dataframe
             if not iv_analysis_final.empty:
-                covariate_df = edited_extract_df.drop(['Time','Conc','Dose'],axis = 1).drop_duplicates(subset='ID')
+                covariate_df = dataset.covariates()
                 iv_analysis_covariate_df = iv_analysis_final.merge(covariate_df, on = 'ID')
                 iv_analysis_covariate_final = st.data_editor(iv_analysis_covariate_df)
             else:
@@ -232,7 +266,7 @@ with one_compartment:
         if im_analysis:
             st.subheader("Non-IV Drug Analysis")
             st.caption("Each patient needs at least 3 data points for non-iv drug analysis to fit the non-linear model with 3 parameters, including ka, ke, and Vd. However, to obtain reliable results, each patient should have more than 30 data points.")
-            st.caption("The non-linear model fitting process requires initial guesses for the parameters, which can be based on previous studies. If the initial guesses are significantly different from the actual values, alternative values should be considered.")
+            st.caption("The non-linear model fitting process starts each patient from initial guesses derived from its own non-compartmental analysis. The initial guesses below, which can be based on previous studies, are used as a second attempt for the patients whose fit does not converge.")
             
             # Take the initial guesses of ke, ka, and Vd
             col1, col2 = st.columns(2)
@@ -246,21 +280,39 @@ with one_compartment:
             start =  st.button('Run Analysis')
 
             if start: 
+                # Fit in the background, so that the page keeps responding and its reruns do not restart the fits
+                session_jobs().submit('im_analysis', one_compartmental_im_analysis, df=dataset, predefined_F=predefined_F, initial_ka=initial_ka, initial_ke=initial_ke, initial_Vd=initial_Vd, n_jobs=process_workers())
+
+            job = job_progress('im_analysis', label='Non-IV drug analysis', unit='patients')
+            if job is not None: 
                 # Export the analysis resutls
-                im_analysis_final, unqualified_id = one_compartmental_im_analysis(df=edited_extract_df, predefined_F=predefined_F, initial_ka=initial_ka, initial_ke=initial_ke, initial_Vd=initial_Vd)
+                im_analysis_final, unqualified_id = job.result
                 
                 # Print warning for unqualified id
                 if len(unqualified_id) > 0:
-                    st.error(f'**Insufficient data:** ID {", ".join(str(id) for id in unqualified_id)} have less than 3 data points, which is insufficient for fitting the model. Double check your data.')
+                    st.error(f'**Insufficient data:** ID {", ".join(str(id) for id in unqualified_id)} have less than 3 data points or could not be fitted from the initial guesses. Double check your data or try other initial guesses.')
 
                 # Add the covariates to the dataframe
                 if not im_analysis_final.empty:
-                    covariate_df = edited_extract_df.drop(['Time','Conc','Dose'],axis = 1).drop_duplicates(subset='ID')
+                    covariate_df = job.kwargs['df'].covariates()
                     im_analysis_covariate_df = im_analysis_final.merge(covariate_df, on = 'ID')
                     im_analysis_covariate_final = st.data_editor(im_analysis_covariate_df)
                 else:
                     st.info('**Insufficient data:** For non-compartmental analysis, there should be at least 3 data points for each individuals. Double check your input data.')
 
+        st.write('\n')
+
+        # Full report of every individual
+        st.subheader('Full Report')
+        st.caption('The report gathers the analysis tables and the individual plots of every patient in a single HTML file, which can be opened in any browser.')
+        report_analyses = st.multiselect('Analyses to include:', ['nca', 'iv', 'im'], default=['nca', 'iv', 'im'],
+                                         format_func={'nca': 'Non-compartmental', 'iv': 'IV Drug', 'im': 'Non-IV Drug'}.get)
+        report_F = st.number_input('Bioavailability used in the report:', value=1.00, format="%.3f")
+        if st.button('Generate Report'):
+            with st.spinner('Rendering the individual plots...'):
+                report = generate_report(dataset, analyses=tuple(report_analyses), predefined_F=report_F, n_jobs=process_workers())
+            st.download_button('Download Report', report, file_name='pk_report.html', mime='text/html')
+
 
                 
 
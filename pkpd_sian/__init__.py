@@ -1,5 +1,7 @@
 """PKPD-SiAn Tools core package."""
 
-__all__ = ["__version__"]
+from pkpd_sian.regimen import Regimen
+
+__all__ = ["__version__", "Regimen"]
 
 __version__ = "2.0.1"
@@ -0,0 +1,5 @@
+from pkpd_sian.cli import main
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
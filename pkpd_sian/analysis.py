@@ -1,171 +1,682 @@
-import streamlit as st
+import multiprocessing
+import os
+import threading
+import warnings
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import pandas as pd
 import numpy as np
-import plotly.graph_objects as go
-import plotly.express as px
-from sklearn.linear_model import LinearRegression
-from sklearn.metrics import r2_score, root_mean_squared_error
 from scipy.optimize import curve_fit
-from scipy.integrate import quad
+from scipy.special import lambertw
+
+from pkpd_sian.preprocessing import PKDataset, clean_rows
+from pkpd_sian.profiling import count, profiled
 
 
 MIN_TIME_POINTS = 3
 EPSILON = 0.00001
+# Below this number of individuals, starting worker processes costs more than the fits
+PARALLEL_MIN_SUBJECTS = 200
+# Number of individuals solved together by the batch least-squares fitter, bounding its memory use
+BATCH_FIT_BLOCK = 50000
+# Number of individuals fitted between two progress reports of a serial fit
+PROGRESS_CHUNK_SUBJECTS = 10
+
+
+def _process_pool(n_workers):
+    """Process pool of n_workers. Outside the main thread, e.g. in a Streamlit script run or a background job, the workers are
+    spawned rather than forked, since forking a multithreaded process can deadlock the children on a lock held by another thread."""
+    if threading.current_thread() is threading.main_thread():
+        return ProcessPoolExecutor(max_workers=n_workers)
+    return ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+_Profiles = namedtuple('_Profiles', ['ids', 'counts', 'starts', 'time', 'conc', 'dose'])
+
+
+@profiled('analysis.sort_profiles')
+def _sorted_profiles(df, min_points=MIN_TIME_POINTS):
+    """Keep the clean rows and sort the dataset once by ID (in order of first appearance) and Time.
+    The clean rows have every mandatory column and a non-negative concentration, missing covariates do not matter.
+    A PKDataset is already sorted, so its order (by dose, then ID) is kept and its cached validation mask is used.
+
+    Returns the contiguous profiles of the subjects with at least min_points points, and the list of the other IDs.
+    """
+    if isinstance(df, PKDataset):
+        codes, ids, presorted = df.subject_codes(), df.ids, True
+        clean = df.validation.clean_mask
+        df = df.frame
+    else:
+        codes, ids = pd.factorize(df['ID'])
+        ids, presorted = np.asarray(ids), False
+        clean = clean_rows(df)
+    keep = (codes >= 0) & clean
+    codes = codes[keep]
+    time = df['Time'].to_numpy(dtype=float)[keep]
+    counts = np.bincount(codes, minlength=ids.size)
+
+    # Keep only the rows of qualified subjects so that every segment is non-empty
+    qualified = counts >= max(min_points, 1)
+    rows = qualified[codes]
+    codes, time = codes[rows], time[rows]
+    order = slice(None) if presorted else np.lexsort((time, codes))
+    counts = counts[qualified]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    profiles = _Profiles(
+        ids=ids[qualified],
+        counts=counts,
+        starts=starts,
+        time=time[order],
+        conc=df['Conc'].to_numpy(dtype=float)[keep][rows][order],
+        dose=df['Dose'].to_numpy()[keep][rows][order],
+    )
+    return profiles, ids[~qualified].tolist()
+
+
+def _subset_profiles(profiles, selected):
+    """Contiguous profiles of the selected individuals, given as a boolean mask or as indices (repeats allowed)."""
+    selected = np.arange(profiles.counts.size)[selected]
+    counts = profiles.counts[selected]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    rows = np.repeat(profiles.starts[selected] - starts, counts) + np.arange(counts.sum())
+    return _Profiles(
+        ids=profiles.ids[selected],
+        counts=counts,
+        starts=starts,
+        time=profiles.time[rows],
+        conc=profiles.conc[rows],
+        dose=profiles.dose[rows],
+    )
+
+
+def _segment_sum(values, profiles):
+    """Sum values per subject segment."""
+    return np.add.reduceat(values, profiles.starts)
+
+
+def _broadcast_segments(values, profiles):
+    """Repeat one value per subject onto each of its rows."""
+    return np.repeat(values, profiles.counts)
+
+
+def _regression_from_sums(n, sum_t, sum_y, sum_tt, sum_ty, sum_yy):
+    """Least-squares slope, intercept and R2 of y on t for windows described by their running sums."""
+    s_tt = sum_tt - sum_t * sum_t / n
+    s_ty = sum_ty - sum_t * sum_y / n
+    s_yy = sum_yy - sum_y * sum_y / n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(s_tt > 0, s_ty / s_tt, 0.0)
+        # A constant response is fitted perfectly, as in sklearn.metrics.r2_score
+        r2 = np.where(s_yy > 0, slope * s_ty / s_yy, 1.0)
+    intercept = (sum_y - slope * sum_t) / n
+    return slope, intercept, r2
+
+
+def _segment_terminal_slopes(profiles, log_conc):
+    """Regress every tail window of at least MIN_TIME_POINTS points of every subject at once and keep each subject's best R2.
+
+    Returns per-subject arrays (slope, intercept, r2, number of lambda points).
+    """
+    ends = profiles.starts + profiles.counts
+    row = np.arange(profiles.time.size)
+    points_to_end = _broadcast_segments(ends, profiles) - row
+
+    # Sums over the last k points of a subject are suffix sums, built from one global cumulative sum per term.
+    # Centering each profile on its last point keeps the sums of squares well conditioned.
+    t_ref = profiles.time[ends - 1]
+    y_ref = log_conc[ends - 1]
+    t = profiles.time - _broadcast_segments(t_ref, profiles)
+    y = log_conc - _broadcast_segments(y_ref, profiles)
+    suffix_sums = []
+    for values in (t, y, t * t, t * y, y * y):
+        cumulative = np.cumsum(values)
+        # The rounding error of each partial sum is tracked separately (compensated summation), so a subject
+        # late in a large dataset keeps the precision of its own sums rather than that of the running total
+        rounding = np.cumsum(np.diff(cumulative, prepend=0.0) - values)
+        last = ends - 1
+        suffix = _broadcast_segments(cumulative[last], profiles) - cumulative
+        suffix -= _broadcast_segments(rounding[last], profiles) - rounding
+        suffix_sums.append(suffix + values)
+    slope, intercept, r2 = _regression_from_sums(points_to_end, *suffix_sums)
+
+    # Best R2 per subject, the smallest window (latest starting row) wins ties as in the incremental search
+    r2 = np.where(points_to_end >= MIN_TIME_POINTS, r2, -np.inf)
+    best_r2 = np.maximum.reduceat(r2, profiles.starts)
+    is_best = r2 == _broadcast_segments(best_r2, profiles)
+    best = np.maximum.reduceat(np.where(is_best, row, -1), profiles.starts)
+    intercept = y_ref + intercept[best] - slope[best] * t_ref
+    return slope[best], intercept, r2[best], points_to_end[best]
+
+
+def _segment_trapezoids(profiles, auc_method='linear'):
+    """Sum the AUC and AUMC trapezoids of every subject.
+
+    auc_method is 'linear' (linear trapezoids) or 'linear-up/log-down' (logarithmic trapezoids where the concentration decreases).
+    """
+    time, conc = profiles.time, profiles.conc
+    ends = profiles.starts + profiles.counts
+
+    # Trapezoids of C and t * C between consecutive rows, discarding those that straddle two subjects
+    dt = np.zeros_like(conc)
+    dt[:-1] = np.diff(time)
+    c1, c2 = conc, np.append(conc[1:], 0.0)
+    t1, t2 = time, np.append(time[1:], 0.0)
+    trapezoids = dt * (c1 + c2) / 2
+    moment_trapezoids = dt * (t1 * c1 + t2 * c2) / 2
+    if auc_method == 'linear-up/log-down':
+        # Exponential decay between two positive, decreasing concentrations, with k = ln(C1 / C2) / dt
+        log_down = (c2 < c1) & (c2 > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            k = np.log(c1 / c2) / dt
+            trapezoids = np.where(log_down, (c1 - c2) / k, trapezoids)
+            moment_trapezoids = np.where(log_down, (t1 * c1 - t2 * c2) / k + (c1 - c2) / k ** 2, moment_trapezoids)
+    elif auc_method != 'linear':
+        raise ValueError(f"Unknown auc_method '{auc_method}'. Use 'linear' or 'linear-up/log-down'.")
+    trapezoids[ends - 1] = 0.0
+    moment_trapezoids[ends - 1] = 0.0
+    return _segment_sum(trapezoids, profiles), _segment_sum(moment_trapezoids, profiles)
+
+
+def _segment_extremes(profiles):
+    """Cmax, the first row where it is reached, and Cmin of every subject."""
+    conc = profiles.conc
+    cmax = np.maximum.reduceat(conc, profiles.starts)
+    row = np.arange(conc.size)
+    first_max = np.minimum.reduceat(np.where(conc == _broadcast_segments(cmax, profiles), row, conc.size), profiles.starts)
+    return cmax, first_max, np.minimum.reduceat(conc, profiles.starts)
+
+
+@profiled('analysis.nca_reductions')
+def _segment_nca(profiles, auc_method='linear'):
+    """Compute the NCA statistics of every subject with segment reductions over the sorted dataset."""
+    time, conc = profiles.time, profiles.conc
+    ends = profiles.starts + profiles.counts
+    auc_0_last, aumc_0_last = _segment_trapezoids(profiles, auc_method)
+    cmax, first_max, _ = _segment_extremes(profiles)
+
+    slope, intercept, r2, n_lambda_points = _segment_terminal_slopes(profiles, np.log(conc + EPSILON))
+    return {
+        'dose': profiles.dose[profiles.starts],
+        'auc_0_last': auc_0_last,
+        'aumc_0_last': aumc_0_last,
+        'cmax': cmax,
+        'tmax': time[first_max],
+        'clast': conc[ends - 1],
+        'tlast': time[ends - 1],
+        'slope': slope,
+        'intercept': intercept,
+        'r2': r2,
+        'n_lambda_points': n_lambda_points,
+    }
+
+
+def _bateman(t, ka, ke, V, F, dose):
+    """One-compartment model with first-order absorption (Bateman function)."""
+    return (F * dose * ka / (V * (ka - ke))) * (np.exp(-ke * t) - np.exp(-ka * t))
 
 
-def _iter_profiles(df):
-    """Yield (ID, profile_df) pairs with NaNs removed, preserving original order."""
-    for subject_id, subset in df.groupby('ID', sort=False):
-        yield subject_id, subset.dropna()
+def _bateman_jacobian(t, ka, ke, V, F, dose):
+    """Analytic derivatives of the Bateman function with respect to (ka, ke, V), stacked on a new last axis."""
+    exp_ke, exp_ka = np.exp(-ke * t), np.exp(-ka * t)
+    amplitude = F * dose * ka / (V * (ka - ke))
+    squared_gap = V * (ka - ke) ** 2
+    d_ka = -F * dose * ke / squared_gap * (exp_ke - exp_ka) + amplitude * t * exp_ka
+    d_ke = F * dose * ka / squared_gap * (exp_ke - exp_ka) - amplitude * t * exp_ke
+    d_V = -amplitude * (exp_ke - exp_ka) / V
+    return np.stack([d_ka, d_ke, d_V], axis=-1)
 
 
-def non_compartmental_analysis(df):
+def _bateman_initial_guesses(nca, F):
+    """Derive per-individual (ka, ke, V) starting values from the NCA statistics.
+
+    ke is the terminal slope, V follows from F * Dose / (ke * AUC_0-inf) and ka is the solution of
+    Tmax = ln(ka / ke) / (ka - ke), obtained in closed form with the Lambert W function.
+    """
+    ke = np.abs(nca['slope'])
+    ke = np.where(ke > 0, ke, 0.1)
+    auc_0_inf = nca['auc_0_last'] + nca['clast'] / ke
+    V = np.where(auc_0_inf > 0, F * nca['dose'] / (ke * auc_0_inf), 1.0)
+
+    # With x = ke * Tmax and r = ka / ke, ln(r) = x (r - 1) is solved by r = -W(-x exp(-x)) / x on the branch
+    # that does not give the trivial root r = 1 (W_-1 when x < 1, W_0 when x > 1)
+    x = np.clip(ke * nca['tmax'], 1e-3, 50.0)
+    x = np.where(np.abs(x - 1) < 1e-3, 1 - 1e-3, x)
+    argument = -x * np.exp(-x)
+    ratio = np.where(x < 1, -lambertw(argument, -1).real / x, -lambertw(argument, 0).real / x)
+    ka = ke * ratio
+    return np.column_stack([ka, ke, V])
+
+
+@profiled('analysis.curve_fit')
+def _fit_bateman_chunk(tasks, F, fallback_guess=None):
+    """Fit a list of (time, conc, dose, initial guess) individuals; returns (ka, ke, V, RMSE) or None per individual."""
+    count('analysis.curve_fit_subjects', len(tasks))
+    results = []
+    for time, conc, dose, guess in tasks:
+        def model(t, ka, ke, V):
+            return _bateman(t, ka, ke, V, F, dose)
+
+        def jacobian(t, ka, ke, V):
+            return _bateman_jacobian(t, ka, ke, V, F, dose)
+
+        result = None
+        for initial_guesses in (guess, fallback_guess):
+            if initial_guesses is None:
+                continue
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    params, _ = curve_fit(model, time, conc, p0=initial_guesses, jac=jacobian)
+            except (RuntimeError, ValueError):
+                continue
+            if np.all(np.isfinite(params)) and np.all(params > 0):
+                prediction = model(time, *params)
+                result = (*params, np.sqrt(np.mean((conc - prediction) ** 2)))
+                break
+        results.append(result)
+    return results
+
+
+def _padded_profiles(profiles):
+    """Lay the sorted profiles out as (individuals x samples) arrays, padded with zeros, and the mask of real samples."""
+    row = np.repeat(np.arange(profiles.counts.size), profiles.counts)
+    column = np.arange(profiles.time.size) - _broadcast_segments(profiles.starts, profiles)
+    shape = (profiles.counts.size, profiles.counts.max(initial=0))
+    time, conc, mask = np.zeros(shape), np.zeros(shape), np.zeros(shape, dtype=bool)
+    time[row, column] = profiles.time
+    conc[row, column] = profiles.conc
+    mask[row, column] = True
+    return time, conc, mask
+
+
+def _iv_bolus_model(t, params, dose, F):
+    """Mono-exponential model C = F * Dose / V * exp(-ke * t) and its derivatives with respect to (ke, V)."""
+    ke, V = params[..., 0:1], params[..., 1:2]
+    prediction = F * dose / V * np.exp(-ke * t)
+    return prediction, np.stack([-t * prediction, -prediction / V], axis=-1)
+
+
+def _absorption_model(t, params, dose, F):
+    """Bateman model and its derivatives with respect to (ka, ke, V)."""
+    ka, ke, V = params[..., 0:1], params[..., 1:2], params[..., 2:3]
+    return _bateman(t, ka, ke, V, F, dose), _bateman_jacobian(t, ka, ke, V, F, dose)
+
+
+@profiled('analysis.levenberg_marquardt')
+def _batch_levenberg_marquardt(model, initial_params, time, conc, mask, dose, F, max_iter=200, tol=1e-10):
+    """Fit every individual (row) at once with vectorized Levenberg-Marquardt steps.
+
+    The parameters are optimized on the log scale, which keeps them positive. Each iteration costs a fixed number of
+    NumPy calls whatever the number of individuals; individuals leave the active set once their step stops improving the fit.
+    Returns (params, converged, rmse).
+    """
+    dose = dose[:, None]
+
+    def evaluate(theta, rows):
+        params = np.exp(theta)
+        prediction, jacobian = model(time[rows], params, dose[rows], F)
+        residuals = np.where(mask[rows], prediction - conc[rows], 0.0)
+        jacobian = np.where(mask[rows][..., None], jacobian * params[:, None, :], 0.0)
+        return residuals, jacobian, np.sum(residuals ** 2, axis=1)
+
+    theta = np.log(initial_params)
+    n_subjects, n_params = theta.shape
+    all_rows = np.arange(n_subjects)
+    with np.errstate(all='ignore'):
+        residuals, jacobian, cost = evaluate(theta, all_rows)
+    damping = np.full(n_subjects, 1e-3)
+    converged = np.zeros(n_subjects, dtype=bool)
+    active = np.isfinite(cost)
+    identity = np.eye(n_params)
+
+    for _ in range(max_iter):
+        rows = np.flatnonzero(active)
+        if rows.size == 0:
+            break
+        J, r = jacobian[rows], residuals[rows]
+        JTJ = np.einsum('snp,snq->spq', J, J)
+        gradient = np.einsum('snp,sn->sp', J, r)
+
+        # Marquardt scaling of the damping by the diagonal of J'J
+        scaled = JTJ + damping[rows, None, None] * (JTJ * identity + 1e-12 * identity)
+        with np.errstate(all='ignore'):
+            try:
+                step = np.linalg.solve(scaled, -gradient[..., None])[..., 0]
+            except np.linalg.LinAlgError:
+                step = (np.linalg.pinv(scaled) @ -gradient[..., None])[..., 0]
+            trial = theta[rows] + step
+            trial_residuals, trial_jacobian, trial_cost = evaluate(trial, rows)
+
+        improved = np.isfinite(trial_cost) & (trial_cost < cost[rows])
+        accepted = rows[improved]
+        theta[accepted] = trial[improved]
+        residuals[accepted] = trial_residuals[improved]
+        jacobian[accepted] = trial_jacobian[improved]
+
+        # Converged when an accepted step barely changes the cost, or the gradient vanishes
+        relative_change = (cost[accepted] - trial_cost[improved]) / np.maximum(cost[accepted], np.finfo(float).tiny)
+        cost[accepted] = trial_cost[improved]
+        done = np.zeros(rows.size, dtype=bool)
+        done[improved] = relative_change < tol
+        done |= np.max(np.abs(gradient), axis=1) < tol * np.maximum(cost[rows], 1.0)
+        damping[rows] = np.where(improved, damping[rows] / 10, damping[rows] * 10)
+        stalled = damping[rows] > 1e12
+        converged[rows[done | stalled]] = True
+        active[rows[done | stalled]] = False
+
+    n_points = mask.sum(axis=1)
+    return np.exp(theta), converged, np.sqrt(cost / n_points)
+
+
+def _batch_fit(profiles, model, initial_params, F, max_iter=200):
+    """Run the batch Levenberg-Marquardt fitter over blocks of BATCH_FIT_BLOCK individuals."""
+    time, conc, mask = _padded_profiles(profiles)
+    dose = profiles.dose[profiles.starts].astype(float)
+    params = np.empty_like(initial_params, dtype=float)
+    converged = np.zeros(initial_params.shape[0], dtype=bool)
+    rmse = np.empty(initial_params.shape[0])
+    for start in range(0, initial_params.shape[0], BATCH_FIT_BLOCK):
+        block = slice(start, start + BATCH_FIT_BLOCK)
+        params[block], converged[block], rmse[block] = _batch_levenberg_marquardt(
+            model, initial_params[block], time[block], conc[block], mask[block], dose[block], F, max_iter
+        )
+    return params, converged, rmse
+
+
+@profiled('analysis.log_linear_regression')
+def _log_linear_table(profiles):
+    """Fit ln(C) = ln(C0) - ke * t to every individual from per-individual sums, returning the iv analysis columns except ID."""
+    n_points = profiles.counts
+
+    # Linear Regression of ln(C) on time from per-individual sums of the centered data
+    Y = np.log(profiles.conc + EPSILON)
+    X = profiles.time
+    X_mean = _segment_sum(X, profiles) / n_points
+    Y_mean = _segment_sum(Y, profiles) / n_points
+    t = X - _broadcast_segments(X_mean, profiles)
+    y = Y - _broadcast_segments(Y_mean, profiles)
+    coef, centered_intercept, _ = _regression_from_sums(
+        n_points, *(_segment_sum(values, profiles) for values in (t, y, t * t, t * y, y * y))
+    )
+    intercept = Y_mean + centered_intercept - coef * X_mean
+
+    # Evaluate the regression on the concentration scale
+    exp_prediction = np.exp(_broadcast_segments(intercept, profiles) + _broadcast_segments(coef, profiles) * X)
+    exp_Y = np.exp(Y)
+    ss_res = _segment_sum((exp_Y - exp_prediction) ** 2, profiles)
+    ss_tot = _segment_sum((exp_Y - _broadcast_segments(_segment_sum(exp_Y, profiles) / n_points, profiles)) ** 2, profiles)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r2 = np.where(ss_tot > 0, 1 - ss_res / ss_tot, np.where(ss_res == 0, 1.0, 0.0))
+
+    slope = -coef
+    c0 = np.exp(intercept)
+    dose = profiles.dose[profiles.starts]
+    return {'Dose': dose,
+            'C0': c0,
+            'ke': slope,
+            'R2': r2,
+            'RMSE': np.sqrt(ss_res / n_points),
+            'AUC_0-inf': c0 / slope,
+            'Half life': np.log(2) / slope,
+            'Apparent CL': slope * dose / c0,
+            'Apparent Vd': dose / c0}
+
+
+def _bateman_table(ka, ke, V, rmse, F, dose):
+    """Primary and closed-form secondary parameters of the non-iv analysis, returned as columns except ID."""
+    tmax = np.log(ke / ka) / (ke - ka)
+    auc = F * dose / (V * ke)
+    return {'Dose': dose,
+            'ka': ka,
+            'ke': ke,
+            'Vd': V,
+            'RMSE': rmse,
+            'Tmax': tmax,
+            'Cmax': _bateman(tmax, ka, ke, V, F, dose),
+            'Half life': np.log(2) / np.minimum(ka, ke),
+            'AUC_0-inf': auc,
+            'Clearance': dose / auc}
+
+
+@profiled('analysis.non_compartmental_analysis')
+def non_compartmental_analysis(df, extended=False, auc_method='linear'):
     '''This function helps to analysis the clinical trials results using non-comparmental analysis.
     
     Parameters: 
-        df (PandasDataFrame): A data frame that stores information of the clinical trials. The columns should be renamed as "ID","Dose","Time", and "Conc".
+        df (PandasDataFrame or PKDataset): A data frame that stores information of the clinical trials. The columns should be renamed as "ID","Dose","Time", and "Conc".
         The additional columns is acceptable. 
+        extended (bool): Also report the exposure, moment and volume metrics listed below.
+        auc_method (str): 'linear' for the linear trapezoidal rule, or 'linear-up/log-down' for the logarithmic trapezoidal rule
+        on the decreasing parts of the profile. It applies to both AUC and AUMC.
         
     Returns: 
         df_analysis (PandasDataFrame): A data frame that stores the analysis results, including: 
             - ID
             - Dose
             - Slope
+            - Intercept (of the terminal regression of the log concentration)
             - Number of Lambda Points
             - R2 Values
             - AUC_0-last
             - AUC_last-inf
             - AUC _0-inf
             - Apparent Clearance
+            - Cmax, Tmax, Clast, Tlast, AUMC_0-last, AUMC_0-inf, MRT, Vz, Vss and %AUC Extrapolated (extended only)
         
         unqualified_id (list): A list of unqualified individuals that cannot do the analysis.'''
     
-    # Initialize output dataframe
-    data = {
-        'ID': [],
-        'Dose': [],
-        'Slope': [],
-        'Number of Lambda Points': [],
-        'R2 Values': [],
-        'AUC_0-last': [],
-        'AUC_last-inf': [],
-        'AUC_0-inf': [],
-        'Half Life': [],
-        'Apparent Clearance': []
-    }
-    
-    # Initialize unqualified id list
-    unqualified_id = []
-    
-    # Extract each id data to handle
-    for id, df_id in _iter_profiles(df):
-        
-        # Skip if is has less than 3 points 
-        if df_id.shape[0] < MIN_TIME_POINTS:
-            unqualified_id.append(id)
-            continue  
-        
-        # Calculate AUC 0-last
-        auc_0_last = np.trapz(y=df_id['Conc'], x=df_id['Time'])
-        
-        # Find optimal number of lambda points
-        r2_list = []
-        slope_list = []
-        
-        # Try different number of lamdapoints
-        for n_points in range(MIN_TIME_POINTS, df_id.shape[0] + 1):
-            # Extract df
-            df_id_point = df_id.iloc[-n_points:, :] 
-            
-            # Run regression
-            X_points = df_id_point[['Time']]
-            Y_points = np.log(df_id_point['Conc'] + EPSILON).values.reshape(-1, 1)
-            
-            
-            model = LinearRegression()
-            model.fit(X_points, Y_points)
-            
-            # Evaluate regression
-            prediction = model.predict(X_points)
-            r2 = r2_score(y_true=Y_points, y_pred=prediction)
-            r2_list.append(r2)
-            slope_list.append(model.coef_.item())
-        
-        # Skip if r2_list is empty
-        if not r2_list:
-            unqualified_id.append(id)
-            continue  
-        
-        # Select optimal lambda points and the corresponding slopes
-        r2_max_index = np.argmax(r2_list)
-        slope = slope_list[r2_max_index]
-        
-        # Determine PK parameters
-        auc_last_inf = -df_id['Conc'].iloc[-1] / slope
-        dose = df_id['Dose'].unique()[0]
-        auc_0_inf = auc_0_last + auc_last_inf
-        apparent_CL = dose / auc_0_inf
-        half_life = -np.log(2) / slope
-        
-        # Add to initial dataframe
-        data['ID'].append(id)
-        data['Dose'].append(dose)
-        data['Slope'].append(-slope)
-        data['Number of Lambda Points'].append(r2_max_index + MIN_TIME_POINTS)
-        data['R2 Values'].append(r2_list[r2_max_index])
-        data['AUC_0-last'].append(auc_0_last)
-        data['AUC_last-inf'].append(auc_last_inf)
-        data['AUC_0-inf'].append(auc_0_inf)
-        data['Half Life'].append(half_life)
-        data['Apparent Clearance'].append(apparent_CL)
+    # Sort the whole dataset once and analyse every qualified individual together
+    profiles, unqualified_id = _sorted_profiles(df)
+    nca = _segment_nca(profiles, auc_method)
 
+    # Determine PK parameters
+    slope = nca['slope']
+    auc_last_inf = -nca['clast'] / slope
+    auc_0_inf = nca['auc_0_last'] + auc_last_inf
+    clearance = nca['dose'] / auc_0_inf
+    
     # Create DataFrame
-    df_analysis = pd.DataFrame(data)
+    df_analysis = pd.DataFrame({
+        'ID': profiles.ids,
+        'Dose': nca['dose'],
+        'Slope': -slope,
+        'Intercept': nca['intercept'],
+        'Number of Lambda Points': nca['n_lambda_points'],
+        'R2 Values': nca['r2'],
+        'AUC_0-last': nca['auc_0_last'],
+        'AUC_last-inf': auc_last_inf,
+        'AUC_0-inf': auc_0_inf,
+        'Half Life': -np.log(2) / slope,
+        'Apparent Clearance': clearance
+    })
+
+    if extended:
+        # Extrapolate the first moment with the terminal slope: Clast * Tlast / lambda + Clast / lambda^2
+        lambda_z = -slope
+        aumc_0_inf = nca['aumc_0_last'] + nca['clast'] * nca['tlast'] / lambda_z + nca['clast'] / lambda_z ** 2
+        mrt = aumc_0_inf / auc_0_inf
+        df_analysis = df_analysis.assign(**{
+            'Cmax': nca['cmax'],
+            'Tmax': nca['tmax'],
+            'Clast': nca['clast'],
+            'Tlast': nca['tlast'],
+            'AUMC_0-last': nca['aumc_0_last'],
+            'AUMC_0-inf': aumc_0_inf,
+            'MRT': mrt,
+            'Vz': clearance / lambda_z,
+            'Vss': clearance * mrt,
+            '%AUC Extrapolated': 100 * auc_last_inf / auc_0_inf,
+        })
     return df_analysis, unqualified_id
 
 
-def non_compartmental_plots(df_whole_profile,df_lambda_profile):
-    '''This function helps to visualized the choice of lambda points and the regression line on individual profile.
-    
+def _dosing_intervals(profiles, tau, start=0.0, n_doses=None):
+    """Split the profile of every subject by dosing interval, duplicating the samples taken at a dose time.
+
+    Returns the interval profiles (one segment per subject and interval), and the subject index and interval number of each segment.
+    """
+    subject = np.repeat(np.arange(profiles.counts.size), profiles.counts)
+    position = (profiles.time - start) / tau
+    interval = np.floor(position + 1e-9).astype(np.int64)
+
+    # A sample taken at a dose time closes the previous interval and opens the next one
+    on_boundary = (np.abs(position - np.round(position)) < 1e-9) & (interval > 0)
+    rows = np.concatenate([np.arange(profiles.time.size), np.flatnonzero(on_boundary)])
+    interval = np.concatenate([interval, interval[on_boundary] - 1])
+    keep = interval >= 0
+    if n_doses is not None:
+        keep &= interval < n_doses
+    rows, interval = rows[keep], interval[keep]
+
+    # Sort once by (subject, interval, time) and cut the segments where either key changes
+    order = np.lexsort((profiles.time[rows], interval, subject[rows]))
+    rows, interval, subject = rows[order], interval[order], subject[rows[order]]
+    new_segment = np.ones(rows.size, dtype=bool)
+    new_segment[1:] = (subject[1:] != subject[:-1]) | (interval[1:] != interval[:-1])
+    starts = np.flatnonzero(new_segment)
+    intervals = _Profiles(
+        ids=profiles.ids[subject[starts]],
+        counts=np.diff(np.append(starts, rows.size)),
+        starts=starts,
+        time=profiles.time[rows],
+        conc=profiles.conc[rows],
+        dose=profiles.dose[rows],
+    )
+    return intervals, subject[starts], interval[starts]
+
+
+@profiled('analysis.multiple_dose_non_compartmental_analysis')
+def multiple_dose_non_compartmental_analysis(df, tau, start=0.0, n_doses=None, auc_method='linear'):
+    '''This function helps to analysis repeated-dose clinical trials using non-compartmental analysis on each dosing interval.
+    The profile of each individual is split into the intervals [start + k * tau, start + (k + 1) * tau], and a sample taken at a dose time
+    is used both as the last point of an interval and as the first point of the next one. The AUC of an interval only covers its samples,
+    so each interval should be sampled up to its end.
+
     Parameters:
-        df_whole_profile (PandasDataFrame): A dataframe containing whole profile of individuals.
-        df_lambda_profile (Pandas DataFrame): A dataframe containing only lambda points of individuals profiles.'''
-    
-    # Create base figure with whole profile
-    fig = px.scatter(df_whole_profile, x='Time', y='log_conc')
-    
-    # Create scatter plot with trendline for lambda points
-    trend_fig = px.scatter(df_lambda_profile, x='Time', y='log_conc', trendline='ols')
-    
-    # Extract the trendline data
-    trendline_data = trend_fig.data[1]  # The trendline is the second trace in the figure
-    
-    # Add lambda profile to the main figure
-    fig.add_trace(go.Scatter(x=df_lambda_profile['Time'], y=df_lambda_profile['log_conc'], mode='markers', marker=dict(color='red'), name='Lambda Points',showlegend=False))
-    
-    # Add the trendline to the main figure
-    fig.add_trace(trendline_data)
+        df (PandasDataFrame or PKDataset): A data frame that stores information of the clinical trials. The columns should be renamed as "ID","Dose","Time", and "Conc".
+        The additional columns is acceptable.
+        tau (float): Dosing interval.
+        start (float): Time of the first dose.
+        n_doses (int): Number of doses. Samples after the last interval (e.g. a washout) are ignored. None keeps every interval.
+        auc_method (str): 'linear' or 'linear-up/log-down', as in non_compartmental_analysis.
+
+    Returns:
+        df_analysis (PandasDataFrame): A data frame with one row per individual and interval, including:
+            - ID
+            - Interval (1 for the first dose)
+            - Dose
+            - Start Time
+            - Number of Points
+            - AUC_tau
+            - Cmax (Cmax,ss at steady state)
+            - Tmax (from the start of the interval)
+            - Cmin (Cmin,ss at steady state)
+            - Cavg
+            - Fluctuation (%): 100 * (Cmax - Cmin) / Cavg
+            - Accumulation Ratio: AUC_tau of the interval over AUC_tau of the first analysed interval of the individual
+
+        unqualified_id (list): A list of unqualified individuals, which have no interval with at least 2 data points.'''
+
+    if tau <= 0:
+        raise ValueError('tau must be positive.')
+
+    # Sort the whole dataset once, then split it by subject and interval in one pass
+    profiles, unqualified_id = _sorted_profiles(df, min_points=1)
+    intervals, subject, interval = _dosing_intervals(profiles, tau, start, n_doses)
+    qualified = intervals.counts >= 2
+    intervals, subject, interval = _subset_profiles(intervals, qualified), subject[qualified], interval[qualified]
+    unqualified_id = unqualified_id + profiles.ids[np.setdiff1d(np.arange(profiles.ids.size), subject)].tolist()
+
+    # Exposure of every interval
+    auc_tau, _ = _segment_trapezoids(intervals, auc_method)
+    cmax, first_max, cmin = _segment_extremes(intervals)
+    cavg = auc_tau / tau
+    interval_start = start + interval * tau
+
+    # Accumulation against the first analysed interval of each subject
+    first = np.ones(subject.size, dtype=bool)
+    first[1:] = subject[1:] != subject[:-1]
+    first_auc = auc_tau[first][np.cumsum(first) - 1]
+
+    df_analysis = pd.DataFrame({
+        'ID': intervals.ids,
+        'Interval': interval + 1,
+        'Dose': intervals.dose[intervals.starts],
+        'Start Time': interval_start,
+        'Number of Points': intervals.counts,
+        'AUC_tau': auc_tau,
+        'Cmax': cmax,
+        'Tmax': intervals.time[first_max] - interval_start,
+        'Cmin': cmin,
+        'Cavg': cavg,
+        'Fluctuation (%)': 100 * (cmax - cmin) / cavg,
+        'Accumulation Ratio': auc_tau / first_auc,
+    })
+    return df_analysis, unqualified_id
 
-    # Modify the axis label
-    fig.update_layout(title=f"ID {df_whole_profile['ID'].unique()}", xaxis_title='Time', yaxis_title='Log Concentration')
-    
-    # Display the figure
-    config_nca = {
-        'toImageButtonOptions': {
-        'format': 'png', 
-        'filename': 'nca_analysis',
-        'height': None,
-        'width': None,
-        'scale': 5 }}
-    st.plotly_chart(fig,config = config_nca)
 
+def _terminal_regression_points(time, conc, n_lambda_points, slope, intercept):
+    """Points of one subject for the plot of its terminal regression: the log concentrations on the scale of the regression
+    (zero concentrations included), the first lambda point, and the two ends of the regression line."""
+    log_conc = np.log(conc + EPSILON)
+    lambda_start = max(time.size - int(n_lambda_points), 0)
+    line_time = time[[lambda_start, -1]]
+    return log_conc, lambda_start, line_time, intercept - slope * line_time
 
+
+@profiled('analysis.non_compartmental_batch_plots')
+def non_compartmental_batch_plots(df, df_analysis, page=0, page_size=20, n_cols=2):
+    '''This function helps to visualized the lambda points and the regression line of many individuals in one figure.
+    The dataset is sorted and indexed once, the regression lines are drawn from the slope and intercept of the analysis results,
+    and every individual is a WebGL small multiple, so a page of individuals renders as a single figure.
+
+    Parameters:
+        df (PandasDataFrame): A data frame that stores information of the clinical trials, with the columns "ID", "Dose", "Time", and "Conc".
+        df_analysis (PandasDataFrame): The results of non_compartmental_analysis, with the columns "ID", "Slope", "Intercept" and "Number of Lambda Points".
+        page (int): Index of the page to draw, starting from 0.
+        page_size (int): Number of individuals per page.
+        n_cols (int): Number of columns of the grid.
+
+    Returns:
+        fig (PlotlyFigure): The figure of the individuals on the page.'''
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+
+    # Locate the rows of the individuals on the page in the sorted dataset
+    profiles, _ = _sorted_profiles(df, min_points=1)
+    page_df = df_analysis.iloc[page * page_size:(page + 1) * page_size]
+    segment = pd.Index(profiles.ids).get_indexer(page_df['ID'])
+    n_rows = max(-(-len(page_df) // n_cols), 1)
+    fig = make_subplots(rows=n_rows, cols=n_cols, subplot_titles=[f'ID {id}' for id in page_df['ID']],
+                        vertical_spacing=min(0.3 / n_rows, 0.08), horizontal_spacing=0.08)
+
+    for position, (index, slope, intercept, lambda_points) in enumerate(zip(
+            segment, page_df['Slope'], page_df['Intercept'], page_df['Number of Lambda Points'])):
+        if index < 0:
+            continue
+        start, end = profiles.starts[index], profiles.starts[index] + profiles.counts[index]
+        time = profiles.time[start:end]
+        log_conc, lambda_start, line_time, line_log_conc = _terminal_regression_points(
+            time, profiles.conc[start:end], lambda_points, slope, intercept)
+        row, col = position // n_cols + 1, position % n_cols + 1
+        fig.add_trace(go.Scattergl(x=time, y=log_conc, mode='markers', marker=dict(color='#636EFA'), showlegend=False), row=row, col=col)
+        fig.add_trace(go.Scattergl(x=time[lambda_start:], y=log_conc[lambda_start:], mode='markers', marker=dict(color='red'), showlegend=False), row=row, col=col)
+        fig.add_trace(go.Scattergl(x=line_time, y=line_log_conc, mode='lines', line=dict(color='red'), showlegend=False), row=row, col=col)
+
+    fig.update_xaxes(title_text='Time')
+    fig.update_yaxes(title_text='Log Concentration')
+    fig.update_layout(height=300 * n_rows, margin=dict(t=40))
+    return fig
+
+
+@profiled('analysis.one_compartmental_iv_analysis')
 def one_compartmental_iv_analysis(df):
     '''This function helps to analysis the clinical trials results for iv drug using one-compartmental model.
     The analysis is conducted using linear regression of the function: ln(C) = ln(C0) - ke*t.
     
     Parameters: 
-        df (PandasDataFrame): A data frame that stores information of the clinical trials. The columns should be renamed as "ID","Dose","Time", and "Conc".
+        df (PandasDataFrame or PKDataset): A data frame that stores information of the clinical trials. The columns should be renamed as "ID","Dose","Time", and "Conc".
         The additional columns is acceptable. 
         
     Returns: 
@@ -183,72 +694,33 @@ def one_compartmental_iv_analysis(df):
         
         unqualified_id (list): A list of unqualified individuals that cannot do the analysis.'''
     
-    # Initialize output dataframe
-    iv_analysis_results = {'ID': [],
-                               'Dose':[],
-                               'C0': [],
-                               'ke':[],
-                               'R2':[],
-                               'RMSE':[],
-                               'AUC_0-inf':[],
-                               'Half life': [],
-                               'Apparent CL':[],
-                               'Apparent Vd':[]}
-    # Initialize unqualified id list
-    unqualified_id = []
-
-    # Extract each id data to handle
-    for id, df_id in _iter_profiles(df):
-
-        # Skip if id has less than 3 datapoints   
-        if df_id.shape[0] < MIN_TIME_POINTS:
-            unqualified_id.append(id)
-            continue 
-        
-        # Linear Regression 
-        else:
-            Y = np.log(df_id['Conc'] + EPSILON).values.reshape(-1, 1)
-            X = df_id['Time'].values.reshape(-1, 1)
-            model = LinearRegression()
-            model.fit(X,Y)
-            prediction = model.predict(X)
-            exp_prediction = np.exp(prediction)
-            exp_Y = np.exp(Y)
-            slope = -model.coef_.item()
-            c0 = np.exp(model.intercept_.item())
-            dose = df_id['Dose'].unique()[0]
-
-            # Store the primary data
-            iv_analysis_results['ID'].append(id)
-            iv_analysis_results['R2'].append(r2_score(y_true=exp_Y, y_pred=exp_prediction))
-            iv_analysis_results['RMSE'].append(root_mean_squared_error(y_true=exp_Y, y_pred=exp_prediction))
-            iv_analysis_results['ke'].append(slope)
-            iv_analysis_results['C0'].append(c0)
-            iv_analysis_results['Dose'].append(dose)
-            iv_analysis_results['Apparent Vd'].append(dose / c0)
-            iv_analysis_results['Apparent CL'].append(slope * dose / c0)
-            iv_analysis_results['AUC_0-inf'].append(c0 / slope)
-            iv_analysis_results['Half life'].append(np.log(2) / slope)
-
-                
-        
-    iv_analysis_df = pd.DataFrame(iv_analysis_results)
+    # Sort the whole dataset once and fit every qualified individual together
+    profiles, unqualified_id = _sorted_profiles(df)
+    iv_analysis_df = pd.DataFrame({'ID': profiles.ids, **_log_linear_table(profiles)})
         
     return iv_analysis_df, unqualified_id
 
 
-def one_compartmental_im_analysis(df, predefined_F, initial_ka, initial_ke, initial_Vd):
+@profiled('analysis.one_compartmental_im_analysis')
+def one_compartmental_im_analysis(df, predefined_F, initial_ka=None, initial_ke=None, initial_Vd=None, n_jobs=None, solver='curve_fit',
+                                  progress=None):
     '''This function helps to analysis the clinical trials results for non-iv drug using one-compartmental model.
-    The analysis is conducted using non-linear regression, therefore, it requires the initial guess of parameters.
+    The analysis is conducted using non-linear regression with the analytic Jacobian of the model. The initial guesses of each individual
+    are derived from its own non-compartmental analysis, and the user-defined initial guesses are only used as a second attempt.
     
     Parameters: 
-        df (PandasDataFrame): A data frame that stores information of the clinical trials. The columns should be renamed as "ID","Dose","Time", and "Conc".
+        df (PandasDataFrame or PKDataset): A data frame that stores information of the clinical trials. The columns should be renamed as "ID","Dose","Time", and "Conc".
         The additional columns is acceptable. 
 
-        predefined_F (float): Initial guess of bioavailability.
-        predefined_ka (float): Initial guess of ka.
-        predefined_ke (float): Initial guess of ke.
-        predefined_Vd (float): Initial guess of Vd.
+        predefined_F (float): Bioavailability of the drug.
+        initial_ka (float): Fallback initial guess of ka.
+        initial_ke (float): Fallback initial guess of ke.
+        initial_Vd (float): Fallback initial guess of Vd.
+        n_jobs (int): Number of worker processes used to fit the individuals. None uses all CPUs, 1 fits in the current process.
+        solver (str): 'curve_fit' fits each individual separately. 'batch' fits all individuals at once with vectorized
+        Levenberg-Marquardt steps, and only the individuals that do not converge are refitted separately.
+        progress (callable): Called as progress(done, total) each time a chunk of individuals is fitted, e.g. by a background job.
+        An exception raised by it stops the analysis.
         
     Returns: 
         df_analysis (PandasDataFrame): A data frame that stores the analysis results, including: 
@@ -265,71 +737,123 @@ def one_compartmental_im_analysis(df, predefined_F, initial_ka, initial_ke, init
             - Clearance
 
         
-        unqualified_id (list): A list of unqualified individuals that cannot do the analysis.'''
+        unqualified_id (list): A list of unqualified individuals that cannot do the analysis, either because they have too few data points or because the fit did not converge.'''
     
-    # Initialize output dataframe
-    im_analysis_results = {'ID': [],
-                               'Dose':[],
-                               'ka': [],
-                               'ke':[],
-                               'Vd':[],
-                               'RMSE':[],
-                               'Tmax':[],
-                               'Cmax': [],
-                               'Half life':[],
-                               'AUC_0-inf':[],
-                               'Clearance':[]}
-        
-    # Initialized unqualified id list
-    unqualified_id = []
-
-    # Extract each id data to handle
-    for id, df_id in _iter_profiles(df):
-            
-        # Skip if id has less than 3 datapoints
-        if df_id.shape[0] < MIN_TIME_POINTS:
-            unqualified_id.append(id)
-            continue 
-
-        # Non-linear regression
+    # Sort the whole dataset once, then warm-start every individual from its NCA estimates
+    profiles, unqualified_id = _sorted_profiles(df)
+    nca_guesses = _bateman_initial_guesses(_segment_nca(profiles), predefined_F)
+    user_guess = None
+    if None not in (initial_ka, initial_ke, initial_Vd):
+        user_guess = (initial_ka, initial_ke, initial_Vd)
+
+    # Fit all individuals at once, keeping the ones that do not converge for the individual fits
+    fitted = [None] * profiles.ids.size
+    pending = np.arange(profiles.ids.size)
+    if solver == 'batch':
+        params, converged, rmse = _batch_fit(profiles, _absorption_model, nca_guesses, predefined_F)
+        for i in np.flatnonzero(converged):
+            fitted[i] = (*params[i], rmse[i])
+        pending = np.flatnonzero(~converged)
+    elif solver != 'curve_fit':
+        raise ValueError(f"Unknown solver '{solver}'. Use 'curve_fit' or 'batch'.")
+
+    # Fit the individuals in chunks, in parallel when there are enough of them
+    tasks = [
+        (profiles.time[start:start + size], profiles.conc[start:start + size], dose, guess)
+        for start, size, dose, guess in zip(
+            profiles.starts[pending], profiles.counts[pending], profiles.dose[profiles.starts][pending], nca_guesses[pending]
+        )
+    ]
+    n_workers = n_jobs or os.cpu_count() or 1
+    if progress is not None:
+        progress(0, len(tasks))
+    if n_workers == 1 or len(tasks) < PARALLEL_MIN_SUBJECTS:
+        if progress is None:
+            pending_results = _fit_bateman_chunk(tasks, predefined_F, user_guess)
         else:
-            dose = df_id['Dose'].unique()[0]
-
-            def model(t, ka, ke, V):
-                F = predefined_F
-                return (F * dose * ka / (V * (ka - ke))) * (np.exp(-ke * t) - np.exp(-ka * t))
-
-            initial_guesses = [initial_ka, initial_ke, initial_Vd]
-            Y = df_id['Conc'].values
-            X = df_id['Time'].values
-            params, _ = curve_fit(model, X, Y, p0=initial_guesses)
-            ka_est, ke_est, V_est = params
-                
-            prediction = model(X, ka_est, ke_est, V_est)
-            RMSE = root_mean_squared_error(Y,prediction)
-
-            integral, _ = quad(model, 0, np.inf, args=(ka_est, ke_est, V_est))
-
-            # Store the primary data
-            im_analysis_results['ID'].append(id)
-            im_analysis_results['Dose'].append(dose)
-            im_analysis_results['ka'].append(ka_est)
-            im_analysis_results['ke'].append(ke_est)
-            im_analysis_results['Vd'].append(V_est)
-            im_analysis_results['RMSE'].append(RMSE)
-            tmax = np.log(ke_est/ka_est)/(ke_est-ka_est)
-            im_analysis_results['Tmax'].append(tmax)
-            im_analysis_results['Cmax'].append(model(t=tmax, ka=ka_est, ke=ke_est, V=V_est))
-            im_analysis_results['AUC_0-inf'].append(integral)
-            im_analysis_results['Clearance'].append(dose/integral) 
-            if ka_est > ke_est:
-                im_analysis_results['Half life'].append(np.log(2)/ke_est)
-            elif ka_est < ke_est:
-                im_analysis_results['Half life'].append(np.log(2)/ka_est)
-
-
-                
-        
-    im_analysis_df = pd.DataFrame(im_analysis_results)
+            pending_results = []
+            for start in range(0, len(tasks), PROGRESS_CHUNK_SUBJECTS):
+                pending_results += _fit_bateman_chunk(tasks[start:start + PROGRESS_CHUNK_SUBJECTS], predefined_F, user_guess)
+                progress(len(pending_results), len(tasks))
+    else:
+        n_chunks = n_workers * 4
+        chunks = [tasks[i::n_chunks] for i in range(n_chunks)]
+        with _process_pool(n_workers) as executor:
+            futures = [executor.submit(_fit_bateman_chunk, chunk, predefined_F, user_guess) for chunk in chunks]
+            try:
+                done = 0
+                for future in as_completed(futures):
+                    done += len(future.result())
+                    if progress is not None:
+                        progress(done, len(tasks))
+            except BaseException:
+                # Do not start the remaining chunks when the analysis is stopped
+                for future in futures:
+                    future.cancel()
+                raise
+        # Undo the round-robin split
+        pending_results = [None] * len(tasks)
+        for i, future in enumerate(futures):
+            pending_results[i::n_chunks] = future.result()
+    for i, result in zip(pending, pending_results):
+        fitted[i] = result
+
+    # Individuals whose fit failed are reported with the unqualified ones
+    converged = np.array([result is not None for result in fitted], dtype=bool)
+    unqualified_id = unqualified_id + profiles.ids[~converged].tolist()
+    params = np.array([result for result in fitted if result is not None]).reshape(-1, 4)
+    ka_est, ke_est, V_est, RMSE = params.T
+    dose = profiles.dose[profiles.starts][converged]
+
+    # Secondary parameters in closed form
+    im_analysis_df = pd.DataFrame({'ID': profiles.ids[converged], **_bateman_table(ka_est, ke_est, V_est, RMSE, predefined_F, dose)})
         
     return im_analysis_df, unqualified_id
+
+
+@profiled('analysis.one_compartmental_batch_fit')
+def one_compartmental_batch_fit(df, model='absorption', predefined_F=1.0, max_iter=200):
+    '''This function helps to fit the one-compartmental model to all individuals of the clinical trials at once.
+    The individual profiles are stacked into (individuals x samples) arrays and solved together with vectorized Levenberg-Marquardt
+    steps on the log of the parameters, starting from each individual's non-compartmental estimates. It is meant for very large datasets,
+    where fitting the individuals one by one is dominated by the overhead of each optimizer call.
+
+    Parameters:
+        df (PandasDataFrame or PKDataset): A data frame that stores information of the clinical trials. The columns should be renamed as "ID","Dose","Time", and "Conc".
+        The additional columns is acceptable.
+        model (str): 'iv' for C = F * Dose / Vd * exp(-ke * t), or 'absorption' for the first-order absorption model.
+        predefined_F (float): Bioavailability of the drug.
+        max_iter (int): Maximum number of Levenberg-Marquardt iterations.
+
+    Returns:
+        df_analysis (PandasDataFrame): A data frame that stores the analysis results, including:
+            - ID
+            - Dose
+            - ka (absorption model only)
+            - ke
+            - Vd
+            - RMSE
+
+        unqualified_id (list): A list of unqualified individuals that have too few data points or whose fit did not converge.'''
+
+    profiles, unqualified_id = _sorted_profiles(df)
+    nca = _segment_nca(profiles)
+    if model == 'absorption':
+        model_function, names = _absorption_model, ['ka', 'ke', 'Vd']
+        initial_params = _bateman_initial_guesses(nca, predefined_F)
+    elif model == 'iv':
+        # Terminal slope and back-extrapolated C0 of the NCA regression
+        model_function, names = _iv_bolus_model, ['ke', 'Vd']
+        ke = np.abs(nca['slope'])
+        initial_params = np.column_stack([np.where(ke > 0, ke, 0.1), predefined_F * nca['dose'] / np.exp(nca['intercept'])])
+    else:
+        raise ValueError(f"Unknown model '{model}'. Use 'iv' or 'absorption'.")
+
+    params, converged, rmse = _batch_fit(profiles, model_function, initial_params, predefined_F, max_iter)
+    unqualified_id = unqualified_id + profiles.ids[~converged].tolist()
+
+    df_analysis = pd.DataFrame({'ID': profiles.ids[converged], 'Dose': nca['dose'][converged]})
+    for name, values in zip(names, params[converged].T):
+        df_analysis[name] = values
+    df_analysis['RMSE'] = rmse[converged]
+    return df_analysis, unqualified_id
@@ -0,0 +1,176 @@
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from pkpd_sian.analysis import (
+    EPSILON,
+    _absorption_model,
+    _bateman,
+    _bateman_table,
+    _batch_fit,
+    _log_linear_table,
+    _process_pool,
+    _sorted_profiles,
+    _subset_profiles,
+    non_compartmental_analysis,
+    one_compartmental_im_analysis,
+    one_compartmental_iv_analysis,
+)
+
+
+# Number of replicates resampled together; the random stream of each chunk only depends on the seed and the chunk number
+BOOTSTRAP_CHUNK = 100
+# Subject resampling is only spread over processes above this many resampled values (replicates x subjects)
+PARALLEL_MIN_RESAMPLES = 5_000_000
+
+_STATISTICS = {
+    'mean': lambda values: np.nanmean(values, axis=1),
+    'median': lambda values: np.nanmedian(values, axis=1),
+    'geometric mean': lambda values: np.exp(np.nanmean(np.log(values), axis=1)),
+}
+
+
+def _apply_statistic(values, statistic):
+    """Summarise a (replicates x subjects x parameters) array over the subjects, ignoring failed fits."""
+    with warnings.catch_warnings(), np.errstate(all='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return _STATISTICS[statistic](values)
+
+
+def _refit_table(analysis, pseudo, params, F, columns):
+    """Refit the pseudo-individuals, returning the requested columns as a (pseudo-individuals x parameters) array."""
+    if analysis == 'iv':
+        table = _log_linear_table(pseudo)
+    else:
+        fitted, converged, rmse = _batch_fit(pseudo, _absorption_model, params, F)
+        fitted[~converged] = np.nan
+        table = _bateman_table(*fitted.T, np.where(converged, rmse, np.nan), F, pseudo.dose[pseudo.starts])
+    return np.column_stack([table[column] for column in columns])
+
+
+def _replicate_chunk(task):
+    """Statistics of one chunk of bootstrap replicates, shape (replicates x parameters)."""
+    values, n_replicates, seed, statistic, residual_fit = task
+    rng = np.random.default_rng(seed)
+    n_subjects = values.shape[0]
+    indices = rng.integers(0, n_subjects, size=(n_replicates, n_subjects))
+    if residual_fit is None:
+        # The per-individual results are precomputed, so resampling the subjects is a single indexing operation
+        return _apply_statistic(values[indices], statistic)
+
+    # Stack the resampled individuals of every replicate into one set of pseudo-profiles
+    analysis, profiles, prediction, residuals, params, F, columns = residual_fit
+    selected = indices.ravel()
+    pseudo = _subset_profiles(profiles._replace(conc=prediction), selected)
+    pool = _subset_profiles(profiles._replace(conc=residuals), selected).conc
+
+    # Draw the residuals of each pseudo-individual from its own residuals
+    counts = np.repeat(pseudo.counts, pseudo.counts)
+    draws = np.repeat(pseudo.starts, pseudo.counts) + (rng.random(counts.size) * counts).astype(np.int64)
+    if analysis == 'iv':
+        conc = np.exp(pseudo.conc + pool[draws]) - EPSILON
+    else:
+        conc = pseudo.conc + pool[draws]
+    table = _refit_table(analysis, pseudo._replace(conc=conc), None if params is None else params[selected], F, columns)
+    return _apply_statistic(table.reshape(n_replicates, n_subjects, -1), statistic)
+
+
+def _residual_fit(analysis, df, analysis_df, predefined_F, columns):
+    """Predictions and residuals of the original fit, for the individuals listed in the analysis table."""
+    profiles, _ = _sorted_profiles(df)
+    profiles = _subset_profiles(profiles, np.isin(profiles.ids, analysis_df['ID'].to_numpy()))
+    dose = profiles.dose
+    time = profiles.time
+
+    def per_row(column):
+        return np.repeat(analysis_df[column].to_numpy(dtype=float), profiles.counts)
+
+    if analysis == 'iv':
+        # The iv analysis is a log-linear regression, so its residuals live on the log scale
+        prediction = np.log(per_row('C0')) - per_row('ke') * time
+        residuals = np.log(profiles.conc + EPSILON) - prediction
+        params = None
+    else:
+        prediction = _bateman(time, per_row('ka'), per_row('ke'), per_row('Vd'), predefined_F, dose)
+        residuals = profiles.conc - prediction
+        params = analysis_df[['ka', 'ke', 'Vd']].to_numpy(dtype=float)
+    return (analysis, profiles, prediction, residuals, params, predefined_F, columns)
+
+
+def bootstrap_confidence_intervals(df, analysis='nca', n_bootstrap=1000, statistic='mean', confidence=0.95, residuals=False,
+                                   predefined_F=1.0, seed=None, n_jobs=None):
+    '''This function helps to estimate bootstrap confidence intervals of the population parameters from the clinical trials.
+    The analysis is run once on the original data. Each replicate then resamples the subjects with replacement and summarises the
+    per-subject results with the chosen statistic. With residuals=True, each resampled subject is also refitted after resampling its
+    own residuals around the fitted curve, which adds the uncertainty of the individual fits. The replicates are computed in chunks
+    and spread over processes.
+
+    Parameters:
+        df (PandasDataFrame or PKDataset): A data frame that stores information of the clinical trials. The columns should be renamed as "ID","Dose","Time", and "Conc".
+        analysis (str): 'nca' for non_compartmental_analysis, 'iv' for one_compartmental_iv_analysis or 'im' for one_compartmental_im_analysis.
+        n_bootstrap (int): Number of bootstrap replicates.
+        statistic (str): Population summary of the subject parameters, 'mean', 'median' or 'geometric mean'.
+        confidence (float): Confidence level of the percentile intervals.
+        residuals (bool): Also resample the residuals within each subject and refit it (only for 'iv' and 'im').
+        predefined_F (float): Bioavailability of the drug, used by the 'im' analysis.
+        seed (int): Seed of the random generator. The results do not depend on n_jobs.
+        n_jobs (int): Number of worker processes. None uses all CPUs, 1 computes in the current process.
+
+    Returns:
+        df_ci (PandasDataFrame): A data frame with one row per parameter, including:
+            - Parameter
+            - Estimate
+            - CI Lower
+            - CI Upper
+            - Standard Error
+
+        analysis_df (PandasDataFrame): The per-subject analysis results of the original data.'''
+
+    if statistic not in _STATISTICS:
+        raise ValueError(f"Unknown statistic '{statistic}'. Use one of {list(_STATISTICS)}.")
+    if analysis == 'nca':
+        if residuals:
+            raise ValueError('Residual resampling needs a fitted model, use the iv or im analysis.')
+        analysis_df = non_compartmental_analysis(df)[0]
+    elif analysis == 'iv':
+        analysis_df = one_compartmental_iv_analysis(df)[0]
+    elif analysis == 'im':
+        analysis_df = one_compartmental_im_analysis(df, predefined_F, n_jobs=n_jobs)[0]
+    else:
+        raise ValueError(f"Unknown analysis '{analysis}'. Use 'nca', 'iv' or 'im'.")
+
+    # Per-subject results of the original data
+    columns = [column for column in analysis_df.columns
+               if column not in ('ID', 'Dose') and pd.api.types.is_numeric_dtype(analysis_df[column])]
+    values = analysis_df[columns].to_numpy(dtype=float)
+    residual_fit = _residual_fit(analysis, df, analysis_df, predefined_F, columns) if residuals else None
+
+    # Chunks of replicates with independent random streams
+    sizes = [min(BOOTSTRAP_CHUNK, n_bootstrap - start) for start in range(0, n_bootstrap, BOOTSTRAP_CHUNK)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(values, size, chunk_seed, statistic, residual_fit) for size, chunk_seed in zip(sizes, seeds)]
+    n_workers = min(n_jobs or os.cpu_count() or 1, len(tasks))
+    if n_workers <= 1 or (residual_fit is None and n_bootstrap * values.shape[0] < PARALLEL_MIN_RESAMPLES):
+        replicates = [_replicate_chunk(task) for task in tasks]
+    else:
+        with _process_pool(n_workers) as executor:
+            replicates = list(executor.map(_replicate_chunk, tasks))
+    replicates = np.concatenate(replicates).reshape(n_bootstrap, len(columns))
+
+    # Percentile intervals of the replicate statistics
+    alpha = (1 - confidence) / 2
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        lower, upper = np.nanquantile(replicates, [alpha, 1 - alpha], axis=0)
+        standard_error = np.nanstd(replicates, axis=0, ddof=1)
+    df_ci = pd.DataFrame({
+        'Parameter': columns,
+        'Estimate': _apply_statistic(values[None], statistic)[0],
+        'CI Lower': lower,
+        'CI Upper': upper,
+        'Standard Error': standard_error,
+    })
+
+    return df_ci, analysis_df
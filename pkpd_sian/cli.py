@@ -0,0 +1,320 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+# Patients simulated and appended to the output file at once by the population jobs
+SIMULATION_CHUNK_PATIENTS = 2_000
+MANIFEST_NAME = 'manifest.jsonl'
+
+# Defaults of the optional entries of the simulation parameters, which TOML cannot set to None
+_POPULATION_PK_DEFAULTS = {'Population ka': None, 'Omega ka': 0.0, 'C Limit': None, 'logit': False, 'Sigma Residual': 0.0}
+
+
+def load_spec(file):
+    '''This function helps to read a job specification from a JSON or a TOML file.
+
+    Parameters:
+        file (str or Path): The specification, with a "jobs" list and optionally "output_dir" and "workers".
+
+    Returns:
+        spec (dict): The specification.
+    '''
+    path = Path(file)
+    if path.suffix.lower() == '.toml':
+        try:
+            import tomllib
+        except ImportError as error:
+            raise ImportError('TOML specifications need Python 3.11 or later, use a JSON specification instead.') from error
+        with open(path, 'rb') as handle:
+            spec = tomllib.load(handle)
+    else:
+        with open(path, encoding='utf-8') as handle:
+            spec = json.load(handle)
+    if not isinstance(spec.get('jobs'), list) or not spec['jobs']:
+        raise ValueError(f'{path} has no "jobs" list.')
+    return spec
+
+
+def _append_csv(df, path, first):
+    """Write a chunk of a table, with the header only for the first chunk."""
+    df.to_csv(path, mode='w' if first else 'a', header=first, index=False)
+
+
+def _time_above(concentration, time, limit):
+    """Time of every profile (row) above the limit, with the crossings interpolated linearly within each time step."""
+    start, end = concentration[:, :-1], concentration[:, 1:]
+    high, low = np.maximum(start, end), np.minimum(start, end)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.where(high > low, np.clip((high - limit) / (high - low), 0.0, 1.0), (low > limit).astype(float))
+    return (fraction * np.diff(time)).sum(axis=1)
+
+
+def _load_dataset(job, base_dir):
+    """Read the dataset of an analysis job as a PKDataset."""
+    from pkpd_sian.preprocessing import PKDataset, apply_schema, read_trial_csv
+    from pkpd_sian.storage import open_study
+
+    path = base_dir / job['data']
+    if path.suffix.lower() == '.arrow':
+        return open_study(path).to_dataset()
+    schema = job.get('schema')
+    df = read_trial_csv(path, usecols=None if schema else 'inferred')
+    return PKDataset(apply_schema(df, schema))
+
+
+def _run_population_pk(job, output, base_dir, n_jobs):
+    """Simulate the population in chunks of patients, appending each chunk to the output file."""
+    from pkpd_sian.regimen import Regimen
+    from pkpd_sian.simulation import population_pk_simulation
+    from pkpd_sian.storage import simulation_to_long, write_study
+
+    parameters = {**_POPULATION_PK_DEFAULTS, **job['parameters']}
+    dose = parameters['Dose']
+    if isinstance(dose, dict):
+        dose = parameters['Dose'] = Regimen(**dose)
+    n_patients = parameters['Number of Patients']
+    file_format = job.get('format', 'csv')
+    path = output.with_suffix('.' + file_format)
+
+    # A regimen has no single dose, its rows are labelled with its hash and the manifest keeps the regimen under that label
+    details = {'patients': n_patients}
+    if isinstance(dose, Regimen):
+        label = f'regimen-{hash(dose) & 0xFFFFFFFFFFFFFFFF:016x}'
+        details['regimens'] = {label: dose.to_dict()}
+    else:
+        label = dose
+
+    chunks = []
+    for start in range(0, n_patients, SIMULATION_CHUNK_PATIENTS):
+        size = min(SIMULATION_CHUNK_PATIENTS, n_patients - start)
+        df_C, _ = population_pk_simulation({**parameters, 'Number of Patients': size}, plot=False)
+        long_df = simulation_to_long(df_C, label)
+        long_df['ID'] += start
+        if file_format == 'csv':
+            _append_csv(long_df, path, first=start == 0)
+        elif file_format == 'arrow':
+            chunks.append(long_df)
+        else:
+            raise ValueError(f"Unknown format '{file_format}'. Use 'csv' or 'arrow'.")
+    if chunks:
+        write_study(pd.concat(chunks, ignore_index=True), path)
+    return [path], details
+
+
+def _run_regimen_sweep(job, output, base_dir, n_jobs):
+    """Simulate every combination of dose, dosing interval and number of doses, appending the exposure of each interval group."""
+    from pkpd_sian.regimen import Regimen
+    from pkpd_sian.simulation import regimen_simulation
+
+    doses = np.atleast_1d(np.asarray(job['doses'], dtype=float))
+    step = job.get('step', 0.1)
+    limit = job.get('C Limit')
+    path = output.with_suffix('.csv')
+
+    first = True
+    for tau in np.atleast_1d(job['taus']):
+        for n_doses in np.atleast_1d(job['n_doses']):
+            # The one-compartment model is linear in the dose, so a unit regimen is simulated once and scaled
+            end = tau * n_doses
+            time = np.linspace(0, end, int(round(end / step)) + 1)
+            unit = Regimen.repeated(1.0, tau, int(n_doses), route=job.get('route', 'iv'), F=job.get('F', 1.0),
+                                    infusion_duration=job.get('infusion_duration'))
+            concentration = doses[:, None] * regimen_simulation(unit, time, job['ke'], job['Vd'], job.get('ka'))[None, :]
+            last = time >= end - tau
+            result = pd.DataFrame({
+                'Dose': doses,
+                'Tau': tau,
+                'Number of Doses': n_doses,
+                'Cmax': concentration.max(axis=1),
+                'Tmax': time[concentration.argmax(axis=1)],
+                'Cmin': concentration[:, last].min(axis=1),
+                'Cavg': np.trapezoid(concentration[:, last], time[last], axis=1) / tau,
+                'AUC': np.trapezoid(concentration, time, axis=1),
+            })
+            if limit is not None:
+                result['Time Above Limit'] = _time_above(concentration, time, limit)
+            _append_csv(result, path, first)
+            first = False
+    return [path], {}
+
+
+def _run_nca(job, output, base_dir, n_jobs):
+    from pkpd_sian.analysis import non_compartmental_analysis
+
+    df_analysis, unqualified_id = non_compartmental_analysis(_load_dataset(job, base_dir), extended=job.get('extended', True),
+                                                             auc_method=job.get('auc_method', 'linear'))
+    df_analysis.to_csv(output.with_suffix('.csv'), index=False)
+    return [output.with_suffix('.csv')], {'subjects': len(df_analysis), 'unqualified_id': unqualified_id}
+
+
+def _run_multiple_dose_nca(job, output, base_dir, n_jobs):
+    from pkpd_sian.analysis import multiple_dose_non_compartmental_analysis
+
+    df_analysis, unqualified_id = multiple_dose_non_compartmental_analysis(
+        _load_dataset(job, base_dir), job['tau'], start=job.get('start', 0.0), n_doses=job.get('n_doses'),
+        auc_method=job.get('auc_method', 'linear'))
+    df_analysis.to_csv(output.with_suffix('.csv'), index=False)
+    return [output.with_suffix('.csv')], {'intervals': len(df_analysis), 'unqualified_id': unqualified_id}
+
+
+def _run_iv_fit(job, output, base_dir, n_jobs):
+    from pkpd_sian.analysis import one_compartmental_iv_analysis
+
+    df_analysis, unqualified_id = one_compartmental_iv_analysis(_load_dataset(job, base_dir))
+    df_analysis.to_csv(output.with_suffix('.csv'), index=False)
+    return [output.with_suffix('.csv')], {'subjects': len(df_analysis), 'unqualified_id': unqualified_id}
+
+
+def _run_im_fit(job, output, base_dir, n_jobs):
+    from pkpd_sian.analysis import one_compartmental_im_analysis
+
+    df_analysis, unqualified_id = one_compartmental_im_analysis(
+        _load_dataset(job, base_dir), job.get('predefined_F', 1.0), initial_ka=job.get('initial_ka'), initial_ke=job.get('initial_ke'),
+        initial_Vd=job.get('initial_Vd'), n_jobs=n_jobs)
+    df_analysis.to_csv(output.with_suffix('.csv'), index=False)
+    return [output.with_suffix('.csv')], {'subjects': len(df_analysis), 'unqualified_id': unqualified_id}
+
+
+def _run_population_fit(job, output, base_dir, n_jobs):
+    from pkpd_sian.estimation import population_estimation
+
+    population_parameters, individual_df = population_estimation(
+        _load_dataset(job, base_dir), model=job.get('model', 'absorption'), predefined_F=job.get('predefined_F', 1.0),
+        n_exploration=job.get('n_exploration', 150), n_smoothing=job.get('n_smoothing', 100), seed=job.get('seed'))
+    parameters_path = output.parent / (output.name + '_population.json')
+    individuals_path = output.parent / (output.name + '_individuals.csv')
+    parameters_path.write_text(json.dumps({name: float(value) for name, value in population_parameters.items()}, indent=2))
+    individual_df.to_csv(individuals_path, index=False)
+    return [parameters_path, individuals_path], {'subjects': len(individual_df)}
+
+
+def _run_report(job, output, base_dir, n_jobs):
+    from pkpd_sian.report import generate_report
+
+    path = output.with_suffix('.html')
+    generate_report(_load_dataset(job, base_dir), path, analyses=tuple(job.get('analyses', ('nca', 'iv', 'im'))),
+                    predefined_F=job.get('predefined_F', 1.0), n_jobs=n_jobs, title=job.get('title', 'PK Analysis Report'))
+    return [path], {}
+
+
+JOB_RUNNERS = {
+    'population_pk': _run_population_pk,
+    'regimen_sweep': _run_regimen_sweep,
+    'nca': _run_nca,
+    'multiple_dose_nca': _run_multiple_dose_nca,
+    'iv_fit': _run_iv_fit,
+    'im_fit': _run_im_fit,
+    'population_fit': _run_population_fit,
+    'report': _run_report,
+}
+
+
+def run_job(job, output_dir, base_dir='.', n_jobs=None):
+    '''This function helps to run one job of a specification and write its results in the output directory.
+    Errors are caught and reported in the returned record, so one failing job does not stop a batch.
+
+    Parameters:
+        job (dict): The job, with a "type" among JOB_RUNNERS, a "name" and its options (e.g. "data" for the analyses).
+        output_dir (str or Path): The directory of the output files, which are named after the job.
+        base_dir (str or Path): The directory that relative data paths refer to.
+        n_jobs (int): Number of worker processes of the job itself, unless the job sets "n_jobs".
+
+    Returns:
+        record (dict): The name, type, status ('ok' or 'error'), duration in seconds, output files and details of the job.
+    '''
+    started = time.perf_counter()
+    record = {'name': job['name'], 'type': job['type']}
+    try:
+        if 'seed' in job:
+            np.random.seed(job['seed'])
+        outputs, details = JOB_RUNNERS[job['type']](job, Path(output_dir) / job['name'], Path(base_dir), job.get('n_jobs', n_jobs))
+        record.update(status='ok', outputs=[str(path) for path in outputs], **details)
+    except Exception as error:
+        record.update(status='error', error=f'{type(error).__name__}: {error}')
+    record['seconds'] = round(time.perf_counter() - started, 3)
+    return record
+
+
+def _named_jobs(jobs):
+    """Check the job types and give every job a unique name."""
+    named = []
+    for index, job in enumerate(jobs):
+        if job.get('type') not in JOB_RUNNERS:
+            raise ValueError(f"Job {index} has an unknown type {job.get('type')!r}. Use one of {list(JOB_RUNNERS)}.")
+        named.append({'name': f"{index:03d}_{job['type']}", **job})
+    names = [job['name'] for job in named]
+    duplicated = sorted({name for name in names if names.count(name) > 1})
+    if duplicated:
+        raise ValueError(f'Job names must be unique, found {duplicated} more than once.')
+    return named
+
+
+def run_spec(spec, output_dir, base_dir='.', workers=None, log=None):
+    '''This function helps to run every job of a specification, in parallel worker processes.
+    The outputs of each job are written by the worker as soon as they are computed, and a line is appended to the manifest
+    (manifest.jsonl in the output directory) whenever a job finishes.
+
+    Parameters:
+        spec (dict): The specification, e.g. from load_spec.
+        output_dir (str or Path): The directory of the output files and of the manifest.
+        base_dir (str or Path): The directory that relative data paths refer to.
+        workers (int): Number of jobs run at once. None uses all CPUs, 1 runs the jobs one after the other in the current process.
+        log (file-like): Where to print one progress line per finished job, e.g. sys.stderr.
+
+    Returns:
+        records (list): The record of each job (see run_job), in the order of the specification.
+    '''
+    jobs = _named_jobs(spec['jobs'])
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    n_workers = min(workers or os.cpu_count() or 1, len(jobs))
+    # Jobs running side by side keep to one process each unless they ask for more
+    job_n_jobs = None if n_workers == 1 else 1
+
+    records = {}
+    with open(output_dir / MANIFEST_NAME, 'w', encoding='utf-8') as manifest:
+        def finish(record):
+            records[record['name']] = record
+            manifest.write(json.dumps(record, default=str) + '\n')
+            manifest.flush()
+            if log is not None:
+                print(f"[{len(records)}/{len(jobs)}] {record['name']}: {record['status']} in {record['seconds']:.1f} s"
+                      + (f" ({record['error']})" if record['status'] == 'error' else ''), file=log, flush=True)
+
+        if n_workers == 1:
+            for job in jobs:
+                finish(run_job(job, output_dir, base_dir, job_n_jobs))
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = [executor.submit(run_job, job, output_dir, base_dir, job_n_jobs) for job in jobs]
+                for future in as_completed(futures):
+                    finish(future.result())
+    return [records[job['name']] for job in jobs]
+
+
+def main(argv=None):
+    '''Entry point of "python -m pkpd_sian".'''
+    parser = argparse.ArgumentParser(
+        prog='python -m pkpd_sian',
+        description='Run population simulations, regimen sweeps, NCA and model fits from a JSON or TOML job specification.')
+    parser.add_argument('spec', help='The job specification (.json or .toml).')
+    parser.add_argument('-o', '--output-dir', help='Directory of the results. Defaults to "output_dir" of the specification, '
+                                                   'or <spec name>_results next to it.')
+    parser.add_argument('-w', '--workers', type=int, help='Number of jobs run at once. Defaults to "workers" of the specification, '
+                                                          'or the number of CPUs.')
+    args = parser.parse_args(argv)
+
+    spec_path = Path(args.spec)
+    spec = load_spec(spec_path)
+    base_dir = spec_path.parent
+    output_dir = args.output_dir or base_dir / spec.get('output_dir', spec_path.stem + '_results')
+    records = run_spec(spec, output_dir, base_dir, workers=args.workers or spec.get('workers'), log=sys.stderr)
+    return 0 if all(record['status'] == 'ok' for record in records) else 1
@@ -0,0 +1,156 @@
+import numpy as np
+import pandas as pd
+
+from pkpd_sian.analysis import (
+    MIN_TIME_POINTS,
+    _bateman,
+    _bateman_initial_guesses,
+    _padded_profiles,
+    _segment_nca,
+    _sorted_profiles,
+    _subset_profiles,
+)
+
+
+# Parameters estimated by each model, named as in pkpd_sian.simulation.population_pk_simulation
+_MODEL_PARAMETERS = {
+    'iv': ['Clearance', 'Volume of Distribution'],
+    'absorption': ['Clearance', 'Volume of Distribution', 'ka'],
+}
+_OMEGA_NAMES = {'Clearance': 'Omega CL', 'Volume of Distribution': 'Omega V', 'ka': 'Omega ka'}
+_INDIVIDUAL_NAMES = {'Clearance': 'CL', 'Volume of Distribution': 'Vd', 'ka': 'ka'}
+# Starting typical values (CL, V, ka) when no individual has enough samples for an NCA
+_DEFAULT_TYPICAL_VALUES = np.array([1.0, 10.0, 1.0])
+
+
+def _predict(model, time, params, dose, F):
+    """Population model prediction for individual parameters (CL, V[, ka]) on padded (individuals x samples) times."""
+    CL, V = params[:, 0:1], params[:, 1:2]
+    ke = CL / V
+    if model == 'iv':
+        return F * dose / V * np.exp(-ke * time)
+    return _bateman(time, params[:, 2:3], ke, V, F, dose)
+
+
+def _initial_population(profiles, model, F):
+    """Log typical values from the medians of the NCA-based guesses of the richly sampled individuals."""
+    n_params = len(_MODEL_PARAMETERS[model])
+    rich = profiles.counts >= MIN_TIME_POINTS
+    if rich.any():
+        ka, ke, V = _bateman_initial_guesses(_segment_nca(_subset_profiles(profiles, rich)), F).T
+        guesses = np.column_stack([ke * V, V, ka])[:, :n_params]
+        guesses = guesses[np.all(np.isfinite(guesses) & (guesses > 0), axis=1)]
+        if guesses.size:
+            return np.log(np.median(guesses, axis=0))
+    return np.log(_DEFAULT_TYPICAL_VALUES[:n_params])
+
+
+def population_estimation(df, model='absorption', predefined_F=1.0, n_exploration=150, n_smoothing=100, n_chain_steps=2, seed=None):
+    '''This function helps to estimate the population PK parameters from the clinical trials results using nonlinear mixed-effects modelling.
+    The estimation uses the Stochastic Approximation Expectation-Maximization (SAEM) algorithm on the one-compartmental model, with
+    log-normal interindividual variability and an additive residual error, as in the population PK simulation. The individual parameters
+    of all individuals are sampled together by vectorized Metropolis-Hastings steps, so each iteration costs the same number of NumPy calls
+    whatever the number of individuals. Individuals with a single sample still contribute to the estimation.
+
+    Parameters:
+        df (PandasDataFrame): A data frame that stores information of the clinical trials. The columns should be renamed as "ID","Dose","Time", and "Conc".
+        The additional columns is acceptable.
+        model (str): 'iv' for the iv bolus model (CL, V), or 'absorption' for the first-order absorption model (CL, V, ka).
+        predefined_F (float): Bioavailability of the drug, which is not estimated.
+        n_exploration (int): Number of SAEM iterations with a step size of 1.
+        n_smoothing (int): Number of SAEM iterations with a decreasing step size, which average the estimates.
+        n_chain_steps (int): Number of Metropolis-Hastings sweeps per iteration and per kernel.
+        seed (int): Seed of the random number generator.
+
+    Returns:
+        population_parameters (dict): The estimated typical values, omegas (standard deviation of the log-normal distribution) and sigma,
+        named as the parameters of pkpd_sian.simulation.population_pk_simulation, e.g. 'Population Clearance', 'Omega CL', 'Sigma Residual'.
+        individual_df (PandasDataFrame): The empirical Bayes estimates of each individual (ID, CL, Vd, ka, ke), i.e. the mean of its
+        parameters over the smoothing iterations.
+    '''
+
+    if model not in _MODEL_PARAMETERS:
+        raise ValueError(f"Unknown model '{model}'. Use 'iv' or 'absorption'.")
+    rng = np.random.default_rng(seed)
+    names = _MODEL_PARAMETERS[model]
+    n_params = len(names)
+
+    # Every individual with at least one observation contributes
+    profiles, _ = _sorted_profiles(df, min_points=1)
+    time, conc, mask = _padded_profiles(profiles)
+    dose = profiles.dose[profiles.starts].astype(float)[:, None]
+    n_subjects, n_observations = profiles.ids.size, mask.sum()
+
+    def squared_residuals(phi):
+        with np.errstate(all='ignore'):
+            prediction = _predict(model, time, np.exp(phi), dose, predefined_F)
+            ssr = np.sum(np.where(mask, (conc - prediction) ** 2, 0.0), axis=1)
+        return np.where(np.isfinite(ssr), ssr, np.inf)
+
+    # Initial estimates: typical values from NCA, wide omegas, sigma from the spread of the data
+    mu = _initial_population(profiles, model, predefined_F)
+    omega2 = np.ones(n_params)
+    phi = mu + rng.normal(0.0, 1.0, (n_subjects, n_params)) * 0.1
+    ssr = squared_residuals(phi)
+    finite = np.isfinite(ssr)
+    sigma2 = np.sum(ssr[finite]) / max(mask[finite].sum(), 1) if finite.any() else np.var(conc[mask])
+    sigma2 = max(sigma2, 1e-12)
+    step_scale = np.full(n_params, 0.4)
+    statistics = [phi.mean(axis=0), (phi ** 2).mean(axis=0), sigma2]
+    phi_sum = np.zeros_like(phi)
+
+    for iteration in range(n_exploration + n_smoothing):
+        # Simulation step: Metropolis-Hastings sweeps for all individuals at once
+        def log_prior(values):
+            return -0.5 * np.sum((values - mu) ** 2 / omega2, axis=1)
+
+        for _ in range(n_chain_steps):
+            # Kernel 1: independent proposals from the population distribution
+            proposal = mu + rng.normal(0.0, 1.0, phi.shape) * np.sqrt(omega2)
+            proposal_ssr = squared_residuals(proposal)
+            accept = np.log(rng.uniform(size=n_subjects)) < (ssr - proposal_ssr) / (2 * sigma2)
+            phi[accept], ssr[accept] = proposal[accept], proposal_ssr[accept]
+
+        for component in range(n_params):
+            for _ in range(n_chain_steps):
+                # Kernel 2: random walk on one parameter at a time, with an adaptive step size
+                proposal = phi.copy()
+                proposal[:, component] += rng.normal(0.0, 1.0, n_subjects) * step_scale[component] * np.sqrt(omega2[component])
+                proposal_ssr = squared_residuals(proposal)
+                log_ratio = (ssr - proposal_ssr) / (2 * sigma2) + log_prior(proposal) - log_prior(phi)
+                accept = np.log(rng.uniform(size=n_subjects)) < log_ratio
+                phi[accept], ssr[accept] = proposal[accept], proposal_ssr[accept]
+                step_scale[component] *= 1 + 0.4 * (accept.mean() - 0.4)
+
+        # Stochastic approximation of the sufficient statistics
+        gamma = 1.0 if iteration < n_exploration else 1.0 / (iteration - n_exploration + 2)
+        finite = np.isfinite(ssr)
+        observed = (phi.mean(axis=0), (phi ** 2).mean(axis=0), np.sum(ssr[finite]) / max(mask[finite].sum(), 1))
+        statistics = [old + gamma * (new - old) for old, new in zip(statistics, observed)]
+
+        # Maximization step, with slow shrinkage of the variances while exploring (simulated annealing)
+        mu = statistics[0]
+        new_omega2 = np.maximum(statistics[1] - mu ** 2, 1e-8)
+        new_sigma2 = max(statistics[2], 1e-12)
+        if iteration < n_exploration:
+            new_omega2 = np.maximum(new_omega2, 0.95 * omega2)
+            new_sigma2 = max(new_sigma2, 0.95 * sigma2)
+        omega2, sigma2 = new_omega2, new_sigma2
+        if iteration >= n_exploration:
+            phi_sum += phi
+
+    population_parameters = {}
+    for name, value, variance in zip(names, np.exp(mu), omega2):
+        population_parameters[f'Population {name}'] = float(value)
+        population_parameters[_OMEGA_NAMES[name]] = float(np.sqrt(variance))
+    population_parameters['Population Bioavailability'] = predefined_F
+    population_parameters['Sigma Residual'] = float(np.sqrt(sigma2))
+    population_parameters['Number of Observations'] = int(n_observations)
+    population_parameters['Number of Patients'] = int(n_subjects)
+
+    individual_params = np.exp(phi_sum / max(n_smoothing, 1)) if n_smoothing else np.exp(phi)
+    individual_df = pd.DataFrame({'ID': profiles.ids})
+    for name, values in zip(names, individual_params.T):
+        individual_df[_INDIVIDUAL_NAMES[name]] = values
+    individual_df['ke'] = individual_df['CL'] / individual_df['Vd']
+    return population_parameters, individual_df
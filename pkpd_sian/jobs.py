@@ -0,0 +1,209 @@
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pkpd_sian.profiling import count
+
+
+# Jobs computed at once, over all the sessions of the app; the other ones wait for a free worker
+MAX_BACKGROUND_JOBS = 4
+# Seconds between two refreshes of the progress of a running job on a page
+PROGRESS_REFRESH = 0.5
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class JobCancelled(Exception):
+    """Raised in a job by its progress callback once it has been cancelled."""
+
+
+class Job:
+    '''A computation running in the background, with its progress, its result and its error (see JobManager.submit).
+
+    Attributes:
+        name (str): The name of the job in its manager.
+        status (str): 'pending', 'running', 'done', 'failed' or 'cancelled'.
+        done (int), total (int): Progress reported by the computation, e.g. fitted subjects out of all subjects.
+        result: Return value of the computation once done.
+        error (Exception): Exception raised by the computation once failed.
+        kwargs (dict): Keyword arguments of the computation, e.g. to display its result with its parameters.
+    '''
+
+    def __init__(self, name, kwargs):
+        self.name = name
+        self.kwargs = kwargs
+        self.status = 'pending'
+        self.done = 0
+        self.total = None
+        self.result = None
+        self.error = None
+        self.started = None
+        self.finished = None
+        self._cancelled = threading.Event()
+
+    @property
+    def running(self):
+        return self.status in ('pending', 'running')
+
+    @property
+    def fraction(self):
+        return min(self.done / self.total, 1.0) if self.total else 0.0
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.perf_counter()) - self.started
+
+    def progress(self, done, total):
+        '''This function helps to report the progress of the computation, which passes it as its progress callback.
+        It raises JobCancelled once the job is cancelled, to stop the computation at its next report.'''
+        self.done, self.total = done, total
+        if self._cancelled.is_set():
+            raise JobCancelled(f'The job {self.name} was cancelled.')
+
+    def cancel(self):
+        '''This function helps to stop the job at its next progress report, or before it starts.'''
+        self._cancelled.set()
+
+    def wait(self, timeout=None):
+        '''This function helps to wait until the job is finished, for at most timeout seconds; returns whether it is.'''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.running:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def _run(self, function, args):
+        """Run the computation in a worker thread and record how it ended."""
+        if self._cancelled.is_set():
+            self.status = 'cancelled'
+            return
+        self.started = time.perf_counter()
+        self.status = 'running'
+        try:
+            self.result = function(*args, progress=self.progress, **self.kwargs)
+            self.status = 'done'
+        except JobCancelled:
+            self.status = 'cancelled'
+        except Exception as error:
+            self.error = error
+            self.status = 'failed'
+        finally:
+            self.finished = time.perf_counter()
+            count(f'jobs.{self.status}')
+
+
+def process_workers():
+    '''This function helps to bound the worker processes a job starts, e.g. as the n_jobs of an analysis, so that MAX_BACKGROUND_JOBS
+    concurrent jobs together do not start more processes than there are CPUs.'''
+    return max((os.cpu_count() or 1) // MAX_BACKGROUND_JOBS, 1)
+
+
+def _shared_executor():
+    """Executor shared by every job manager, created on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_BACKGROUND_JOBS, thread_name_prefix='pkpd-job')
+        return _executor
+
+
+class JobManager:
+    '''The background jobs of one user session, one per name: submitting a job again cancels and replaces the previous one.
+    The jobs run in threads, so that the page keeps responding and its reruns do not interrupt them, and finished jobs keep
+    their result until they are replaced or cleared.'''
+
+    def __init__(self):
+        self._jobs = {}
+
+    def submit(self, name, function, *args, **kwargs):
+        '''This function helps to run a computation in the background.
+
+        Parameters:
+            name (str): The name of the job, e.g. 'im_analysis'.
+            function (callable): The computation. It is called with the given arguments and a progress keyword argument,
+            progress(done, total), which it calls regularly and which raises JobCancelled once the job is cancelled.
+            args, kwargs: The arguments of the computation.
+
+        Returns:
+            job (Job): The submitted job.
+        '''
+        previous = self._jobs.get(name)
+        if previous is not None:
+            previous.cancel()
+        job = Job(name, kwargs)
+        self._jobs[name] = job
+        # The job runs in the context of the submitting script run, e.g. to record into its session's profiling
+        context = contextvars.copy_context()
+        _shared_executor().submit(context.run, job._run, function, args)
+        return job
+
+    def get(self, name):
+        '''This function helps to get the last job submitted under the name, None if there is none.'''
+        return self._jobs.get(name)
+
+    def cancel(self, name):
+        job = self._jobs.get(name)
+        if job is not None:
+            job.cancel()
+
+    def clear(self, name):
+        '''This function helps to cancel the job and forget it with its result.'''
+        self.cancel(name)
+        self._jobs.pop(name, None)
+
+
+def session_jobs():
+    '''This function helps to get the job manager of the current Streamlit session, kept in its session state.'''
+    import streamlit as st
+
+    if 'job_manager' not in st.session_state:
+        st.session_state.job_manager = JobManager()
+    return st.session_state.job_manager
+
+
+def job_progress(name, label='Running', unit='subjects'):
+    '''This function helps to display a background job of the session on a page: a progress bar and a Cancel button while it runs,
+    refreshed every PROGRESS_REFRESH seconds without rerunning the page, then the error or the cancellation once it has ended.
+
+    Parameters:
+        name (str): The name of the job.
+        label (str): Description of the computation shown next to the progress.
+        unit (str): What the progress counts.
+
+    Returns:
+        job (Job): The job once it has finished successfully, with its result. None when it is missing, running, failed or cancelled.
+    '''
+    import streamlit as st
+
+    job = session_jobs().get(name)
+    if job is None:
+        return None
+
+    if job.running:
+        @st.fragment(run_every=PROGRESS_REFRESH)
+        def show_progress():
+            # Rerun the whole page once the job has ended, to display its result
+            if not job.running:
+                st.rerun()
+            total = '?' if job.total is None else job.total
+            st.progress(job.fraction, text=f'{label}: {job.done}/{total} {unit} ({job.elapsed:.0f} s)')
+            if st.button('Cancel', key=f'cancel_job_{name}'):
+                job.cancel()
+                st.rerun()
+
+        show_progress()
+        return None
+
+    if job.status == 'failed':
+        st.error(f'**{label} failed:** {type(job.error).__name__}: {job.error}')
+    elif job.status == 'cancelled':
+        st.warning(f'{label} was cancelled after {job.done} {unit}.')
+    else:
+        return job
+    return None
@@ -1,7 +1,174 @@
-import streamlit as st
+import re
+from collections import namedtuple
+from functools import lru_cache
+
 import pandas as pd 
 import numpy as np
-from thefuzz import process
+
+from pkpd_sian.profiling import count, profiled
+
+
+# Pharmacometric names of each unified column, after normalization (lower case, units and punctuation removed)
+COLUMN_SYNONYMS = {
+    'ID': ('id', 'subject', 'subject id', 'subj', 'subjid', 'usubjid', 'patient', 'patient id', 'pid', 'ptid', 'individual', 'animal'),
+    'Time': ('time', 't', 'tad', 'tafd', 'tsfd', 'time after dose', 'time after first dose', 'nominal time', 'actual time',
+             'elapsed time', 'hours', 'hour', 'hr', 'h', 'ntime', 'atime', 'nomtime'),
+    'Conc': ('conc', 'concentration', 'dv', 'cp', 'plasma concentration', 'plasma conc', 'serum concentration', 'serum conc',
+             'observation', 'obs', 'pcstresn', 'concentration value'),
+    'Dose': ('dose', 'amt', 'amount', 'dose amount', 'dosage', 'dose level', 'dose mg', 'exdose'),
+    'Age': ('age', 'age years', 'ageyr', 'age yr'),
+    'Weight': ('weight', 'wt', 'bw', 'wgt', 'body weight', 'bodyweight', 'weight kg'),
+    'Gender': ('gender', 'sex'),
+    'CLCR': ('clcr', 'crcl', 'creatinine clearance', 'clearance creatinine', 'cockcroft gault'),
+}
+MANDATORY_COLUMNS = ('ID', 'Time', 'Conc', 'Dose')
+# Checks of validate_dataset reported for information only, not as data issues
+INFORMATIONAL_CHECKS = ('Zero Conc',)
+
+_UNITS = re.compile(r'\([^)]*\)|\[[^\]]*\]')
+_SEPARATORS = re.compile(r'[^0-9a-z]+')
+_SYNONYM_LOOKUP = {synonym: role for role, synonyms in COLUMN_SYNONYMS.items() for synonym in synonyms}
+
+
+def _normalize_column(column):
+    """Lower case a column name and drop its units and punctuation, e.g. 'CONC (mg/L)' -> 'conc'."""
+    return _SEPARATORS.sub(' ', _UNITS.sub(' ', str(column).lower())).strip()
+
+
+def infer_schema(columns):
+    '''This function helps to guess which column of a dataset holds each unified column ("ID", "Time", "Conc", "Dose", "Age", "Weight", "Gender", "CLCR").
+    Each column name is normalized and looked up in COLUMN_SYNONYMS, first as a whole and then word by word. The mandatory columns that
+    are still missing fall back to fuzzy matching. The result is cached on the column names, so reruns do not redo the matching.
+
+    Parameters:
+        columns (tuple): The column names of the dataset.
+
+    Returns:
+        schema (dict): The column name assigned to each unified column, or None when no column matches.
+    '''
+    return dict(_infer_schema(tuple(columns)))
+
+
+@lru_cache(maxsize=128)
+@profiled('preprocessing.infer_schema')
+def _infer_schema(columns):
+    """Match the column names against the synonyms once per distinct tuple of column names."""
+    # Score each column: 2 for a whole-name synonym, 1 for a synonym word, and keep the first best column of each role
+    best = {}
+    for position, column in enumerate(columns):
+        name = _normalize_column(column)
+        if name in _SYNONYM_LOOKUP:
+            matches = [(_SYNONYM_LOOKUP[name], 2)]
+        else:
+            matches = [(_SYNONYM_LOOKUP[word], 1) for word in dict.fromkeys(name.split()) if word in _SYNONYM_LOOKUP]
+        for role, score in matches:
+            if role not in best or score > best[role][0]:
+                best[role] = (score, position)
+
+    # A column holds one role at most, the better score wins
+    schema = {role: None for role in COLUMN_SYNONYMS}
+    taken = set()
+    for role, (score, position) in sorted(best.items(), key=lambda item: (-item[1][0], item[1][1])):
+        if position not in taken:
+            schema[role] = columns[position]
+            taken.add(position)
+
+    # Fuzzy matching on the remaining columns, as the last resort for the mandatory columns
+    for role in MANDATORY_COLUMNS:
+        remaining = [column for position, column in enumerate(columns) if position not in taken]
+        if schema[role] is None and remaining:
+            from thefuzz import process
+            schema[role] = process.extractOne(role, remaining)[0]
+            taken.add(columns.index(schema[role]))
+    return schema
+
+
+# Missing value tokens of spreadsheet and NONMEM exports, on top of the pandas defaults ('#N/A', 'NA', 'NaN', ...)
+NA_VALUES = ['.', '#N/A', '#N/A N/A', '#NA', '#VALUE!', '#DIV/0!', 'N/A', 'n/a', 'NA', 'na', 'NaN', 'nan', 'NULL', 'null', '']
+CSV_CHUNK_ROWS = 500_000
+
+
+def _clean_column(column):
+    """Strip the byte order mark and the surrounding spaces of a column name."""
+    return str(column).lstrip('\ufeff').strip()
+
+
+def _downcast_frame(df, float_dtype=None):
+    """Downcast integer columns to int32 when their values fit, and float columns to float_dtype when it is given.
+    Integers stop at int32, so that the values edited later in the page's data editor cannot overflow a smaller type."""
+    int32 = np.iinfo(np.int32)
+    for column in df.columns:
+        values = df[column]
+        if values.dtype.kind in 'iu' and (values.empty or (values.min() >= int32.min and values.max() <= int32.max)):
+            df[column] = values.astype(np.int32)
+        elif values.dtype.kind == 'f' and float_dtype is not None:
+            df[column] = values.astype(float_dtype)
+    return df
+
+
+def _common_dtype(first, second, float_dtype=None):
+    """Smallest dtype holding the values of both dtypes, float_dtype for floats when it is given."""
+    if first == second:
+        return first
+    try:
+        dtype = np.result_type(first, second)
+    except TypeError:
+        return np.dtype(object)
+    return np.dtype(float_dtype) if dtype.kind == 'f' and float_dtype is not None else dtype
+
+
+@profiled('preprocessing.read_trial_csv')
+def read_trial_csv(file, usecols=None, chunksize=CSV_CHUNK_ROWS, engine='c', float_dtype=None, na_values=None):
+    '''This function helps to read a clinical trial CSV file with compact typed columns.
+    The file is read in chunks of chunksize rows and each chunk is downcast before the next one is read, so the parser never holds the
+    raw values of the whole file; the downcast chunks are then concatenated, which copies them once. Integer columns become int32 when
+    their values fit, and every chunk is cast to the dtypes of the first chunk, widened only when a later chunk does not fit them.
+    The column names are cleaned from byte order marks and surrounding spaces. Missing value tokens such as '#N/A' or the NONMEM '.' become NaN, so numeric columns stay numeric.
+
+    Parameters:
+        file (str, Path or file-like): The CSV file, e.g. the output of st.file_uploader.
+        usecols (list or str): The (cleaned) columns to read. 'inferred' reads only the columns recognized by infer_schema. None reads every column.
+        chunksize (int): Number of rows per chunk with the 'c' engine.
+        engine (str): 'c', or 'pyarrow' for the multithreaded pyarrow parser (needs pyarrow, reads the file at once).
+        float_dtype (str): Optional dtype for the float columns, e.g. 'float32'. By default floats stay float64.
+        na_values (list): Missing value tokens, defaults to NA_VALUES.
+
+    Returns:
+        df (PandasDataFrame): The dataset.
+    '''
+    na_values = NA_VALUES if na_values is None else na_values
+
+    # Project the columns by their raw names, read from the header only
+    if usecols is not None:
+        columns = pd.read_csv(file, nrows=0, encoding='utf-8-sig').columns
+        if hasattr(file, 'seek'):
+            file.seek(0)
+        if isinstance(usecols, str) and usecols == 'inferred':
+            usecols = [column for column in infer_schema(tuple(_clean_column(column) for column in columns)).values() if column is not None]
+        selected = {_clean_column(column) for column in usecols}
+        usecols = [column for column in columns if _clean_column(column) in selected]
+    options = dict(encoding='utf-8-sig', na_values=na_values, usecols=usecols)
+
+    if engine == 'pyarrow':
+        df = _downcast_frame(pd.read_csv(file, engine='pyarrow', **options), float_dtype)
+    elif engine == 'c':
+        chunks, dtypes = [], None
+        for chunk in pd.read_csv(file, chunksize=chunksize, low_memory=False, **options):
+            chunks.append(_downcast_frame(chunk, float_dtype))
+            # The first chunk sets the dtype of every column, a later chunk only widens it, e.g. int32 to float64 for missing values
+            dtypes = dict(chunk.dtypes) if dtypes is None else {
+                column: _common_dtype(dtype, chunk[column].dtype, float_dtype) for column, dtype in dtypes.items()
+            }
+        # Cast the chunks to the target dtypes one at a time, so that concat keeps them instead of upcasting on its own
+        for position, chunk in enumerate(chunks):
+            if not chunk.dtypes.equals(pd.Series(dtypes)):
+                chunks[position] = chunk.astype(dtypes)
+        df = chunks[0] if len(chunks) == 1 else pd.concat(chunks, ignore_index=True)
+    else:
+        raise ValueError(f"Unknown engine '{engine}'. Use 'c' or 'pyarrow'.")
+    df.columns = [_clean_column(column) for column in df.columns]
+    count('preprocessing.rows_read', len(df))
+    return df
 
 
 def data_preprocessing(df):
@@ -13,31 +180,25 @@ def data_preprocessing(df):
     Returns: 
         extract_df (PandasDataFrame): the manipulated dataset, with the unified columns' name.
     '''
-    # Use the similarity check to pre-assign mandatory columns
-    default_id_col = process.extract('ID', df.columns, limit=1)[0][0]
-    default_time_col = process.extract('Time', df.columns, limit=1)[0][0]
-    default_conc_col = process.extract('Conc', df.columns, limit=1)[0][0]
-    default_dose_col = process.extract('Dose', df.columns, limit=1)[0][0]
-
-    default_id_index = df.columns.get_loc(default_id_col)
-    default_time_index = df.columns.get_loc(default_time_col)
-    default_conc_index = df.columns.get_loc(default_conc_col)
-    default_dose_index = df.columns.get_loc(default_dose_col)
+    # Pre-assign the columns from the cached schema inference
+    schema = infer_schema(tuple(df.columns))
+    default_index = {role: None if column is None else df.columns.get_loc(column) for role, column in schema.items()}
 
     # Let user define the columns
+    import streamlit as st
     col1, col2 = st.columns(2)
     with col1:  # Use pre-assign columns as the default argument
         st.write('**Compulsory Information**')
-        ID_col = st.selectbox('Select a column that represent ID', df.columns, index=default_id_index)
-        Time_col = st.selectbox('Select a column that represent Time', df.columns, index=default_time_index)
-        Concentration_col = st.selectbox('Select a column that represent Concentration', df.columns, index=default_conc_index)
-        Dose_col = st.selectbox('Select a column that represent Dose', df.columns, index=default_dose_index)
+        ID_col = st.selectbox('Select a column that represent ID', df.columns, index=default_index['ID'])
+        Time_col = st.selectbox('Select a column that represent Time', df.columns, index=default_index['Time'])
+        Concentration_col = st.selectbox('Select a column that represent Concentration', df.columns, index=default_index['Conc'])
+        Dose_col = st.selectbox('Select a column that represent Dose', df.columns, index=default_index['Dose'])
     with col2:
         st.write('**Additional Information**')
-        Age_col = st.selectbox('Select a column that represent Age', df.columns, index=None)
-        Weight_col = st.selectbox('Select a column that represent Body Weight', df.columns, index=None)
-        Gender_col = st.selectbox('Select a column that represent Gender', df.columns, index=None)
-        CLCR_col = st.selectbox('Select a column that represent Clearance Creatinine', df.columns, index=None)
+        Age_col = st.selectbox('Select a column that represent Age', df.columns, index=default_index['Age'])
+        Weight_col = st.selectbox('Select a column that represent Body Weight', df.columns, index=default_index['Weight'])
+        Gender_col = st.selectbox('Select a column that represent Gender', df.columns, index=default_index['Gender'])
+        CLCR_col = st.selectbox('Select a column that represent Clearance Creatinine', df.columns, index=default_index['CLCR'])
 
     # Define the extracted columns from df
     col_list = [ID_col, Time_col, Concentration_col, Dose_col, Age_col, Weight_col, Gender_col, CLCR_col]
@@ -53,4 +214,181 @@ def data_preprocessing(df):
     extract_df = df[extracted_col]
     extract_df.columns = extracted_col_name
 
-    return extract_df
\ No newline at end of file
+    return extract_df
+
+
+def apply_schema(df, schema=None):
+    '''This function helps to rename the columns of a dataset to the unified names without user interaction, e.g. for batch jobs.
+
+    Parameters:
+        df (PandasDataFrame): the initial dataset.
+        schema (dict): The column of the dataset for each unified column ("ID", "Time", "Conc", "Dose", "Age", "Weight", "Gender", "CLCR").
+        The unified columns that are not given are inferred with infer_schema.
+
+    Returns:
+        extract_df (PandasDataFrame): the dataset with the unified columns' names, restricted to the matched columns.
+    '''
+    schema = {**infer_schema(tuple(df.columns)), **(schema or {})}
+    matched = {role: column for role, column in schema.items() if column is not None}
+    extract_df = df[list(matched.values())]
+    extract_df.columns = list(matched)
+    return extract_df
+
+
+ValidationReport = namedtuple('ValidationReport', ['clean_mask', 'row_flags', 'subject_flags'])
+ValidationReport.__doc__ = '''Result of validate_dataset.
+
+    clean_mask (NumPy array): True for the rows the analysis can use (mandatory columns present and Conc >= 0).
+    row_flags (PandasDataFrame): One boolean column per row-level check, aligned with the rows of the dataset.
+    subject_flags (PandasDataFrame): One row per ID with the number of rows raising each check, and whether the ID has several doses.
+'''
+
+
+def clean_rows(df):
+    """Rows with every mandatory column present and a non-negative concentration."""
+    mandatory = df[list(MANDATORY_COLUMNS)]
+    conc = pd.to_numeric(df['Conc'], errors='coerce').to_numpy(dtype=float)
+    return mandatory.notna().all(axis=1).to_numpy() & ~(conc < 0) & ~np.isnan(conc)
+
+
+@profiled('preprocessing.validate_dataset')
+def validate_dataset(df):
+    '''This function helps to check a preprocessed dataset for the problems that affect the analysis, for every individual at once.
+    The checks are missing values in the mandatory columns ("ID", "Time", "Conc", "Dose"), negative concentrations, zero concentrations
+    after time 0 (pre-dose samples are expected to be zero), times that go back in the row order of an individual, duplicated time points,
+    and individuals with more than one dose. Only the missing values and the negative concentrations remove rows from the clean mask;
+    the other checks are reported only, and the INFORMATIONAL_CHECKS (e.g. concentrations below the limit of quantification) are not data issues.
+
+    Parameters:
+        df (PandasDataFrame or PKDataset): The dataset with the unified columns' names from data_preprocessing.
+
+    Returns:
+        report (ValidationReport): The clean mask of the rows, the flags of every row and the summary of every individual.
+    '''
+    if isinstance(df, PKDataset):
+        df = df.frame
+    codes, ids = pd.factorize(df['ID'])
+    time = pd.to_numeric(df['Time'], errors='coerce').to_numpy(dtype=float)
+    conc = pd.to_numeric(df['Conc'], errors='coerce').to_numpy(dtype=float)
+    dose = df['Dose'].to_numpy()
+
+    # Row checks; the ordering checks compare each row with the previous row of the same individual
+    row_flags = pd.DataFrame({
+        f'Missing {column}': df[column].isna().to_numpy() for column in MANDATORY_COLUMNS
+    })
+    row_flags['Negative Conc'] = conc < 0
+    row_flags['Zero Conc'] = (conc == 0) & (time > 0)
+    order = np.argsort(codes, kind='stable')
+    same_subject = np.zeros(codes.size, dtype=bool)
+    same_subject[1:] = (codes[order][1:] == codes[order][:-1]) & (codes[order][1:] >= 0)
+    decreasing = np.zeros(codes.size, dtype=bool)
+    decreasing[order[1:]] = same_subject[1:] & (np.diff(time[order]) < 0)
+    row_flags['Non-monotonic Time'] = decreasing
+    by_time = np.lexsort((time, codes))
+    duplicated = np.zeros(codes.size, dtype=bool)
+    duplicated[by_time[1:]] = (codes[by_time][1:] == codes[by_time][:-1]) & (codes[by_time][1:] >= 0) & (np.diff(time[by_time]) == 0)
+    row_flags['Duplicate Time'] = duplicated
+
+    # Individual summary: number of flagged rows per check, and several distinct doses
+    valid = codes >= 0
+    subject_flags = pd.DataFrame({'ID': ids})
+    for column in row_flags.columns:
+        subject_flags[column] = np.bincount(codes[valid], weights=row_flags[column].to_numpy()[valid], minlength=ids.size).astype(np.int64)
+    dose_codes, doses = pd.factorize(dose)
+    pairs = np.unique((codes.astype(np.int64) * (len(doses) + 1) + dose_codes)[valid & (dose_codes >= 0)])
+    subject_flags['Multiple Doses'] = np.bincount(pairs // (len(doses) + 1), minlength=ids.size) > 1
+
+    return ValidationReport(clean_mask=clean_rows(df), row_flags=row_flags, subject_flags=subject_flags)
+
+
+class PKDataset:
+    '''A preprocessed dataset stored once in sorted, contiguous order, with offset indexes by ID and by Dose.
+    The rows are sorted by the dose of each individual, then by ID (in order of first appearance) and Time, so the rows of an individual
+    and the individuals of a dose are contiguous blocks. Every lookup is a dictionary access followed by a slice, which does not copy the data.
+
+    Parameters:
+        df (PandasDataFrame): The dataset with the unified columns' names from data_preprocessing ("ID", "Time", "Conc", "Dose", and covariates).
+        Rows without an ID are dropped. The dose of an individual is the dose of its first row.
+    '''
+
+    @profiled('preprocessing.PKDataset')
+    def __init__(self, df):
+        codes, ids = pd.factorize(df['ID'])
+        keep = codes >= 0
+        codes = codes[keep]
+        time = df['Time'].to_numpy(dtype=float)[keep]
+
+        # Dose of each individual, taken from its first row, and its rank among the sorted doses (missing doses last)
+        first_rows = np.flatnonzero(keep)[np.unique(codes, return_index=True)[1]]
+        dose_codes, doses = pd.factorize(df['Dose'].to_numpy()[first_rows], sort=True)
+        dose_codes = np.where(dose_codes < 0, doses.size, dose_codes)
+
+        # Order the individuals by dose, then the rows by individual and time
+        subject_order = np.lexsort((np.arange(ids.size), dose_codes))
+        subject_rank = np.empty_like(subject_order)
+        subject_rank[subject_order] = np.arange(ids.size)
+        order = np.lexsort((time, subject_rank[codes]))
+        self.frame = df[keep].iloc[order].reset_index(drop=True)
+
+        # Offsets of the individuals and of the doses in the sorted rows
+        self.ids = np.asarray(ids)[subject_order]
+        self.id_counts = np.bincount(codes, minlength=ids.size)[subject_order]
+        self.id_starts = np.concatenate(([0], np.cumsum(self.id_counts)[:-1])).astype(np.int64)
+        subject_dose_codes = dose_codes[subject_order]
+        dose_subjects = np.bincount(subject_dose_codes, minlength=doses.size + 1)
+        present = dose_subjects > 0
+        subject_bounds = np.concatenate(([0], np.cumsum(dose_subjects)))
+        row_bounds = np.concatenate((self.id_starts, [len(self.frame)]))
+        self.doses = pd.Index(doses).append(pd.Index([np.nan])).to_numpy()[present]
+        self.dose_starts = row_bounds[subject_bounds[:-1]][present]
+        self.dose_counts = (row_bounds[subject_bounds[1:]] - row_bounds[subject_bounds[:-1]])[present]
+        self.subject_doses = self.doses[np.cumsum(present)[subject_dose_codes] - 1]
+        self._id_index = {id: i for i, id in enumerate(self.ids.tolist())}
+        self._dose_index = {dose: i for i, dose in enumerate(self.doses.tolist()) if dose == dose}
+        self._validation = None
+
+    def __len__(self):
+        return len(self.frame)
+
+    @property
+    def validation(self):
+        '''The ValidationReport of the sorted rows, computed on first use.'''
+        if self._validation is None:
+            self._validation = validate_dataset(self.frame)
+        return self._validation
+
+    @property
+    def n_subjects(self):
+        return self.ids.size
+
+    @property
+    def columns(self):
+        return self.frame.columns
+
+    def subject_codes(self):
+        '''This function helps to get the position of the individual of every row, in the order of PKDataset.ids.'''
+        return np.repeat(np.arange(self.ids.size), self.id_counts)
+
+    def subject(self, id):
+        '''This function helps to get the rows of one individual, sorted by time.'''
+        i = self._id_index[id]
+        return self.frame.iloc[self.id_starts[i]:self.id_starts[i] + self.id_counts[i]]
+
+    def dose_group(self, dose):
+        '''This function helps to get the rows of the individuals who received the given dose.'''
+        i = self._dose_index[dose]
+        return self.frame.iloc[self.dose_starts[i]:self.dose_starts[i] + self.dose_counts[i]]
+
+    def iter_subjects(self):
+        '''This function helps to iterate over (ID, rows of the individual) pairs.'''
+        for id, start, count in zip(self.ids, self.id_starts, self.id_counts):
+            yield id, self.frame.iloc[start:start + count]
+
+    def iter_doses(self):
+        '''This function helps to iterate over (Dose, rows of the dose group) pairs.'''
+        for dose, start, count in zip(self.doses, self.dose_starts, self.dose_counts):
+            yield dose, self.frame.iloc[start:start + count]
+
+    def covariates(self):
+        '''This function helps to get one row per individual with its covariates (every column except "Time", "Conc" and "Dose").'''
+        return self.frame.iloc[self.id_starts].drop(columns=['Time', 'Conc', 'Dose'], errors='ignore').reset_index(drop=True)
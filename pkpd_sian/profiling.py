@@ -0,0 +1,247 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+
+# Number of individual span events kept for the structured logs of a recording; the per-stage totals are never truncated
+MAX_EVENTS = 10_000
+
+
+class Recording:
+    '''The stages, counters and span events recorded for one user session (see use), or for the whole process (see enable).'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = {}
+        self._events = deque(maxlen=MAX_EVENTS)
+
+    def add_span(self, name, duration):
+        with self._lock:
+            stage = self._stages.get(name)
+            if stage is None:
+                stage = self._stages[name] = [0, 0.0, 0.0]
+            stage[0] += 1
+            stage[1] += duration
+            stage[2] = max(stage[2], duration)
+            self._events.append((time.time(), name, duration, threading.current_thread().name))
+
+    def add_count(self, name, n):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._counters.clear()
+            self._events.clear()
+
+    def snapshot(self):
+        """Copies of the stages, counters and events, taken under the lock."""
+        with self._lock:
+            return ({name: tuple(stage) for name, stage in self._stages.items()}, dict(self._counters), list(self._events))
+
+
+_enabled = os.getenv('PKPD_SIAN_PROFILE', '').lower() in ('1', 'true', 'yes')
+_process_recording = Recording()
+# Recording of the current context, e.g. the script run of a Streamlit session; it takes precedence over the process one
+_context_recording = contextvars.ContextVar('pkpd_sian_recording', default=None)
+
+
+def _active_recording():
+    """Recording the spans and counters go to, None while nothing is recorded."""
+    recording = _context_recording.get()
+    if recording is None and _enabled:
+        return _process_recording
+    return recording
+
+
+def _selected_recording(recording):
+    """The given recording, else the one of the current context, else the process one."""
+    return recording or _context_recording.get() or _process_recording
+
+
+class _NullSpan:
+    """Span returned while nothing is recorded, entering and leaving it does nothing."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    """Span that adds its wall time to the totals of its stage in a recording when it is left."""
+
+    __slots__ = ('name', 'recording', 'started')
+
+    def __init__(self, name, recording):
+        self.name = name
+        self.recording = recording
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.recording.add_span(self.name, time.perf_counter() - self.started)
+        return False
+
+
+def enable():
+    '''This function helps to start recording the spans and counters of the whole process (also enabled by the environment variable
+    PKPD_SIAN_PROFILE=1), e.g. for the batch runner or the HTTP service.'''
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    '''This function helps to stop recording for the whole process; the spans then cost a flag and a context variable check.'''
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def use(recording):
+    '''This function helps to record the spans and counters of the current context, i.e. the current thread or Streamlit script run
+    and the background jobs it submits, into a recording of its own rather than the process one.
+
+    Parameters:
+        recording (Recording): Where to record. None stops recording in the current context, unless the process recording is enabled.
+    '''
+    _context_recording.set(recording)
+
+
+def reset(recording=None):
+    '''This function helps to clear the recorded stages, counters and events (of the current context's recording by default).'''
+    _selected_recording(recording).reset()
+
+
+def span(name):
+    '''This function helps to time a stage of the computation, e.g. "with span('analysis.fit'): ...".
+
+    Parameters:
+        name (str): The stage, as "<module>.<stage>".
+
+    Returns:
+        span (context manager): Records the wall time of the block under the stage name while recording.
+    '''
+    recording = _active_recording()
+    return _NULL_SPAN if recording is None else _Span(name, recording)
+
+
+def count(name, n=1):
+    '''This function helps to add n to a counter, e.g. the number of fitted individuals, while recording.'''
+    recording = _active_recording()
+    if recording is not None:
+        recording.add_count(name, n)
+
+
+def profiled(name):
+    '''This function helps to time every call of a function as a stage, as a decorator.'''
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            recording = _active_recording()
+            if recording is None:
+                return function(*args, **kwargs)
+            with _Span(name, recording):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summary(recording=None):
+    '''This function helps to summarise the recorded stages (of the current context's recording by default).
+
+    Returns:
+        stages (PandasDataFrame): One row per stage, sorted by total time, including:
+            - Stage
+            - Calls
+            - Total (s)
+            - Mean (ms)
+            - Max (ms)
+            - Share (%): share of the total time of all stages. Nested stages are counted in their parent as well.
+        counters (dict): The value of every counter.
+    '''
+    import pandas as pd
+
+    stages, counters, _ = _selected_recording(recording).snapshot()
+    rows = [(name, calls, total, max_duration) for name, (calls, total, max_duration) in stages.items()]
+    stages = pd.DataFrame(rows, columns=['Stage', 'Calls', 'Total (s)', 'Max (ms)'])
+    stages['Mean (ms)'] = 1e3 * stages['Total (s)'] / stages['Calls']
+    stages['Max (ms)'] *= 1e3
+    stages['Share (%)'] = 100 * stages['Total (s)'] / stages['Total (s)'].sum() if rows else []
+    stages = stages[['Stage', 'Calls', 'Total (s)', 'Mean (ms)', 'Max (ms)', 'Share (%)']]
+    return stages.sort_values('Total (s)', ascending=False, ignore_index=True), counters
+
+
+def export_logs(file=None, recording=None):
+    '''This function helps to export a recording (the current context's by default) as structured logs, one JSON object per line:
+    a "span" record per recorded span (the last MAX_EVENTS), then a "stage" record per stage and a "counter" record per counter.
+
+    Parameters:
+        file (str, Path or file-like): Where to write the logs. None only returns them.
+        recording (Recording): The recording to export.
+
+    Returns:
+        logs (str): The JSON lines.
+    '''
+    stages, counters, events = _selected_recording(recording).snapshot()
+    records = [{'type': 'span', 'timestamp': timestamp, 'stage': name, 'duration_ms': 1e3 * duration, 'thread': thread}
+               for timestamp, name, duration, thread in events]
+    records += [{'type': 'stage', 'stage': name, 'calls': calls, 'total_s': total, 'max_ms': 1e3 * max_duration}
+                for name, (calls, total, max_duration) in stages.items()]
+    records += [{'type': 'counter', 'counter': name, 'value': value} for name, value in counters.items()]
+    logs = ''.join(json.dumps(record) + '\n' for record in records)
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'w', encoding='utf-8') as handle:
+            handle.write(logs)
+    elif file is not None:
+        file.write(logs)
+    return logs
+
+
+def performance_panel():
+    '''This function helps to display the optional performance panel in the sidebar of a page.
+    The toggle records the session's following runs, and its background jobs, into a recording kept in the session state, so other
+    sessions are neither recorded nor shown; the panel shows the per-stage breakdown recorded since the last reset, with a download
+    of the structured logs. Call it at the top of a page, before the computations.'''
+    import streamlit as st
+
+    if not st.sidebar.toggle('Performance panel', key='performance_panel'):
+        use(None)
+        return
+    if 'performance_recording' not in st.session_state:
+        st.session_state.performance_recording = Recording()
+    recording = st.session_state.performance_recording
+    use(recording)
+    with st.sidebar:
+        stages, counters = summary(recording)
+        if stages.empty:
+            st.caption('Nothing recorded yet, the stages appear after the next computation.')
+        else:
+            st.dataframe(stages.round(3), hide_index=True)
+        if counters:
+            st.dataframe({'Counter': list(counters), 'Value': list(counters.values())}, hide_index=True)
+        col1, col2 = st.columns(2)
+        with col1:
+            st.download_button('Export logs', export_logs(recording=recording), file_name='pkpd_sian_profile.jsonl',
+                               mime='application/json')
+        with col2:
+            if st.button('Reset', key='performance_panel_reset'):
+                recording.reset()
+                st.rerun()
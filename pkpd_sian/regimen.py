@@ -0,0 +1,210 @@
+import hashlib
+import json
+
+import numpy as np
+
+
+ROUTES = ('iv', 'non_iv')
+_ROUTE_CODES = {label: code for code, label in enumerate(ROUTES)}
+
+
+def _as_vector(values, size, default, name):
+    """Broadcast a scalar or sequence to a read-only float vector of the given size."""
+    if values is None:
+        values = default
+    array = np.array(values, dtype=float)
+    if array.ndim == 0:
+        array = np.full(size, array.item())
+    array = array.ravel()
+    if array.size != size:
+        raise ValueError(f'{name} has {array.size} entries but the regimen has {size} doses.')
+    return array
+
+
+def _as_route_codes(routes, size):
+    """Translate route labels ('iv', 'non_iv') or integer codes into an int8 vector."""
+    if routes is None:
+        routes = 'iv'
+    if isinstance(routes, str):
+        routes = [routes] * size
+    array = np.asarray(routes)
+    if array.dtype.kind in 'iu':
+        codes = array.astype(np.int8).ravel()
+    else:
+        labels = array.astype(str).ravel()
+        unknown = sorted(set(labels) - set(ROUTES))
+        if unknown:
+            raise ValueError(f'Unknown route(s) {unknown}. Use one of {list(ROUTES)}.')
+        codes = np.zeros(labels.size, dtype=np.int8)
+        for label, code in _ROUTE_CODES.items():
+            codes[labels == label] = code
+    if codes.size != size:
+        raise ValueError(f'routes has {codes.size} entries but the regimen has {size} doses.')
+    return codes
+
+
+class Regimen:
+    '''A dosing regimen stored as parallel NumPy arrays, one entry per dose.
+
+    Parameters:
+        times (array-like): Starting time point of each dose.
+        doses (array-like): Dose amount of each dose.
+        routes (str or array-like): Route of each dose, either 'iv' or 'non_iv' (or the codes 0 and 1). Defaults to 'iv'.
+        F (float or array-like): Bioavailability of each dose. Only used for non-iv doses, defaults to 1.0.
+        infusion_durations (float or array-like): Infusion duration of each iv dose. NaN (or None) means an iv bolus.
+
+    The arrays are read-only, so a regimen can be hashed and used as a cache key. Invalid regimens raise ValueError.
+    '''
+
+    __slots__ = ('times', 'doses', 'routes', 'F', 'infusion_durations', '_hash')
+
+    def __init__(self, times, doses, routes=None, F=None, infusion_durations=None):
+        times = np.array(times, dtype=float).ravel()
+        size = times.size
+        durations = infusion_durations
+        if durations is not None and not np.isscalar(durations):
+            durations = [np.nan if value is None else value for value in durations]
+        self.times = times
+        self.doses = _as_vector(doses, size, None, 'doses')
+        self.routes = _as_route_codes(routes, size)
+        self.F = _as_vector(F, size, 1.0, 'F')
+        self.infusion_durations = _as_vector(durations, size, np.nan, 'infusion_durations')
+        self._hash = None
+        for array in (self.times, self.doses, self.routes, self.F, self.infusion_durations):
+            array.flags.writeable = False
+        self.validate()
+
+    # Construction helpers
+    @classmethod
+    def single(cls, dose, time=0.0, route='iv', F=1.0, infusion_duration=None):
+        '''This function helps to create a regimen with a single dose.'''
+        return cls([time], [dose], [route], [F], [infusion_duration])
+
+    @classmethod
+    def repeated(cls, dose, tau, n_doses, start=0.0, route='iv', F=1.0, infusion_duration=None):
+        '''This function helps to create a regimen of n_doses equal doses given every tau hours from start.'''
+        times = start + tau * np.arange(n_doses)
+        return cls(times, dose, route, F, np.nan if infusion_duration is None else infusion_duration)
+
+    @classmethod
+    def from_records(cls, records):
+        '''This function helps to convert the list of dose dictionaries used by the Streamlit pages into a regimen.
+
+        Parameters:
+            records (list): Dictionaries with the keys "time", "dose", "label" ('iv' or 'non_iv') and optionally "F" and "infusion_duration".
+        '''
+        times = [record['time'] for record in records]
+        doses = [record['dose'] for record in records]
+        routes = [record.get('label', 'iv') for record in records]
+        F = [1.0 if record.get('F') is None else record['F'] for record in records]
+        durations = [record.get('infusion_duration') for record in records]
+        return cls(times, doses, routes, F, durations)
+
+    @classmethod
+    def from_dict(cls, data):
+        '''This function helps to rebuild a regimen from the output of Regimen.to_dict().'''
+        return cls(data['times'], data['doses'], data['routes'], data['F'], data['infusion_durations'])
+
+    @classmethod
+    def from_json(cls, text):
+        '''This function helps to rebuild a regimen from the output of Regimen.to_json().'''
+        return cls.from_dict(json.loads(text))
+
+    # Serialization
+    def to_dict(self):
+        '''This function helps to export the regimen as a dictionary of plain lists (NaN infusion durations become None).'''
+        return {
+            'times': self.times.tolist(),
+            'doses': self.doses.tolist(),
+            'routes': [ROUTES[code] for code in self.routes],
+            'F': self.F.tolist(),
+            'infusion_durations': [None if np.isnan(value) else value for value in self.infusion_durations.tolist()],
+        }
+
+    def to_json(self):
+        '''This function helps to export the regimen as a JSON string.'''
+        return json.dumps(self.to_dict())
+
+    def to_records(self):
+        '''This function helps to convert the regimen back into the list of dose dictionaries used by the Streamlit pages.'''
+        data = self.to_dict()
+        records = []
+        for time, dose, route, F, duration in zip(data['times'], data['doses'], data['routes'], data['F'], data['infusion_durations']):
+            if route == 'iv':
+                records.append({'time': time, 'dose': dose, 'infusion_duration': duration, 'label': route})
+            else:
+                records.append({'time': time, 'dose': dose, 'F': F, 'label': route})
+        return records
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.__init__(state['times'], state['doses'], state['routes'], state['F'], state['infusion_durations'])
+
+    # Validation and masks
+    def validate(self):
+        '''This function helps to check the whole regimen at once and raise ValueError describing every problem found.'''
+        problems = []
+        if not np.all(np.isfinite(self.times)) or np.any(self.times < 0):
+            problems.append('dose times must be finite and non-negative')
+        if not np.all(np.isfinite(self.doses)) or np.any(self.doses < 0):
+            problems.append('dose amounts must be finite and non-negative')
+        if np.any((self.routes < 0) | (self.routes >= len(ROUTES))):
+            problems.append('route codes must be 0 (iv) or 1 (non_iv)')
+        if not np.all(np.isfinite(self.F)) or np.any(self.F < 0):
+            problems.append('bioavailability must be finite and non-negative')
+        has_duration = ~np.isnan(self.infusion_durations)
+        if np.any(self.infusion_durations[has_duration] <= 0) or np.any(np.isinf(self.infusion_durations)):
+            problems.append('infusion durations must be positive and finite')
+        if np.any(has_duration & (self.routes != _ROUTE_CODES['iv'])):
+            problems.append('infusion durations are only allowed for iv doses')
+        if problems:
+            raise ValueError('Invalid regimen: ' + '; '.join(problems) + '.')
+
+    @property
+    def is_iv(self):
+        return self.routes == _ROUTE_CODES['iv']
+
+    @property
+    def is_bolus(self):
+        return self.is_iv & np.isnan(self.infusion_durations)
+
+    @property
+    def is_infusion(self):
+        return self.is_iv & ~np.isnan(self.infusion_durations)
+
+    @property
+    def is_non_iv(self):
+        return self.routes == _ROUTE_CODES['non_iv']
+
+    # Container protocol
+    def __len__(self):
+        return self.times.size
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            index = slice(index, index + 1 if index != -1 else None)
+        return Regimen(self.times[index], self.doses[index], self.routes[index], self.F[index], self.infusion_durations[index])
+
+    def __eq__(self, other):
+        if not isinstance(other, Regimen):
+            return NotImplemented
+        return all(
+            np.array_equal(mine, theirs, equal_nan=True)
+            for mine, theirs in zip(self._arrays(), other._arrays())
+        )
+
+    def __hash__(self):
+        if self._hash is None:
+            digest = hashlib.blake2b(digest_size=8)
+            for array in self._arrays():
+                digest.update(np.ascontiguousarray(array).tobytes())
+            self._hash = int.from_bytes(digest.digest(), 'little', signed=True)
+        return self._hash
+
+    def __repr__(self):
+        return f'Regimen(n_doses={len(self)}, iv={int(self.is_iv.sum())}, non_iv={int(self.is_non_iv.sum())})'
+
+    def _arrays(self):
+        return (self.times, self.doses, self.routes.astype(float), self.F, self.infusion_durations)
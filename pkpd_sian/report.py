@@ -0,0 +1,178 @@
+import html
+import os
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from pkpd_sian.analysis import (
+    EPSILON,
+    _bateman,
+    _process_pool,
+    _sorted_profiles,
+    _terminal_regression_points,
+    non_compartmental_analysis,
+    one_compartmental_im_analysis,
+    one_compartmental_iv_analysis,
+)
+from pkpd_sian.preprocessing import INFORMATIONAL_CHECKS, PKDataset
+
+
+# Individual plots are only rendered in worker processes above this many subjects
+REPORT_PARALLEL_MIN_SUBJECTS = 50
+REPORT_CURVE_POINTS = 200
+
+_STYLE = '''
+body { font-family: sans-serif; margin: 2em; }
+table { border-collapse: collapse; font-size: 0.85em; margin-bottom: 2em; }
+th, td { border: 1px solid #ccc; padding: 0.25em 0.5em; text-align: right; }
+.subject { border-top: 1px solid #ddd; padding-top: 1em; }
+'''
+
+
+@lru_cache(maxsize=None)
+def _subplot_layout(titles):
+    """Layout of a row of subplots with the given titles, built once per combination of analyses."""
+    from plotly.subplots import make_subplots
+
+    fig = make_subplots(rows=1, cols=max(len(titles), 1), subplot_titles=titles)
+    for col, title in enumerate(titles, start=1):
+        fig.update_xaxes(title_text='Time', row=1, col=col)
+        fig.update_yaxes(title_text='Concentration' if title == 'Non-IV fit' else 'Log Concentration', row=1, col=col)
+    fig.update_layout(height=320, showlegend=False, margin=dict(t=40, b=40))
+    return fig.layout.to_plotly_json()
+
+
+def _trace(col, x, y, mode, color):
+    """Trace of one subplot as a plain dictionary, skipping the validation of plotly objects."""
+    axis = '' if col == 1 else str(col)
+    style = {'marker': {'color': color}} if mode == 'markers' else {'line': {'color': color}}
+    return {'type': 'scatter', 'x': x, 'y': y, 'mode': mode, 'xaxis': 'x' + axis, 'yaxis': 'y' + axis, **style}
+
+
+def _render_subject_chunk(tasks):
+    """Render the individual plots of a list of subjects, returning one HTML fragment per subject."""
+    import plotly.io as pio
+
+    fragments = []
+    for id, time, conc, dose, F, nca, iv, im in tasks:
+        panels = [(name, row) for name, row in (('NCA', nca), ('IV fit', iv), ('Non-IV fit', im)) if row is not None]
+        # Same scale as the log-linear regressions of the analyses, which keeps the zero concentrations
+        log_conc = np.log(conc + EPSILON)
+        curve_time = np.linspace(0, time.max(initial=0.0), REPORT_CURVE_POINTS)
+        data = []
+        for col, (name, row) in enumerate(panels, start=1):
+            if name == 'NCA':
+                # Lambda points and the terminal regression line on the log scale
+                _, lambda_start, line_time, line_log_conc = _terminal_regression_points(
+                    time, conc, row['Number of Lambda Points'], row['Slope'], row['Intercept'])
+                data += [
+                    _trace(col, time, log_conc, 'markers', '#636EFA'),
+                    _trace(col, time[lambda_start:], log_conc[lambda_start:], 'markers', 'red'),
+                    _trace(col, line_time, line_log_conc, 'lines', 'red'),
+                ]
+            elif name == 'IV fit':
+                data += [
+                    _trace(col, time, log_conc, 'markers', '#636EFA'),
+                    _trace(col, curve_time, np.log(row['C0']) - row['ke'] * curve_time, 'lines', '#EF553B'),
+                ]
+            else:
+                data += [
+                    _trace(col, time, conc, 'markers', '#636EFA'),
+                    _trace(col, curve_time, _bateman(curve_time, row['ka'], row['ke'], row['Vd'], F, dose), 'lines', '#EF553B'),
+                ]
+        layout = _subplot_layout(tuple(name for name, _ in panels))
+        fragments.append(
+            f'<div class="subject"><h3>ID {html.escape(str(id))} (Dose {html.escape(str(dose))})</h3>'
+            + pio.to_html({'data': data, 'layout': layout}, full_html=False, include_plotlyjs=False, validate=False)
+            + '</div>'
+        )
+    return fragments
+
+
+def _table_html(df):
+    """Render a results table with rounded numbers."""
+    return df.round(4).to_html(index=False, border=0, na_rep='')
+
+
+def generate_report(data, file=None, analyses=('nca', 'iv', 'im'), predefined_F=1.0, n_jobs=None, title='PK Analysis Report'):
+    '''This function helps to build a self-contained HTML report of a dataset without the Streamlit pages.
+    The analyses run once on the whole dataset, then the individual plots (NCA regression and model fits) of every subject are
+    rendered in parallel worker processes and assembled with the result tables into a single HTML file that embeds plotly.js.
+
+    Parameters:
+        data (PandasDataFrame or PKDataset): The dataset with the unified columns' names ("ID", "Time", "Conc", "Dose", and covariates).
+        file (str or Path): Where to write the report. None only returns the HTML.
+        analyses (tuple): Analyses to include, among 'nca', 'iv' (one_compartmental_iv_analysis) and 'im' (one_compartmental_im_analysis).
+        predefined_F (float): Bioavailability of the drug, used by the 'im' analysis.
+        n_jobs (int): Number of worker processes, used both to fit the 'im' analysis and to render the plots, one step after the other.
+        None uses all CPUs, 1 runs everything in the current process.
+        title (str): Title of the report.
+
+    Returns:
+        report (str): The HTML of the report.
+    '''
+    from plotly.offline import get_plotlyjs
+
+    unknown = sorted(set(analyses) - {'nca', 'iv', 'im'})
+    if unknown:
+        raise ValueError(f"Unknown analyses {unknown}. Use 'nca', 'iv' or 'im'.")
+    dataset = data if isinstance(data, PKDataset) else PKDataset(data)
+
+    # Run every analysis once on the whole dataset
+    results, sections = {}, []
+    if 'nca' in analyses:
+        results['nca'], unqualified_id = non_compartmental_analysis(dataset, extended=True)
+        sections.append(('Non-compartmental Analysis', results['nca'], unqualified_id))
+    if 'iv' in analyses:
+        results['iv'], unqualified_id = one_compartmental_iv_analysis(dataset)
+        sections.append(('One-compartmental IV Analysis', results['iv'], unqualified_id))
+    if 'im' in analyses:
+        results['im'], unqualified_id = one_compartmental_im_analysis(dataset, predefined_F, n_jobs=n_jobs)
+        sections.append(('One-compartmental Non-IV Analysis', results['im'], unqualified_id))
+
+    # One task per subject with its clean profile and its row of each analysis
+    profiles, _ = _sorted_profiles(dataset, min_points=1)
+    rows = {name: df.set_index('ID').to_dict('index') for name, df in results.items()}
+    tasks = []
+    for id, start, count in zip(profiles.ids, profiles.starts, profiles.counts):
+        end = start + count
+        tasks.append((id, profiles.time[start:end], profiles.conc[start:end], profiles.dose[start], predefined_F,
+                      *(rows[name].get(id) if name in rows else None for name in ('nca', 'iv', 'im'))))
+
+    # Render the individual plots, in contiguous chunks over worker processes for large studies
+    n_workers = n_jobs or os.cpu_count() or 1
+    if n_workers == 1 or len(tasks) < REPORT_PARALLEL_MIN_SUBJECTS:
+        fragments = _render_subject_chunk(tasks)
+    else:
+        n_chunks = n_workers * 4
+        bounds = np.linspace(0, len(tasks), n_chunks + 1).astype(int)
+        with _process_pool(n_workers) as executor:
+            chunk_fragments = executor.map(_render_subject_chunk, [tasks[a:b] for a, b in zip(bounds[:-1], bounds[1:])])
+            fragments = [fragment for chunk in chunk_fragments for fragment in chunk]
+
+    # Assemble the report
+    parts = [
+        '<!DOCTYPE html><html><head><meta charset="utf-8">',
+        f'<title>{html.escape(title)}</title><style>{_STYLE}</style>',
+        f'<script type="text/javascript">{get_plotlyjs()}</script></head><body>',
+        f'<h1>{html.escape(title)}</h1>',
+        f'<p>{dataset.n_subjects} individuals, {len(dataset)} rows, doses: {", ".join(str(dose) for dose in dataset.doses)}.</p>',
+    ]
+    subject_flags = dataset.validation.subject_flags
+    flagged = subject_flags.drop(columns=['ID', *INFORMATIONAL_CHECKS]).astype(bool).any(axis=1).to_numpy()
+    if flagged.any():
+        parts += ['<h2>Data Issues</h2>', _table_html(subject_flags[flagged])]
+    for name, df, unqualified_id in sections:
+        parts.append(f'<h2>{name}</h2>')
+        if unqualified_id:
+            parts.append(f'<p>Not analysed: ID {html.escape(", ".join(str(id) for id in unqualified_id))}.</p>')
+        parts += ['<h3>Summary</h3>', _table_html(df.drop(columns='ID').describe().T.reset_index(names='Parameter'))]
+        parts += ['<h3>Individual Results</h3>', _table_html(df)]
+    parts += ['<h2>Individual Profiles</h2>', *fragments, '</body></html>']
+    report = '\n'.join(parts)
+
+    if file is not None:
+        Path(file).write_text(report, encoding='utf-8')
+    return report
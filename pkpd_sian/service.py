@@ -0,0 +1,426 @@
+import argparse
+import json
+import math
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from pkpd_sian import __version__
+from pkpd_sian.profiling import count, span
+from pkpd_sian.regimen import Regimen
+
+
+# Requests waiting for a batch beyond this are answered with 503 instead of queueing without bound
+MAX_PENDING_REQUESTS = 1024
+# Largest body accepted, in bytes
+MAX_BODY_BYTES = 50 * 2 ** 20
+# Seconds a request waits for its result before a 504
+REQUEST_TIMEOUT = 300
+# Bytes of request keys and responses kept by the result cache
+CACHE_MAX_BYTES = 256 * 2 ** 20
+
+
+class ServiceError(Exception):
+    """Error answered to the client with the given HTTP status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _json_ready(value):
+    """Convert NumPy scalars and arrays, and NaN, into JSON-compatible values."""
+    if isinstance(value, dict):
+        return {str(key): _json_ready(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_ready(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return _json_ready(value.tolist())
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+# Request parsing, in the handler thread so that invalid requests never reach a batch
+def _parse_regimen_request(body):
+    """Batch key and inputs of a /simulate/regimen request."""
+    spec = body.get('regimen')
+    if isinstance(spec, list):
+        regimen = Regimen.from_records(spec)
+    elif isinstance(spec, dict):
+        regimen = Regimen(**spec)
+    else:
+        regimen = Regimen.single(body['dose'], route=body.get('route', 'iv'), F=body.get('F', 1.0),
+                                 infusion_duration=body.get('infusion_duration'))
+    grid = body['time']
+    if isinstance(grid, dict):
+        time = np.linspace(grid.get('start', 0.0), grid['end'], int(round((grid['end'] - grid.get('start', 0.0)) / grid['step'])) + 1)
+    else:
+        time = np.asarray(grid, dtype=float)
+    if time.ndim != 1 or time.size == 0 or time.size > 1_000_000:
+        raise ValueError('time must be a non-empty list (or start/end/step) of at most 1,000,000 points.')
+    ka = body.get('ka')
+    if regimen.is_non_iv.any() and ka is None:
+        raise ValueError('ka is mandatory for a regimen with non-iv doses.')
+    params = (float(body['ke']), float(body['Vd']), None if ka is None else float(ka))
+    return (regimen, time.tobytes(), ka is None), (regimen, time, params)
+
+
+def _parse_analysis_request(body, analysis):
+    """Batch key and inputs of an /analysis/<analysis> request."""
+    df = pd.DataFrame(body['data'])
+    missing = [column for column in ('ID', 'Time', 'Conc', 'Dose') if column not in df.columns]
+    if missing:
+        raise ValueError(f'data is missing the columns {missing}.')
+    df[['Time', 'Conc', 'Dose']] = df[['Time', 'Conc', 'Dose']].apply(pd.to_numeric, errors='coerce')
+    if analysis == 'nca':
+        options = (body.get('extended', False), body.get('auc_method', 'linear'))
+    elif analysis == 'im_fit':
+        options = (float(body.get('predefined_F', 1.0)),)
+    else:
+        options = ()
+    return (analysis, options), df
+
+
+# Batched engine calls: every function takes the inputs of several requests sharing a key and returns one result per request
+def _simulate_regimens(key, inputs):
+    """One vectorized regimen simulation for all the requests, each with its own ke, Vd and ka."""
+    from pkpd_sian.simulation import regimen_simulation
+
+    regimen, time, _ = inputs[0]
+    ke, Vd, ka = (np.array(values, dtype=float) for values in zip(*(params for _, _, params in inputs)))
+    concentration = regimen_simulation(regimen, time, ke, Vd, None if key[2] else ka)
+    return [{'time': time, 'concentration': row} for row in concentration]
+
+
+def _analyse_datasets(key, inputs):
+    """One analysis call on the datasets of all the requests, stacked with request-specific subject codes."""
+    from pkpd_sian.analysis import non_compartmental_analysis, one_compartmental_im_analysis, one_compartmental_iv_analysis
+
+    analysis, options = key
+    frames, original_ids, offset = [], [], 0
+    for df in inputs:
+        codes, uniques = pd.factorize(df['ID'])
+        frames.append(df.assign(ID=np.where(codes >= 0, codes + offset, -1)))
+        original_ids.append(uniques)
+        offset += len(uniques)
+    stacked = pd.concat(frames, ignore_index=True)
+    stacked = stacked[stacked['ID'] >= 0]
+
+    if analysis == 'nca':
+        result, unqualified = non_compartmental_analysis(stacked, extended=options[0], auc_method=options[1])
+    elif analysis == 'iv_fit':
+        result, unqualified = one_compartmental_iv_analysis(stacked)
+    else:
+        result, unqualified = one_compartmental_im_analysis(stacked, options[0], n_jobs=1)
+
+    # Give every request its own rows back, with its own IDs
+    bounds = np.cumsum([0] + [len(ids) for ids in original_ids])
+    request = np.searchsorted(bounds, result['ID'].to_numpy(), side='right') - 1
+    unqualified = np.asarray(unqualified, dtype=np.int64)
+    unqualified_request = np.searchsorted(bounds, unqualified, side='right') - 1
+    outputs = []
+    for i, ids in enumerate(original_ids):
+        rows = result[request == i].copy()
+        rows['ID'] = ids[rows['ID'].to_numpy() - bounds[i]]
+        outputs.append({
+            'results': rows.to_dict('records'),
+            'unqualified_id': list(ids[unqualified[unqualified_request == i] - bounds[i]]),
+        })
+    return outputs
+
+
+ENDPOINTS = {
+    '/simulate/regimen': (_parse_regimen_request, _simulate_regimens),
+    '/analysis/nca': (lambda body: _parse_analysis_request(body, 'nca'), _analyse_datasets),
+    '/analysis/iv_fit': (lambda body: _parse_analysis_request(body, 'iv_fit'), _analyse_datasets),
+    '/analysis/im_fit': (lambda body: _parse_analysis_request(body, 'im_fit'), _analyse_datasets),
+}
+
+
+class ResultCache:
+    '''A thread-safe LRU cache of encoded responses, keyed on the endpoint and the canonical JSON of the request body.
+    It is bounded both by its number of entries and by the bytes of their keys and responses; an entry larger than the byte
+    bound on its own is not cached.'''
+
+    def __init__(self, size=1024, max_bytes=CACHE_MAX_BYTES):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        entry_bytes = len(key) + len(value)
+        if self.size <= 0 or entry_bytes > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self.bytes -= len(key) + len(previous)
+            self._items[key] = value
+            self.bytes += entry_bytes
+            while len(self._items) > self.size or self.bytes > self.max_bytes:
+                old_key, old_value = self._items.popitem(last=False)
+                self.bytes -= len(old_key) + len(old_value)
+
+
+class MicroBatcher:
+    '''Collects concurrent requests for a short time and runs the requests that share a batch key in one engine call,
+    on a bounded pool of worker threads.
+
+    Parameters:
+        workers (int): Number of batches run at once. None uses the number of CPUs.
+        max_batch_size (int): Largest number of requests per batch.
+        max_delay (float): Seconds the first request of a batch waits for others.
+        max_pending (int): Requests waiting for a batch beyond this are refused (ServiceError 503).
+    '''
+
+    def __init__(self, workers=None, max_batch_size=64, max_delay=0.005, max_pending=MAX_PENDING_REQUESTS):
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.batches = 0
+        self.requests = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1, thread_name_prefix='pkpd-batch')
+        self._closed = threading.Event()
+        self._dispatcher = threading.Thread(target=self._dispatch, name='pkpd-batcher', daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, run, key, inputs):
+        '''This function helps to queue one request; the returned Future holds its result once its batch has run.'''
+        future = Future()
+        try:
+            self._queue.put_nowait((run, key, inputs, future))
+        except queue.Full:
+            raise ServiceError(503, 'Too many pending requests, retry later.') from None
+        return future
+
+    def close(self):
+        self._closed.set()
+        self._dispatcher.join()
+        self._pool.shutdown(wait=True)
+
+    def _dispatch(self):
+        while not self._closed.is_set():
+            try:
+                items = [self._queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            # Wait a little for concurrent requests, then group them by engine and batch key
+            deadline = time.monotonic() + self.max_delay
+            while len(items) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    items.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            groups = {}
+            for item in items:
+                groups.setdefault((item[0], item[1]), []).append(item)
+            for (run, key), group in groups.items():
+                self.batches += 1
+                self.requests += len(group)
+                self._pool.submit(self._run_batch, run, key, group)
+
+    @staticmethod
+    def _run_batch(run, key, group):
+        count('service.batches')
+        count('service.batched_requests', len(group))
+        try:
+            with span('service.batch'):
+                results = run(key, [inputs for _, _, inputs, _ in group])
+        except Exception as error:
+            if len(group) == 1:
+                group[0][3].set_exception(error)
+                return
+            # A request that breaks the batch must not fail the others, so they are retried one by one
+            for item in group:
+                MicroBatcher._run_batch(run, key, [item])
+            return
+        for (_, _, _, future), result in zip(group, results):
+            future.set_result(result)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = f'pkpd-sian/{__version__}'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, status, payload, cache='miss'):
+        self._send_body(status, json.dumps(payload).encode(), cache)
+
+    def _send_body(self, status, body, cache='miss'):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Cache', cache)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            batcher, cache = self.server.batcher, self.server.cache
+            self._send(200, {'status': 'ok', 'version': __version__, 'endpoints': sorted(ENDPOINTS), 'batches': batcher.batches,
+                             'batched_requests': batcher.requests, 'cache_hits': cache.hits, 'cache_misses': cache.misses,
+                             'cache_bytes': cache.bytes})
+        else:
+            self._send(404, {'error': f'Unknown path {self.path}.'})
+
+    def do_POST(self):
+        try:
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+            except ValueError:
+                length = -1
+            # The body cannot be skipped without a valid length, so the connection is closed after the error
+            if length < 0:
+                self.close_connection = True
+                raise ServiceError(400, 'The Content-Length header must be a non-negative integer.')
+            if length > MAX_BODY_BYTES:
+                self.close_connection = True
+                raise ServiceError(413, f'The body exceeds {MAX_BODY_BYTES} bytes.')
+            raw = self.rfile.read(length)
+            if self.path not in ENDPOINTS:
+                raise ServiceError(404, f'Unknown path {self.path}. Use one of {sorted(ENDPOINTS)}.')
+            try:
+                body = json.loads(raw)
+            except ValueError:
+                raise ServiceError(400, 'The body is not valid JSON.') from None
+            if not isinstance(body, dict):
+                raise ServiceError(400, 'The body must be a JSON object.')
+
+            # Identical requests are answered from the cache without reaching the engines
+            cache_key = f'{self.path} {json.dumps(body, sort_keys=True)}'
+            cached = self.server.cache.get(cache_key)
+            if cached is not None:
+                count('service.cache_hits')
+                self._send_body(200, cached, cache='hit')
+                return
+
+            parse, run = ENDPOINTS[self.path]
+            try:
+                key, inputs = parse(body)
+            except (KeyError, TypeError, ValueError) as error:
+                raise ServiceError(400, f'Invalid request: {error!r}') from None
+            future = self.server.batcher.submit(run, key, inputs)
+            try:
+                payload = _json_ready(future.result(timeout=REQUEST_TIMEOUT))
+            # Distinct from the builtin TimeoutError before Python 3.11
+            except FutureTimeoutError:
+                raise ServiceError(504, 'The computation did not finish in time.') from None
+            except (KeyError, TypeError, ValueError) as error:
+                raise ServiceError(400, f'Invalid request: {error!r}') from None
+            response = json.dumps(payload).encode()
+            self.server.cache.put(cache_key, response)
+            self._send_body(200, response)
+        except ServiceError as error:
+            self._send(error.status, {'error': str(error)})
+        except Exception as error:
+            self._send(500, {'error': f'{type(error).__name__}: {error}'})
+
+
+class SimulationServer(ThreadingHTTPServer):
+    '''HTTP server of the simulation and analysis engines, with its micro-batcher and result cache (see create_server).'''
+
+    daemon_threads = True
+    # Room in the listen backlog for the bursts of concurrent clients that batching is meant for
+    request_queue_size = 256
+
+    def __init__(self, address, batcher, cache, verbose=False):
+        super().__init__(address, _Handler)
+        self.batcher = batcher
+        self.cache = cache
+        self.verbose = verbose
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def server_close(self):
+        super().server_close()
+        self.batcher.close()
+
+
+def create_server(host='127.0.0.1', port=8000, workers=None, max_batch_size=64, max_delay=0.005, cache_size=1024, verbose=False,
+                  cache_bytes=CACHE_MAX_BYTES):
+    '''This function helps to create the HTTP service of the simulation and analysis engines. Run it with server.serve_forever(),
+    stop it with server.shutdown() then server.server_close().
+
+    Endpoints (JSON bodies and answers):
+        GET /health: status, version and batching and cache statistics.
+        POST /simulate/regimen: {"regimen": Regimen arguments or dose records, or "dose" and "route", "time": list or {"start", "end", "step"},
+            "ke", "Vd", "ka"} -> {"time", "concentration"}. Requests sharing a regimen and a time grid are simulated in one call.
+        POST /analysis/nca, /analysis/iv_fit, /analysis/im_fit: {"data": {"ID": [...], "Time": [...], "Conc": [...], "Dose": [...]},
+            and "extended", "auc_method" (nca) or "predefined_F" (im_fit)} -> {"results": one record per ID, "unqualified_id"}.
+            Concurrent requests with the same options are analysed as one dataset.
+
+    Parameters:
+        host (str): Interface to listen on, localhost by default.
+        port (int): Port to listen on, 0 picks a free port.
+        workers (int): Number of batches computed at once. None uses the number of CPUs.
+        max_batch_size (int): Largest number of requests per engine call.
+        max_delay (float): Seconds a request waits for concurrent requests to batch with.
+        cache_size (int): Number of responses kept in the LRU result cache, 0 disables it.
+        verbose (bool): Log every request on stderr.
+        cache_bytes (int): Bytes of request keys and responses kept in the result cache.
+
+    Returns:
+        server (SimulationServer): The server, listening but not yet serving.
+    '''
+    batcher = MicroBatcher(workers, max_batch_size, max_delay)
+    return SimulationServer((host, port), batcher, ResultCache(cache_size, cache_bytes), verbose)
+
+
+def main(argv=None):
+    '''Entry point of "python -m pkpd_sian.service".'''
+    parser = argparse.ArgumentParser(prog='python -m pkpd_sian.service', description='Serve the simulation and analysis engines over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('-w', '--workers', type=int, help='Number of batches computed at once. Defaults to the number of CPUs.')
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-delay', type=float, default=0.005, help='Seconds a request waits for others to batch with.')
+    parser.add_argument('--cache-size', type=int, default=1024)
+    parser.add_argument('--cache-bytes', type=int, default=CACHE_MAX_BYTES, help='Bytes of requests and responses kept in the cache.')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    server = create_server(args.host, args.port, args.workers, args.max_batch_size, args.max_delay, args.cache_size, args.verbose,
+                           args.cache_bytes)
+    print(f'Serving on {server.url}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,20 +1,28 @@
 import numpy as np
 from scipy.integrate import odeint
-import plotly.graph_objects as go
-import streamlit as st
 import pandas as pd
-from scipy.stats import norm
 
+from pkpd_sian.profiling import count, profiled, span
+from pkpd_sian.regimen import Regimen
 
+# Upper bound on the size of the (patient, dose, time) block built at once by the regimen engine
+REGIMEN_BLOCK_ELEMENTS = 2 ** 22
+# Number of patients simulated between two progress reports of a population simulation
+PROGRESS_CHUNK_PATIENTS = 500
+
+
+@profiled('simulation.sampling')
 def _sample_lognormal(pop_value, omega, size):
     """Draw log-normally distributed samples shaped for broadcasting."""
-    draws = norm.rvs(loc=0, scale=omega, size=size)
+    # Same draws as scipy.stats.norm.rvs from the global random state, without importing scipy.stats
+    draws = np.random.standard_normal(size) * omega
     return (pop_value * np.exp(draws)).reshape(size, 1)
 
 
+@profiled('simulation.sampling')
 def _sample_normal(scale, size):
     """Draw normally distributed residuals shaped for broadcasting."""
-    draws = norm.rvs(loc=0, scale=scale, size=size)
+    draws = np.random.standard_normal(size) * scale
     return np.array(draws).reshape(size, 1)
 
 
@@ -43,7 +51,53 @@ def _peripheral_exchange(compartments, concentrations):
         flux += comp['k_out'] * concentrations[idx] - comp['k_in'] * concentrations[1]
     return flux
 
-def population_pk_simulation(parameters):
+
+def _regimen_profiles(regimen, time, ke, Vd, ka=None, scale=1.0):
+    """Per-dose one-compartment contributions shaped (..., n_doses, n_time); ke, Vd, ka and scale broadcast over the leading axes."""
+    ke, Vd, scale = (np.asarray(value, dtype=float)[..., None, None] for value in (ke, Vd, scale))
+    if ka is not None:
+        ka = np.asarray(ka, dtype=float)[..., None, None]
+    elapsed = np.asarray(time, dtype=float)[None, :] - regimen.times[:, None]
+    started = elapsed >= 0
+    elapsed = np.where(started, elapsed, 0.0)
+    dose = regimen.doses[:, None]
+    leading = [ke.shape, Vd.shape, scale.shape] + ([ka.shape] if ka is not None else [])
+    profiles = np.zeros(np.broadcast_shapes(*leading, elapsed.shape))
+
+    # One vectorized evaluation per dose type, never one per dose
+    bolus, infusion, non_iv = regimen.is_bolus, regimen.is_infusion, regimen.is_non_iv
+    if bolus.any():
+        profiles[..., bolus, :] = pk_iv_dose(dose[bolus], elapsed[bolus], ke, Vd)
+    if infusion.any():
+        durations = regimen.infusion_durations[infusion][:, None]
+        profiles[..., infusion, :] = pk_prolonged_iv_dose(dose[infusion], elapsed[infusion], ke, Vd, durations)
+    if non_iv.any():
+        if ka is None:
+            raise ValueError('ka must be defined to simulate non-IV doses.')
+        F = regimen.F[non_iv][:, None]
+        profiles[..., non_iv, :] = pk_non_iv_dose(dose[non_iv], F, elapsed[non_iv], ke, ka, Vd)
+
+    return profiles * started * scale
+
+
+@profiled('simulation.regimen_engine')
+def _regimen_total(regimen, time, ke, Vd, ka=None, scale=1.0):
+    """Sum the dose contributions, working through the doses in blocks of bounded size."""
+    time = np.asarray(time, dtype=float)
+    leading_shape = np.broadcast_shapes(np.shape(ke), np.shape(Vd), np.shape(scale), np.shape(ka) if ka is not None else ())
+    total = np.zeros(leading_shape + (time.size,))
+    chunk = max(1, REGIMEN_BLOCK_ELEMENTS // max(1, int(np.prod(leading_shape)) * time.size))
+    sorted_time = bool(np.all(np.diff(time) >= 0))
+    for start in range(0, len(regimen), chunk):
+        block = regimen[start:start + chunk]
+        # Time points before the earliest dose of the block receive nothing from it
+        first = np.searchsorted(time, block.times.min()) if sorted_time else 0
+        total[..., first:] += _regimen_profiles(block, time[first:], ke, Vd, ka, scale).sum(axis=-2)
+    return total
+
+
+@profiled('simulation.population_pk_simulation')
+def population_pk_simulation(parameters, plot=True, progress=None):
     '''This function helps to visulaized the PK profile of single dose using one-compartmental model.
     
     Parameters: 
@@ -62,16 +116,21 @@ def population_pk_simulation(parameters):
                 'C Limit': C_limit,
                 'sampling_points': sampling_points,
                 'logit':logit}
+            The Dose can also be a pkpd_sian.regimen.Regimen to simulate a whole dosing regimen for every patient.
+        plot (boolean): indicate if the profiles should be displayed with Streamlit. False only simulates, e.g. for batch jobs.
+        progress (callable): Called as progress(done, total) after the concentrations of every chunk of PROGRESS_CHUNK_PATIENTS patients,
+        e.g. by a background job. An exception raised by it stops the simulation. The population is the same with or without it.
+
     Returns: 
         df_C (PandasDataFrame): Concentration by Time Profile.
         df_C_ln (PandasDataFrame): Logarithm of Concentration by Time Profile.
         '''
 
     n_patients = parameters['Number of Patients']
+    count('simulation.patients', n_patients)
 
     # Defined time scale for the simulation
     sampling_points = np.arange(0, parameters['sampling_points'] + 0.1, 0.1)
-    time = np.array(sampling_points).reshape(1, len(sampling_points))
 
     # Sampling variability of PK parameters
     V_var = _sample_lognormal(parameters['Population Volume of Distribution'], parameters['Omega V'], n_patients)
@@ -83,56 +142,89 @@ def population_pk_simulation(parameters):
     # Sampling variability of residual error
     resid_var = _sample_normal(parameters['Sigma Residual'], n_patients)
 
+    # A single dose is treated as a one-entry regimen given at time 0
     dose = parameters['Dose']
     population_ka = parameters['Population ka']
-    if population_ka is None:
-        concentration = (dose * F_var / V_var) * np.exp(np.dot(-ke_var, time)) + resid_var
+    ka_var = None
+    if population_ka is not None:
+        ka_var = _sample_lognormal(population_ka, parameters['Omega ka'], n_patients)[:, 0]
+    if isinstance(dose, Regimen):
+        regimen = dose
     else:
-        ka_var = _sample_lognormal(population_ka, parameters['Omega ka'], n_patients)
-        concentration = (
-            (dose * F_var * ka_var) / (V_var * (ka_var - ke_var))
-            * (np.exp(np.dot(-ke_var, time)) - np.exp(np.dot(-ka_var, time)))
-            + resid_var
-        )
+        regimen = Regimen.single(dose, route='iv' if population_ka is None else 'non_iv')
+    if progress is None:
+        concentration = _regimen_total(
+            regimen, sampling_points, ke_var[:, 0], V_var[:, 0], ka_var, scale=F_var[:, 0]
+        ) + resid_var
+    else:
+        # Every parameter is drawn above, so only the concentrations are computed chunk by chunk to report the progress
+        concentration = np.empty((n_patients, sampling_points.size))
+        progress(0, n_patients)
+        for start in range(0, n_patients, PROGRESS_CHUNK_PATIENTS):
+            block = slice(start, min(start + PROGRESS_CHUNK_PATIENTS, n_patients))
+            concentration[block] = _regimen_total(
+                regimen, sampling_points, ke_var[block, 0], V_var[block, 0], None if ka_var is None else ka_var[block],
+                scale=F_var[block, 0]
+            ) + resid_var[block]
+            progress(block.stop, n_patients)
 
     # Generate the dataframe of the PK profile
-    rounded_sampling = np.round(sampling_points, 1)
-    df_C = pd.DataFrame(concentration, columns=rounded_sampling)
-    df_C.replace([np.inf, -np.inf], np.nan, inplace=True)
-    df_C_ln = pd.DataFrame(np.log(concentration), columns=rounded_sampling)
-    df_C_ln.replace([np.inf, -np.inf], np.nan, inplace=True)
+    with span('simulation.dataframe'):
+        rounded_sampling = np.round(sampling_points, 1)
+        df_C = pd.DataFrame(concentration, columns=rounded_sampling)
+        df_C.replace([np.inf, -np.inf], np.nan, inplace=True)
+        df_C_ln = pd.DataFrame(np.log(concentration), columns=rounded_sampling)
+        df_C_ln.replace([np.inf, -np.inf], np.nan, inplace=True)
 
     # Visualized Profile
-    fig = go.Figure()
-    plot_log = parameters['logit']
-    frame_to_plot = df_C_ln if plot_log else df_C
-    for i in range(n_patients):
-        fig.add_trace(
-            go.Scatter(x=sampling_points, y=frame_to_plot.iloc[i, :], mode='lines', showlegend=False)
-        )
-    fig.update_yaxes(
-        title_text='Log[Concentration] (mg/L)' if plot_log else 'Concentration (mg/L)'
-    )
-    if parameters['C Limit'] is not None:
-        limit_value = np.log(parameters['C Limit']) if plot_log else parameters['C Limit']
-        fig.add_hline(y=limit_value, line_dash="dash", line_color="red")
-    fig.update_xaxes(title_text='Time (h)')
-    fig.update_layout(title='PK simulation')
-
-    config = {
-        'toImageButtonOptions': {
-            'format': 'png',
-            'filename': 'PK_simulation',
-            'height': None,
-            'width': None,
-            'scale': 5
-        }}
-    st.plotly_chart(fig, config=config)
+    if plot:
+        population_pk_plot(df_C, df_C_ln, parameters)
 
     return df_C, df_C_ln
 
 
-def multiple_compartment_simulation(parameters, time, dose, F, iv):
+def population_pk_plot(df_C, df_C_ln, parameters):
+    '''This function helps to display the simulated PK profiles of a population with Streamlit.
+
+    Parameters:
+        df_C (PandasDataFrame): Concentration by Time Profile, as returned by population_pk_simulation.
+        df_C_ln (PandasDataFrame): Logarithm of Concentration by Time Profile.
+        parameters (dict): The simulation parameters, of which 'logit' and 'C Limit' are used.
+    '''
+    with span('simulation.plot'):
+        import plotly.graph_objects as go
+        import streamlit as st
+
+        sampling_points = df_C.columns.to_numpy()
+        fig = go.Figure()
+        plot_log = parameters['logit']
+        frame_to_plot = df_C_ln if plot_log else df_C
+        for i in range(len(frame_to_plot)):
+            fig.add_trace(
+                go.Scatter(x=sampling_points, y=frame_to_plot.iloc[i, :], mode='lines', showlegend=False)
+            )
+        fig.update_yaxes(
+            title_text='Log[Concentration] (mg/L)' if plot_log else 'Concentration (mg/L)'
+        )
+        if parameters['C Limit'] is not None:
+            limit_value = np.log(parameters['C Limit']) if plot_log else parameters['C Limit']
+            fig.add_hline(y=limit_value, line_dash="dash", line_color="red")
+        fig.update_xaxes(title_text='Time (h)')
+        fig.update_layout(title='PK simulation')
+
+        config = {
+            'toImageButtonOptions': {
+                'format': 'png',
+                'filename': 'PK_simulation',
+                'height': None,
+                'width': None,
+                'scale': 5
+            }}
+        with span('simulation.render'):
+            st.plotly_chart(fig, config=config)
+
+
+def multiple_compartment_simulation(parameters, time, dose, F, iv, infusion_duration=None):
     '''This function helps to visualize pharmacokinetic profile of single dose using multiple-comparmental model.
     
     Parameters: 
@@ -145,6 +237,7 @@ def multiple_compartment_simulation(parameters, time, dose, F, iv):
         dose (float): Dose Amount.
         conc_limit (float): A concentration limitation of the drug. 
         iv (boolean): indicate if the drug is iv or non-iv drug.
+        infusion_duration (float): Duration of a zero-order iv infusion starting at time 0. None means an iv bolus.
 
     Returns: 
         results (dict): A dictionary that contains the concentration by time profile for each compartment.
@@ -176,13 +269,24 @@ def multiple_compartment_simulation(parameters, time, dose, F, iv):
             derivatives[idx] = comp['k_in'] * concentrations[1] - comp['k_out'] * concentrations[idx]
         return derivatives
 
+    def general_model_infusion(concentrations, _t):
+        derivatives = general_model_iv(concentrations, _t)
+        # Zero-order input into the central compartment while the infusion runs
+        if _t < infusion_duration:
+            derivatives[1] += dose / (compartments[1]['V'] * infusion_duration)
+        return derivatives
+
     concentrations_initial = _initial_concentrations(compartments, dose, F, iv)
 
     # Simulation PK profile
-    if iv:
-        solution = odeint(general_model_iv, concentrations_initial, time)
-    else: 
-        solution = odeint(general_model_non_iv, concentrations_initial, time)
+    with span('simulation.ode_solve'):
+        if iv and infusion_duration is not None:
+            concentrations_initial[1] = 0.0
+            solution = odeint(general_model_infusion, concentrations_initial, time, tcrit=[infusion_duration])
+        elif iv:
+            solution = odeint(general_model_iv, concentrations_initial, time)
+        else:
+            solution = odeint(general_model_non_iv, concentrations_initial, time)
     
     # Re-organized the results into dictionary.
     results = {f'C{i}': solution[:, i] for i in range(n_compartments)}
@@ -190,7 +294,8 @@ def multiple_compartment_simulation(parameters, time, dose, F, iv):
     return results
 
 
-def population_pd_simulation(parameters):
+@profiled('simulation.population_pd_simulation')
+def population_pd_simulation(parameters, plot=True):
     '''This function helps to visulaized the PD profile of single dose.
     
     Parameters: 
@@ -207,6 +312,7 @@ def population_pd_simulation(parameters):
               'Number of Patients': n_patients,
               'E Limit': E_limit,
               'Sampling Conc': sampling_conc}
+        plot (boolean): indicate if the profiles should be displayed with Streamlit. False only simulates, e.g. for batch jobs.
 
     Returns: 
         E_df (PandasDataFrame): Effect by Concentration Profile.
@@ -224,25 +330,31 @@ def population_pd_simulation(parameters):
     E_array = (Ebaseline_var + Emax_var * (conc_list ** hill_var) / (EC50_var + conc_list)) + resid_var
     E_df = pd.DataFrame(E_array, columns=np.round(sampling_conc,1))
     
-    fig = go.Figure()
-    for i in range(n_patients):
-        pd_data = E_df.iloc[i, :]
-        fig.add_trace(go.Scatter(x=sampling_conc, y=pd_data, mode='lines', showlegend=False))
-    if parameters['E Limit'] is not None:
-        fig.add_hline(y=parameters['E Limit'], line_dash="dash", line_color="red")
-    fig.update_yaxes(title_text='Effect')
-    fig.update_xaxes(title_text='Concentration')
-    fig.update_layout(title='PD simulation')
-
-    config = {
-        'toImageButtonOptions': {
-            'format': 'png', 
-            'filename': 'PD_simulation',
-            'height': None,
-            'width': None,
-            'scale': 5
-        }}
-    st.plotly_chart(fig, config=config)
+    if plot:
+        with span('simulation.plot'):
+            import plotly.graph_objects as go
+            import streamlit as st
+
+            fig = go.Figure()
+            for i in range(n_patients):
+                pd_data = E_df.iloc[i, :]
+                fig.add_trace(go.Scatter(x=sampling_conc, y=pd_data, mode='lines', showlegend=False))
+            if parameters['E Limit'] is not None:
+                fig.add_hline(y=parameters['E Limit'], line_dash="dash", line_color="red")
+            fig.update_yaxes(title_text='Effect')
+            fig.update_xaxes(title_text='Concentration')
+            fig.update_layout(title='PD simulation')
+
+            config = {
+                'toImageButtonOptions': {
+                    'format': 'png', 
+                    'filename': 'PD_simulation',
+                    'height': None,
+                    'width': None,
+                    'scale': 5
+                }}
+            with span('simulation.render'):
+                st.plotly_chart(fig, config=config)
 
     return E_df
 
@@ -278,15 +390,11 @@ def pk_prolonged_iv_dose(dose, time, ke, Vd, infusion_duration):
         concentration (np.array): A concentration by time profile.
     '''
 
-    concentration = []
-    for time_point in time:
-        if time_point <= infusion_duration:
-            # During infusion
-            concentration.append((dose / (Vd * infusion_duration * ke)) * (1 - np.exp(-ke * time_point)))
-        else:
-            # After infusion
-            concentration.append((dose / (Vd * infusion_duration * ke)) * (1 - np.exp(-ke * infusion_duration)) * np.exp(-ke * (time_point - infusion_duration)))
-    return np.array(concentration)
+    # During infusion the concentration rises, after infusion it declines from the end-of-infusion level
+    elapsed_infusion = np.minimum(time, infusion_duration)
+    concentration = (dose / (Vd * infusion_duration * ke)) * (1 - np.exp(-ke * elapsed_infusion))
+    concentration = concentration * np.exp(-ke * np.maximum(time - infusion_duration, 0))
+    return np.asarray(concentration)
 
 
 def pk_non_iv_dose(dose, F, time, ke, ka, Vd):
@@ -307,3 +415,69 @@ def pk_non_iv_dose(dose, F, time, ke, ka, Vd):
     
     concentration = ((dose * F*ka)/(Vd*(ka-ke)))*(np.exp(-ke*time)-np.exp(-ka*time))
     return concentration
+
+
+def regimen_simulation(regimen, time, ke, Vd, ka=None, each_dose=False):
+    '''This function helps to simulate the PK profile of a whole dosing regimen using the one-compartmental model.
+    All doses of the same type (iv bolus, prolonged iv, non-iv) are evaluated together, and the profiles are superposed.
+
+    Parameters:
+        regimen (pkpd_sian.regimen.Regimen): The dosing regimen.
+        time (np.array): An array containing time points for the simulation.
+        ke (float): the elimination constant of the drug.
+        Vd (float): the volumns of distribution of the drug.
+        ka (float): the absorption constant of the drug. It is mandatory if the regimen has at least 1 non-iv dose.
+        each_dose (boolean): indicate if the contribution of each dose should be returned as well.
+
+    Returns:
+        concentration (np.array): The combined concentration by time profile.
+        dose_profiles (np.array): Only when each_dose is True, an array of shape (number of doses, number of time points) with the profile of each dose.
+    '''
+
+    if each_dose:
+        dose_profiles = _regimen_profiles(regimen, time, ke, Vd, ka)
+        return dose_profiles.sum(axis=0), dose_profiles
+    return _regimen_total(regimen, time, ke, Vd, ka)
+
+
+@profiled('simulation.multiple_compartment_regimen_simulation')
+def multiple_compartment_regimen_simulation(parameters, time, regimen):
+    '''This function helps to simulate a whole dosing regimen using the multiple-compartmental model.
+    The model is solved once for each distinct (route, dose, bioavailability, infusion duration) combination, at the times elapsed since
+    each of its doses, then the solutions are superposed. Doses given before time[0] are included.
+
+    Parameters:
+        parameters (dict): Compartment definitions, as in multiple_compartment_simulation.
+        time (np.array): An array that contain time points used to generate the profile.
+        regimen (pkpd_sian.regimen.Regimen): The dosing regimen, with iv boluses, iv infusions and non-iv doses.
+
+    Returns:
+        results (dict): A dictionary that contains the combined concentration by time profile for each compartment.
+    '''
+
+    if regimen.is_non_iv.any() and _ordered_compartments(parameters)[0]['k_out'] is None:
+        raise ValueError('ka must be defined to simulate non-IV doses.')
+
+    time = np.asarray(time, dtype=float)
+    results = {f'C{i}': np.zeros_like(time) for i in range(len(parameters))}
+
+    # Doses sharing route, amount, bioavailability and infusion duration (0 for the others) share one ODE solution
+    effective_F = np.where(regimen.is_iv, 1.0, regimen.F)
+    durations = np.where(regimen.is_infusion, regimen.infusion_durations, 0.0)
+    keys = np.column_stack([regimen.routes, regimen.doses, effective_F, durations])
+    unique_keys, group = np.unique(keys, axis=0, return_inverse=True)
+    group = group.ravel()
+    for code, (route, dose, F, duration) in enumerate(unique_keys):
+        elapsed = time[None, :] - regimen.times[group == code][:, None]
+        started = elapsed >= 0
+        if not started.any():
+            continue
+        # Solve on every elapsed time, so that no dose is read off the end of the solution or interpolated
+        solve_time = np.union1d(0.0, elapsed[started])
+        response = multiple_compartment_simulation(parameters, solve_time, dose, F, iv=route == 0,
+                                                   infusion_duration=duration if duration > 0 else None)
+        position = np.searchsorted(solve_time, np.where(started, elapsed, 0.0))
+        for compartment, values in response.items():
+            results[compartment] += (values[position] * started).sum(axis=0)
+
+    return results
@@ -0,0 +1,143 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from pkpd_sian.preprocessing import PKDataset
+
+
+# Key of the ID and Dose offset index in the schema metadata of a study file
+INDEX_KEY = b'pkpd_sian.index'
+
+
+def _pyarrow():
+    """Import pyarrow on first use, it is only needed for the study files."""
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc
+    except ImportError as error:
+        raise ImportError('Study files need pyarrow, install it with "pip install pyarrow".') from error
+    return pa
+
+
+def simulation_to_long(df_C, dose):
+    '''This function helps to convert a simulated population (one row per patient, one column per time point) into the long format
+    used by the analysis, with one row per patient and time point.
+
+    Parameters:
+        df_C (PandasDataFrame): Concentration by Time Profile, e.g. from pkpd_sian.simulation.population_pk_simulation.
+        dose (float): The dose given to every patient.
+
+    Returns:
+        df (PandasDataFrame): A data frame with the columns "ID" (from 1), "Time", "Conc" and "Dose".
+    '''
+    concentration = df_C.to_numpy(dtype=float)
+    n_patients, n_times = concentration.shape
+    return pd.DataFrame({
+        'ID': np.repeat(np.arange(1, n_patients + 1), n_times),
+        'Time': np.tile(df_C.columns.to_numpy(dtype=float), n_patients),
+        'Conc': concentration.ravel(),
+        'Dose': dose,
+    })
+
+
+def write_study(data, file=None):
+    '''This function helps to save a dataset in the columnar study format (an Arrow IPC file).
+    The rows are stored sorted as in PKDataset, and the offsets of every ID and Dose are embedded in the file metadata,
+    so a subject or a dose group can later be read without loading the rest of the file.
+
+    Parameters:
+        data (PandasDataFrame or PKDataset): The dataset with the unified columns' names ("ID", "Time", "Conc", "Dose", and covariates).
+        file (str, Path or file-like): Where to write the study. None returns the file content as bytes, e.g. for st.download_button.
+
+    Returns:
+        content (bytes): The file content when file is None.
+    '''
+    pa = _pyarrow()
+    dataset = data if isinstance(data, PKDataset) else PKDataset(data)
+    index = {
+        'ids': dataset.ids.tolist(),
+        'id_starts': dataset.id_starts.tolist(),
+        'id_counts': dataset.id_counts.tolist(),
+        'doses': dataset.doses.tolist(),
+        'dose_starts': dataset.dose_starts.tolist(),
+        'dose_counts': dataset.dose_counts.tolist(),
+    }
+    table = pa.Table.from_pandas(dataset.frame, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), INDEX_KEY: json.dumps(index).encode()})
+
+    sink = pa.BufferOutputStream() if file is None else file
+    if isinstance(sink, (str, Path)):
+        sink = str(sink)
+    with pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    if file is None:
+        return sink.getvalue().to_pybytes()
+
+
+class StudyFile:
+    '''A study opened with open_study. The columns stay in the (memory-mapped) file until a slice of them is converted to pandas.
+
+    Attributes:
+        ids, id_starts, id_counts (NumPy array): The IDs and the offsets of their rows.
+        doses, dose_starts, dose_counts (NumPy array): The doses and the offsets of the rows of their individuals.
+    '''
+
+    def __init__(self, table):
+        self.table = table
+        index = json.loads(table.schema.metadata[INDEX_KEY])
+        self.ids = np.asarray(index['ids'])
+        self.id_starts = np.asarray(index['id_starts'], dtype=np.int64)
+        self.id_counts = np.asarray(index['id_counts'], dtype=np.int64)
+        self.doses = np.asarray(index['doses'])
+        self.dose_starts = np.asarray(index['dose_starts'], dtype=np.int64)
+        self.dose_counts = np.asarray(index['dose_counts'], dtype=np.int64)
+        self._id_index = {id: i for i, id in enumerate(index['ids'])}
+        self._dose_index = {dose: i for i, dose in enumerate(index['doses']) if dose == dose}
+
+    def __len__(self):
+        return self.table.num_rows
+
+    @property
+    def columns(self):
+        return self.table.column_names
+
+    def subject(self, id):
+        '''This function helps to read the rows of one individual, sorted by time.'''
+        i = self._id_index[id]
+        return self.table.slice(self.id_starts[i], self.id_counts[i]).to_pandas()
+
+    def dose_group(self, dose):
+        '''This function helps to read the rows of the individuals who received the given dose.'''
+        i = self._dose_index[dose]
+        return self.table.slice(self.dose_starts[i], self.dose_counts[i]).to_pandas()
+
+    def to_pandas(self, columns=None):
+        '''This function helps to read the whole study, or only the given columns, as a data frame.'''
+        table = self.table if columns is None else self.table.select(columns)
+        return table.to_pandas()
+
+    def to_dataset(self):
+        '''This function helps to read the whole study as a PKDataset.'''
+        return PKDataset(self.to_pandas())
+
+
+def open_study(file):
+    '''This function helps to open a study written by write_study.
+    A path is memory-mapped, so opening the file only reads its metadata, whatever the number of rows.
+
+    Parameters:
+        file (str, Path, bytes or file-like): The study file, e.g. the output of st.file_uploader.
+
+    Returns:
+        study (StudyFile): The opened study.
+    '''
+    pa = _pyarrow()
+    if isinstance(file, (str, Path)):
+        source = pa.memory_map(str(file), 'r')
+    elif isinstance(file, (bytes, bytearray, memoryview)):
+        source = pa.BufferReader(file)
+    else:
+        source = pa.BufferReader(file.read())
+    return StudyFile(pa.ipc.open_file(source).read_all())
@@ -1,11 +1,121 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
 import streamlit as st
 import plotly.graph_objects as go
 import plotly.express as px
+import numpy as np
 import pandas as pd
 
+from pkpd_sian.preprocessing import PKDataset
+from pkpd_sian.profiling import count, span
+
+
+# Above this many points a scatter plot switches to WebGL and is decimated on the server
+MAX_SCATTER_POINTS = 20000
+DECIMATION_GRID = (400, 200)
+SUMMARY_MAX_TIMES = 100
+# Number of sorted columns kept for rebinning the histograms, and of built figures kept for relabeling
+SORTED_CACHE_SIZE = 32
+FIGURE_CACHE_SIZE = 64
+
+# The caches are shared by the script threads of every session, every access to them holds the lock
+_cache_lock = threading.Lock()
+_sorted_columns = OrderedDict()
+_figures = OrderedDict()
+
+
+def _fingerprint(*arrays):
+    """Short digest of the content, dtype and shape of arrays, used as a cache key."""
+    digest = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(f'{array.dtype.str}{array.shape}'.encode())
+        if array.dtype.kind == 'O':
+            array = pd.util.hash_pandas_object(pd.Series(array.ravel()), index=False).to_numpy()
+        digest.update(array.view(np.uint8))
+    return digest.hexdigest()
+
+
+def _frame_fingerprint(df, columns):
+    """Fingerprint of the given columns of a data frame."""
+    return _fingerprint(pd.util.hash_pandas_object(df[list(columns)], index=False).to_numpy())
+
+
+def _cached_figure(key, build):
+    """Return the figure built for key (data fingerprint and plot spec), building it with build() on the first request only."""
+    with _cache_lock:
+        fig = _figures.get(key)
+        if fig is not None:
+            _figures.move_to_end(key)
+    if fig is not None:
+        count('visualization.figure_cache_hits')
+        return fig
+    count('visualization.figure_cache_misses')
+    with span('visualization.figure_build'):
+        fig = build()
+    with _cache_lock:
+        _figures[key] = fig
+        _figures.move_to_end(key)
+        if len(_figures) > FIGURE_CACHE_SIZE:
+            _figures.popitem(last=False)
+    return fig
+
+
+class _FigureSpec(go.Figure):
+    """Figure given by its cached dictionary, which st.plotly_chart serializes as is instead of building and validating it again."""
+
+    def __init__(self, spec):
+        super().__init__()
+        self._spec = spec
+
+    def to_dict(self):
+        return self._spec
+
+
+def _labelled_spec(spec, title, xlabel, ylabel):
+    """Figure dictionary with the given title and axis labels, sharing the traces and the rest of the layout with spec."""
+    layout = dict(spec.get('layout', {}))
+    layout['title'] = {**layout.get('title', {}), 'text': title}
+    for axis, label in (('xaxis', xlabel), ('yaxis', ylabel)):
+        layout[axis] = {**layout.get(axis, {}), 'title': {**layout.get(axis, {}).get('title', {}), 'text': label}}
+    return {'data': spec['data'], 'layout': layout}
+
+
+def _sorted_column(values):
+    """Finite values of a column in ascending order, cached on the content of the column."""
+    key = _fingerprint(values)
+    with _cache_lock:
+        sorted_values = _sorted_columns.get(key)
+        if sorted_values is not None:
+            _sorted_columns.move_to_end(key)
+            return sorted_values
+    count('visualization.sorted_column_misses')
+    sorted_values = np.sort(values[np.isfinite(values)])
+    with _cache_lock:
+        _sorted_columns[key] = sorted_values
+        _sorted_columns.move_to_end(key)
+        if len(_sorted_columns) > SORTED_CACHE_SIZE:
+            _sorted_columns.popitem(last=False)
+    return sorted_values
+
+
+def _histogram(sorted_values, nbins):
+    """Counts of nbins equal-width bins over the range of sorted values, from searchsorted on the bin edges."""
+    nbins = max(int(nbins), 1)
+    low, high = (sorted_values[0], sorted_values[-1]) if sorted_values.size else (0.0, 1.0)
+    if high <= low:
+        low, high = low - 0.5, high + 0.5
+    edges = np.linspace(low, high, nbins + 1)
+    # Bins are closed on the left, the last one also on the right as in np.histogram
+    positions = np.searchsorted(sorted_values, edges[1:-1], side='left')
+    counts = np.diff(np.concatenate(([0], positions, [sorted_values.size])))
+    return counts, edges
 
-def _editable_plot(fig, *, default_title, default_xlabel, default_ylabel, key_prefix, filename):
-    """Render a chart with text inputs that immediately update axis labels."""
+
+def _editable_plot(spec, *, default_title, default_xlabel, default_ylabel, key_prefix, filename):
+    """Render a chart from its cached figure dictionary once, below it the text inputs that set its title and axis labels."""
     config = {
         'toImageButtonOptions': {
             'format': 'png',
@@ -15,9 +125,8 @@ def _editable_plot(fig, *, default_title, default_xlabel, default_ylabel, key_pr
             'scale': 5
         }
     }
+    # Read the labels first and patch only the layout, the chart is then drawn in the placeholder above the inputs
     placeholder = st.empty()
-    placeholder.plotly_chart(fig, use_container_width=True, config=config, key=f'{key_prefix}_initial')
-
     plot_title = st.text_input('Edit plot title:', value=default_title, key=f'{key_prefix}_title')
     col_left, col_right = st.columns(2)
     with col_left:
@@ -25,8 +134,10 @@ def _editable_plot(fig, *, default_title, default_xlabel, default_ylabel, key_pr
     with col_right:
         ylabel = st.text_input('Edit y label:', value=default_ylabel, key=f'{key_prefix}_ylabel')
 
-    fig.update_layout(title=plot_title, xaxis_title=xlabel, yaxis_title=ylabel)
-    placeholder.plotly_chart(fig, use_container_width=True, config=config, key=f'{key_prefix}_updated')
+    # The cached dictionary is shared between sessions, so the labels go on a copy of its layout and the traces are not copied
+    with span('visualization.render'):
+        placeholder.plotly_chart(_FigureSpec(_labelled_spec(spec, plot_title, xlabel, ylabel)), use_container_width=True, config=config,
+                                 key=f'{key_prefix}_chart')
 
 
 def distribution_plots(data,x,xlabel,ylabel,title):
@@ -41,9 +152,12 @@ def distribution_plots(data,x,xlabel,ylabel,title):
 
     st.subheader(title)
     nbins = st.slider(f'Edit the number of bins for {x} distribution:',value = 20)
-    fig = px.histogram(data, x=x,nbins=nbins)
-    fig.update_traces(marker_line_color='black', marker_line_width=1)
-    fig.update_layout(title=title, xaxis_title=xlabel, yaxis_title=ylabel)
+
+    # Bin on the server from the cached sorted column, only the bar heights go to the browser
+    values = pd.to_numeric(data[x], errors='coerce').to_numpy(dtype=float)
+    counts, edges = _histogram(_sorted_column(values), nbins)
+    fig = go.Figure(go.Bar(x=(edges[:-1] + edges[1:]) / 2, y=counts, width=np.diff(edges), marker_line_color='black', marker_line_width=1))
+    fig.update_layout(title=title, xaxis_title=xlabel, yaxis_title=ylabel, bargap=0)
     config_dis = {
         'toImageButtonOptions': {
         'format': 'png', 
@@ -51,7 +165,8 @@ def distribution_plots(data,x,xlabel,ylabel,title):
         'height': None,
         'width': None,
         'scale': 5 }}
-    plot = st.plotly_chart(fig, use_container_width=True, config = config_dis)
+    with span('visualization.render'):
+        plot = st.plotly_chart(fig, use_container_width=True, config = config_dis)
 
 
 def id_count_by_dose(df,gender):
@@ -64,18 +179,22 @@ def id_count_by_dose(df,gender):
     if gender: 
         # Hanlding data
         st.subheader('Number of ID by Dose and Gender')
-        id_count_df = df.groupby(['Dose','Gender'])['ID'].nunique().reset_index(name='ID_count')
-        id_count_df['Dose'] = id_count_df['Dose'].astype(str)+'mg' # Turn dose into category for better visualization
-        id_count_df['Gender'] = id_count_df['Gender'].astype(str)
-
-        # Draw the plot
         default_plot_title = 'Number of ID by Dose and Gender'
         default_xlabel = 'ID Counts'
         default_ylabel = 'Dose'
-        fig = px.bar( id_count_df, x='ID_count', y='Dose', color='Gender', orientation='h',title = default_plot_title)
-        fig.update_layout(xaxis_title=default_xlabel, yaxis_title=default_ylabel, legend_title_text='Gender')
+
+        def build():
+            id_count_df = df.groupby(['Dose','Gender'])['ID'].nunique().reset_index(name='ID_count')
+            id_count_df['Dose'] = id_count_df['Dose'].astype(str)+'mg' # Turn dose into category for better visualization
+            id_count_df['Gender'] = id_count_df['Gender'].astype(str)
+            fig = px.bar( id_count_df, x='ID_count', y='Dose', color='Gender', orientation='h',title = default_plot_title)
+            fig.update_layout(legend_title_text='Gender')
+            return fig
+
+        # Draw the plot, the grouping and the validation of the figure only run when the data change
+        spec = _cached_figure((_frame_fingerprint(df, ['ID', 'Dose', 'Gender']), 'id_count_by_dose', True), lambda: build().to_dict())
         _editable_plot(
-            fig,
+            spec,
             default_title=default_plot_title,
             default_xlabel=default_xlabel,
             default_ylabel=default_ylabel,
@@ -86,17 +205,19 @@ def id_count_by_dose(df,gender):
     else:
         # Handling data: 
         st.subheader('Number of ID by Dose')
-        id_count_df = df.groupby('Dose')['ID'].nunique().reset_index(name='ID_count')
-        id_count_df['Dose'] = 'Dose ' + id_count_df['Dose'].astype(str) # Turn dose into category for better visualization
-
-        # Draw plot
         default_plot_title = 'Number of ID by Dose'
         default_xlabel = 'ID Counts'
         default_ylabel = 'Dose'
-        fig = px.bar(id_count_df, x='ID_count', y='Dose', orientation='h',color = 'Dose', title = default_plot_title ,color_discrete_sequence=px.colors.qualitative.Safe)
-        fig.update_layout(xaxis_title=default_xlabel, yaxis_title=default_ylabel)
+
+        def build():
+            id_count_df = df.groupby('Dose')['ID'].nunique().reset_index(name='ID_count')
+            id_count_df['Dose'] = 'Dose ' + id_count_df['Dose'].astype(str) # Turn dose into category for better visualization
+            return px.bar(id_count_df, x='ID_count', y='Dose', orientation='h',color = 'Dose', title = default_plot_title ,color_discrete_sequence=px.colors.qualitative.Safe)
+
+        # Draw plot, the grouping and the validation of the figure only run when the data change
+        spec = _cached_figure((_frame_fingerprint(df, ['ID', 'Dose']), 'id_count_by_dose', False), lambda: build().to_dict())
         _editable_plot(
-            fig,
+            spec,
             default_title=default_plot_title,
             default_xlabel=default_xlabel,
             default_ylabel=default_ylabel,
@@ -105,18 +226,70 @@ def id_count_by_dose(df,gender):
         )
 
 
-def pk_profile_by_dose(df):
+def _decimate(x, y, grid=DECIMATION_GRID):
+    """Keep one point per occupied cell of a grid over the plot area, which preserves the shape of a dense scatter."""
+    finite = np.isfinite(x) & np.isfinite(y)
+    rows = np.flatnonzero(finite)
+    cells = []
+    for values, n_bins in zip((x[rows], y[rows]), grid):
+        low, high = values.min(initial=0.0), values.max(initial=0.0)
+        extent = high - low if high > low else 1.0
+        cells.append(np.minimum(((values - low) / extent * n_bins).astype(np.int64), n_bins - 1))
+    _, first = np.unique(cells[0] * grid[1] + cells[1], return_index=True)
+    return rows[np.sort(first)]
+
+
+def _percentile_summary(time, conc, percentiles=(5, 50, 95)):
+    """Percentiles of the concentration at each nominal time; many distinct times are grouped in equal-width time bins."""
+    finite = np.isfinite(time) & np.isfinite(conc)
+    time, conc = time[finite], conc[finite]
+    nominal = np.unique(time)
+    if nominal.size > SUMMARY_MAX_TIMES:
+        edges = np.linspace(nominal[0], nominal[-1], SUMMARY_MAX_TIMES + 1)
+        time = np.clip(np.searchsorted(edges, time, side='right') - 1, 0, SUMMARY_MAX_TIMES - 1)
+        time = (edges[time] + edges[time + 1]) / 2
+    summary = pd.Series(conc).groupby(time).quantile(np.asarray(percentiles) / 100).unstack()
+    summary.columns = list(percentiles)
+    return summary
+
+
+def _dose_profile_figure(dose, dose_specific_df, summary, max_points):
+    """Scatter plot of the observations of one dose group, decimated and drawn with WebGL when it is large."""
+    if len(dose_specific_df) <= max_points:
+        fig = px.scatter(dose_specific_df, x='Time', y='Conc', title=f'Dose: {dose}')
+    else:
+        time = dose_specific_df['Time'].to_numpy(dtype=float)
+        conc = dose_specific_df['Conc'].to_numpy(dtype=float)
+        kept = _decimate(time, conc)
+        fig = go.Figure(go.Scattergl(x=time[kept], y=conc[kept], mode='markers', marker=dict(size=4, opacity=0.6), showlegend=False))
+        fig.update_layout(title=f'Dose: {dose} ({kept.size} of {len(dose_specific_df)} points shown)', xaxis_title='Time', yaxis_title='Conc')
+    if summary:
+        percentiles = _percentile_summary(dose_specific_df['Time'].to_numpy(dtype=float), dose_specific_df['Conc'].to_numpy(dtype=float))
+        fig.add_trace(go.Scatter(x=percentiles.index, y=percentiles[95], mode='lines', line=dict(width=0), showlegend=False, hoverinfo='skip'))
+        fig.add_trace(go.Scatter(x=percentiles.index, y=percentiles[5], mode='lines', line=dict(width=0), fill='tonexty',
+                                 fillcolor='rgba(239, 85, 59, 0.2)', name='5th-95th percentile'))
+        fig.add_trace(go.Scatter(x=percentiles.index, y=percentiles[50], mode='lines', line=dict(color='#EF553B'), name='Median'))
+    return fig
+
+
+def pk_profile_by_dose(df, summary=False, max_points=MAX_SCATTER_POINTS):
     '''This function helps to visualize the pharmacokinetic profile of each dose.
+    Large dose groups are drawn with WebGL after a server-side decimation, which keeps one observation per cell of a fine grid,
+    so the figures stay light whatever the size of the study.
+
     Parameters:
-        df (PandasDataFrame): the preprocessed dataframe by pkpd_sian.preprocessing.data_preprocessing function.
+        df (PandasDataFrame or PKDataset): the preprocessed dataframe by pkpd_sian.preprocessing.data_preprocessing function.
+        summary (boolean): indicate if the median and the 90% interval of the concentration at each nominal time should be drawn.
+        max_points (int): number of observations above which a dose group is decimated and drawn with WebGL.
     '''
 
     st.title('PK Profile by Dose')
     col1, col2 = st.columns(2)
-    unique_doses = df['Dose'].unique()
-    for i, dose in enumerate(unique_doses):
-        dose_specific_df = df[df['Dose']==dose]
-        fig = px.scatter(dose_specific_df, x='Time', y='Conc', title=f'Dose: {dose}')
+    dataset = df if isinstance(df, PKDataset) else PKDataset(df)
+    for i, (dose, dose_specific_df) in enumerate(dataset.iter_doses()):
+        # Rebuild the figure only when the observations of the dose group or the options change
+        key = (_frame_fingerprint(dose_specific_df, ['Time', 'Conc']), 'pk_profile_by_dose', dose, summary, max_points)
+        fig = _FigureSpec(_cached_figure(key, lambda: _dose_profile_figure(dose, dose_specific_df, summary, max_points).to_dict()))
         config_dose_profile = {
             'toImageButtonOptions': {
             'format': 'png', 
@@ -125,10 +298,11 @@ def pk_profile_by_dose(df):
             'width': None,
             'scale': 5 }}
             # Plot on 2-column page layout
-        if i % 2 == 0:
-            with col1:
-                st.plotly_chart(fig,config = config_dose_profile)
-        else:
-            with col2:
-                st.plotly_chart(fig,config = config_dose_profile)
+        with span('visualization.render'):
+            if i % 2 == 0:
+                with col1:
+                    st.plotly_chart(fig,config = config_dose_profile)
+            else:
+                with col2:
+                    st.plotly_chart(fig,config = config_dose_profile)
         
@@ -0,0 +1,183 @@
+import numpy as np
+import pandas as pd
+
+from pkpd_sian.analysis import (
+    EPSILON,
+    MIN_TIME_POINTS,
+    _bateman,
+    _bateman_jacobian,
+    multiple_dose_non_compartmental_analysis,
+    non_compartmental_analysis,
+    non_compartmental_batch_plots,
+    one_compartmental_batch_fit,
+    one_compartmental_im_analysis,
+)
+
+
+def _incremental_search(time, log_conc):
+    r2_list, slope_list = [], []
+    for n_points in range(MIN_TIME_POINTS, time.size + 1):
+        X = time[-n_points:]
+        Y = log_conc[-n_points:]
+        slope, intercept = np.polyfit(X, Y, 1)
+        ss_res = np.sum((Y - (intercept + slope * X)) ** 2)
+        ss_tot = np.sum((Y - Y.mean()) ** 2)
+        # A constant response fitted perfectly has an R2 of 1, as in the analysis
+        r2_list.append(1 - ss_res / ss_tot if ss_tot > 0 else float(ss_res == 0))
+        slope_list.append(slope)
+    best = int(np.argmax(r2_list))
+    return slope_list[best], r2_list[best], best + MIN_TIME_POINTS
+
+
+def _synthetic_study(n_subjects, seed=7):
+    rng = np.random.default_rng(seed)
+    frames = []
+    for subject in range(n_subjects):
+        time = np.sort(rng.uniform(0, 48, size=rng.integers(1, 40)))
+        conc = 5 * np.exp(-0.15 * time) * rng.lognormal(0, 0.05, time.size)
+        frames.append(pd.DataFrame({'ID': subject + 1, 'Time': time, 'Conc': conc, 'Dose': 100}))
+    # Shuffle rows so the analysis has to regroup and sort them itself
+    return pd.concat(frames).sample(frac=1, random_state=seed)
+
+
+def test_non_compartmental_analysis_matches_incremental_regressions():
+    df = _synthetic_study(40)
+    results, unqualified_id = non_compartmental_analysis(df)
+
+    counts = df.groupby('ID').size()
+    assert sorted(unqualified_id) == sorted(counts[counts < MIN_TIME_POINTS].index)
+    for _, row in results.iterrows():
+        profile = df[df['ID'] == row['ID']].sort_values('Time')
+        time = profile['Time'].to_numpy()
+        slope, r2, n_points = _incremental_search(time, np.log(profile['Conc'].to_numpy() + EPSILON))
+        assert row['Number of Lambda Points'] == n_points
+        np.testing.assert_allclose([-row['Slope'], row['R2 Values']], [slope, r2], rtol=1e-9, atol=1e-12)
+        np.testing.assert_allclose(row['AUC_0-last'], np.trapezoid(profile['Conc'], time))
+
+
+def test_rows_with_missing_values_are_dropped():
+    df = _synthetic_study(5)
+    df.loc[df.index[:3], 'Conc'] = np.nan
+    results, _ = non_compartmental_analysis(df)
+    expected, _ = non_compartmental_analysis(df.dropna())
+    pd.testing.assert_frame_equal(results.sort_values('ID').reset_index(drop=True), expected.sort_values('ID').reset_index(drop=True))
+
+
+def test_bateman_jacobian_matches_finite_differences():
+    time = np.linspace(0.25, 24, 12)
+    params = np.array([1.3, 0.2, 30.0])
+    jacobian = _bateman_jacobian(time, *params, F=0.8, dose=100)
+    for k in range(3):
+        step = np.zeros(3)
+        step[k] = 1e-6 * params[k]
+        numeric = (_bateman(time, *(params + step), 0.8, 100) - _bateman(time, *(params - step), 0.8, 100)) / (2 * step[k])
+        np.testing.assert_allclose(jacobian[:, k], numeric, rtol=1e-5, atol=1e-10)
+
+
+def test_im_analysis_recovers_parameters_without_user_guesses():
+    time = np.array([0.25, 0.5, 1, 2, 3, 4, 6, 8, 12, 16, 24.0])
+    frames = []
+    for subject, (ka, ke, V) in enumerate([(1.2, 0.15, 30.0), (0.8, 0.1, 45.0), (2.5, 0.3, 20.0)]):
+        conc = _bateman(time, ka, ke, V, 0.9, 100)
+        frames.append(pd.DataFrame({'ID': subject, 'Time': time, 'Conc': conc, 'Dose': 100}))
+    results, unqualified_id = one_compartmental_im_analysis(pd.concat(frames), predefined_F=0.9, n_jobs=1)
+
+    assert unqualified_id == []
+    np.testing.assert_allclose(results[['ka', 'ke', 'Vd']], [[1.2, 0.15, 30.0], [0.8, 0.1, 45.0], [2.5, 0.3, 20.0]], rtol=1e-6)
+    np.testing.assert_allclose(results['AUC_0-inf'], 0.9 * 100 / (results['Vd'] * results['ke']))
+
+
+def test_batch_fit_recovers_both_models_for_all_individuals():
+    time = np.array([0.25, 0.5, 1, 2, 3, 4, 6, 8, 12, 16, 24.0])
+    true_params = np.array([(1.2, 0.15, 30.0), (0.8, 0.1, 45.0), (2.5, 0.3, 20.0)])
+    absorption = pd.concat(
+        pd.DataFrame({'ID': subject, 'Time': time, 'Conc': _bateman(time, *params, 0.9, 100), 'Dose': 100})
+        for subject, params in enumerate(true_params)
+    )
+    iv = pd.concat(
+        pd.DataFrame({'ID': subject, 'Time': time, 'Conc': 100 / V * np.exp(-ke * time), 'Dose': 100})
+        for subject, (_, ke, V) in enumerate(true_params)
+    )
+
+    results, unqualified_id = one_compartmental_batch_fit(absorption, model='absorption', predefined_F=0.9)
+    assert unqualified_id == []
+    np.testing.assert_allclose(results[['ka', 'ke', 'Vd']], true_params, rtol=1e-6)
+
+    results, unqualified_id = one_compartmental_batch_fit(iv, model='iv')
+    assert unqualified_id == []
+    np.testing.assert_allclose(results[['ke', 'Vd']], true_params[:, 1:], rtol=1e-6)
+
+    batch, _ = one_compartmental_im_analysis(absorption, predefined_F=0.9, solver='batch')
+    single, _ = one_compartmental_im_analysis(absorption, predefined_F=0.9, n_jobs=1)
+    pd.testing.assert_frame_equal(batch, single, rtol=1e-6)
+
+
+def test_extended_nca_metrics_match_per_subject_formulas():
+    df = _synthetic_study(20)
+    for auc_method in ('linear', 'linear-up/log-down'):
+        results, _ = non_compartmental_analysis(df, extended=True, auc_method=auc_method)
+        for _, row in results.iterrows():
+            profile = df[df['ID'] == row['ID']].sort_values('Time')
+            t, c = profile['Time'].to_numpy(), profile['Conc'].to_numpy()
+            auc, aumc = 0.0, 0.0
+            for i in range(t.size - 1):
+                dt = t[i + 1] - t[i]
+                if auc_method == 'linear-up/log-down' and 0 < c[i + 1] < c[i]:
+                    k = np.log(c[i] / c[i + 1]) / dt
+                    auc += (c[i] - c[i + 1]) / k
+                    aumc += (t[i] * c[i] - t[i + 1] * c[i + 1]) / k + (c[i] - c[i + 1]) / k ** 2
+                else:
+                    auc += dt * (c[i] + c[i + 1]) / 2
+                    aumc += dt * (t[i] * c[i] + t[i + 1] * c[i + 1]) / 2
+            lambda_z = row['Slope']
+            auc_inf = auc + c[-1] / lambda_z
+            aumc_inf = aumc + c[-1] * t[-1] / lambda_z + c[-1] / lambda_z ** 2
+            np.testing.assert_allclose(
+                [row['AUC_0-last'], row['AUMC_0-inf'], row['MRT'], row['Vz'], row['Vss'], row['Cmax'], row['Tlast']],
+                [auc, aumc_inf, aumc_inf / auc_inf, 100 / (auc_inf * lambda_z), 100 / auc_inf * aumc_inf / auc_inf, c.max(), t[-1]],
+                rtol=1e-9,
+            )
+
+
+def test_multiple_dose_nca_partitions_dosing_intervals():
+    tau, ka, ke, V = 12.0, 1.0, 0.1, 20.0
+    time = np.arange(0, 10 * tau + 1, 0.5)
+    # Superposed oral doses of 100 every tau hours, sampled every half hour including every dose time (pre-dose samples)
+    conc = sum(np.where(time >= k * tau, _bateman(time - k * tau, ka, ke, V, 1.0, 100), 0.0) for k in range(10))
+    df = pd.DataFrame({'ID': np.repeat([1, 2], time.size), 'Time': np.tile(time, 2), 'Conc': np.tile(conc, 2), 'Dose': 100})
+
+    results, unqualified_id = multiple_dose_non_compartmental_analysis(df.sample(frac=1, random_state=0), tau, n_doses=10)
+
+    assert unqualified_id == []
+    assert results.groupby('ID')['Interval'].apply(list).tolist() == [list(range(1, 11))] * 2
+    assert (results['Number of Points'] == 25).all()
+    first = results[(results['ID'] == 1) & (results['Interval'] == 1)].iloc[0]
+    in_interval = (time >= 0) & (time <= tau)
+    np.testing.assert_allclose(first['AUC_tau'], np.trapezoid(conc[in_interval], time[in_interval]))
+    # At steady state the interval AUC approaches Dose / CL
+    last = results[(results['ID'] == 1) & (results['Interval'] == 10)].iloc[0]
+    np.testing.assert_allclose(last['AUC_tau'], 100 / (ke * V), rtol=0.01)
+    np.testing.assert_allclose(last['Accumulation Ratio'], last['AUC_tau'] / first['AUC_tau'])
+    np.testing.assert_allclose(last['Fluctuation (%)'], 100 * (last['Cmax'] - last['Cmin']) / (last['AUC_tau'] / tau))
+
+
+def test_batch_plots_draw_the_stored_regression_lines():
+    df = _synthetic_study(30)
+    results, _ = non_compartmental_analysis(df)
+    fig = non_compartmental_batch_plots(df, results, page=1, page_size=4)
+
+    assert len(fig.data) == 3 * 4
+    row = results.iloc[4]
+    profile = df[df['ID'] == row['ID']].sort_values('Time')
+    line = fig.data[2]
+    np.testing.assert_allclose(line.x, profile['Time'].to_numpy()[[-int(row['Number of Lambda Points']), -1]])
+    np.testing.assert_allclose(line.y, row['Intercept'] - row['Slope'] * np.asarray(line.x))
+
+
+def test_batch_plots_keep_zero_concentrations_on_the_regression_scale():
+    df = pd.DataFrame({'ID': 1, 'Time': [0.0, 1.0, 2.0, 4.0, 8.0], 'Conc': [0.0, 4.0, 3.0, 1.5, 0.4], 'Dose': 100})
+    results, _ = non_compartmental_analysis(df)
+    fig = non_compartmental_batch_plots(df, results)
+
+    np.testing.assert_allclose(fig.data[0].y, np.log(df['Conc'] + EPSILON))
+    assert np.all(np.isfinite(fig.data[0].y))
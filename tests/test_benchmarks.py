@@ -0,0 +1,27 @@
+import copy
+
+from benchmarks.cases import BENCHMARKS, synthetic_trial
+from benchmarks.runner import compare_results, run_benchmarks
+
+
+def test_synthetic_trial_shape():
+    df = synthetic_trial(12, 5, n_doses=3)
+    assert len(df) == 60 and df['ID'].nunique() == 12
+    assert sorted(df['Dose'].unique()) == [50.0, 100.0, 150.0]
+
+
+def test_benchmark_results_compare_with_a_baseline():
+    benchmarks = {'non_compartmental_analysis': {**BENCHMARKS['non_compartmental_analysis'],
+                                                 'quick': {'n_subjects': [10, 20], 'n_samples': [6]}}}
+    results = run_benchmarks(repeats=2, benchmarks=benchmarks)
+    assert [result['params']['n_subjects'] for result in results['results']] == [10, 20]
+    assert all(result['time_min'] > 0 and result['peak_memory_mb'] > 0 for result in results['results'])
+
+    # A baseline twice as fast flags both points, and a point missing from the baseline is never a regression
+    baseline = copy.deepcopy(results)
+    for result in baseline['results']:
+        result['time_min'] /= 2
+    baseline['results'].pop()
+    comparison = compare_results(results, baseline)
+    assert comparison['Regression'].tolist() == [True, False]
+    assert comparison['Time Ratio'].iloc[0] == 2
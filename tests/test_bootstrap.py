@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pkpd_sian.analysis import _bateman
+from pkpd_sian.bootstrap import bootstrap_confidence_intervals
+
+
+def _absorption_study(n_subjects, seed=5):
+    rng = np.random.default_rng(seed)
+    time = np.array([0.5, 1, 2, 4, 6, 8, 12, 24.0])
+    ka = 1.0 * np.exp(rng.normal(0, 0.2, n_subjects))
+    ke = 0.1 * np.exp(rng.normal(0, 0.2, n_subjects))
+    conc = _bateman(time, ka[:, None], ke[:, None], 50.0, 1.0, 100) * rng.lognormal(0, 0.05, (n_subjects, time.size))
+    return pd.DataFrame({
+        'ID': np.repeat(np.arange(n_subjects), time.size),
+        'Time': np.tile(time, n_subjects),
+        'Conc': conc.ravel(),
+        'Dose': 100,
+    })
+
+
+def test_subject_bootstrap_matches_direct_resampling():
+    df = _absorption_study(30)
+    ci, analysis_df = bootstrap_confidence_intervals(df, 'nca', n_bootstrap=500, seed=2, n_jobs=1)
+
+    half_life = analysis_df['Half Life'].to_numpy()
+    row = ci.set_index('Parameter').loc['Half Life']
+    assert row['Estimate'] == pytest.approx(half_life.mean())
+    assert row['CI Lower'] < half_life.mean() < row['CI Upper']
+    assert row['Standard Error'] == pytest.approx(half_life.std(ddof=1) / np.sqrt(half_life.size), rel=0.15)
+
+
+def test_residual_bootstrap_does_not_depend_on_workers():
+    df = _absorption_study(12)
+    serial, _ = bootstrap_confidence_intervals(df, 'im', n_bootstrap=250, residuals=True, seed=4, n_jobs=1)
+    parallel, _ = bootstrap_confidence_intervals(df, 'im', n_bootstrap=250, residuals=True, seed=4, n_jobs=2)
+    pd.testing.assert_frame_equal(serial, parallel)
+
+    ke = serial.set_index('Parameter').loc['ke']
+    assert ke['CI Lower'] < 0.1 < ke['CI Upper']
+    with pytest.raises(ValueError):
+        bootstrap_confidence_intervals(df, 'nca', residuals=True)
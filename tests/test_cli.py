@@ -0,0 +1,87 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from pkpd_sian.cli import main
+
+
+DATA = Path(__file__).resolve().parents[1] / 'testdata' / 'Phase_I_im_drug.csv'
+
+
+def test_cli_runs_every_job_and_writes_a_manifest(tmp_path):
+    spec = {
+        'jobs': [
+            {'name': 'population', 'type': 'population_pk', 'seed': 3, 'parameters': {
+                'Dose': 100, 'Population Clearance': 5.0, 'Population Volume of Distribution': 50.0, 'Population Bioavailability': 1.0,
+                'Number of Patients': 5, 'Omega CL': 0.2, 'Omega V': 0.2, 'Omega F': 0.0, 'Sigma Residual': 0.0, 'sampling_points': 12}},
+            {'name': 'sweep', 'type': 'regimen_sweep', 'ke': 0.1, 'Vd': 50.0, 'doses': [50, 100], 'taus': [12, 24], 'n_doses': 5},
+            {'name': 'nca', 'type': 'nca', 'data': str(DATA)},
+            {'name': 'broken', 'type': 'iv_fit', 'data': 'missing.csv'},
+        ]
+    }
+    spec_path = tmp_path / 'spec.json'
+    spec_path.write_text(json.dumps(spec))
+
+    assert main([str(spec_path), '-o', str(tmp_path / 'out'), '-w', '1']) == 1
+    records = [json.loads(line) for line in (tmp_path / 'out' / 'manifest.jsonl').read_text().splitlines()]
+    assert [(record['name'], record['status']) for record in records] == \
+        [('population', 'ok'), ('sweep', 'ok'), ('nca', 'ok'), ('broken', 'error')]
+
+    population = pd.read_csv(tmp_path / 'out' / 'population.csv')
+    assert population['ID'].nunique() == 5 and list(population.columns) == ['ID', 'Time', 'Conc', 'Dose']
+
+    # The exposure scales with the dose in the linear one-compartment model
+    sweep = pd.read_csv(tmp_path / 'out' / 'sweep.csv')
+    assert len(sweep) == 4
+    ratio = sweep.pivot(index='Tau', columns='Dose', values='AUC')
+    np.testing.assert_allclose(ratio[100.0], 2 * ratio[50.0])
+    assert len(pd.read_csv(tmp_path / 'out' / 'nca.csv')) == 30
+
+
+def test_cli_does_not_import_streamlit(tmp_path):
+    spec_path = tmp_path / 'spec.json'
+    spec_path.write_text(json.dumps({'jobs': [{'type': 'nca', 'data': str(DATA)}]}))
+    code = ('import sys; from pkpd_sian.cli import main; '
+            f'status = main([{str(spec_path)!r}, "-w", "1"]); '
+            'assert "streamlit" not in sys.modules; sys.exit(status)')
+    subprocess.run([sys.executable, '-c', code], check=True, cwd=Path(__file__).resolve().parents[1])
+    assert (tmp_path / 'spec_results' / '000_nca.csv').exists()
+
+
+def test_regimen_sweep_time_above_limit(tmp_path):
+    # Without elimination an iv bolus gives a constant profile, above the limit over the whole 10 h
+    spec_path = tmp_path / 'spec.json'
+    spec_path.write_text(json.dumps({'jobs': [{'name': 'flat', 'type': 'regimen_sweep', 'ke': 0.0, 'Vd': 50.0, 'doses': [100],
+                                               'taus': [5], 'n_doses': 2, 'C Limit': 1.0}]}))
+    assert main([str(spec_path), '-o', str(tmp_path / 'out'), '-w', '1']) == 0
+    sweep = pd.read_csv(tmp_path / 'out' / 'flat.csv')
+    np.testing.assert_allclose(sweep['Time Above Limit'], [10.0])
+
+
+def test_regimen_sweep_interpolates_the_limit_crossing(tmp_path):
+    # A bolus of 100 in 50 L starts at twice the limit and halves after ln(2) / ke hours, between two 1 h steps
+    spec_path = tmp_path / 'spec.json'
+    spec_path.write_text(json.dumps({'jobs': [{'name': 'bolus', 'type': 'regimen_sweep', 'ke': 0.1, 'Vd': 50.0, 'doses': [100],
+                                               'taus': [24], 'n_doses': 1, 'step': 1.0, 'C Limit': 1.0}]}))
+    assert main([str(spec_path), '-o', str(tmp_path / 'out'), '-w', '1']) == 0
+    sweep = pd.read_csv(tmp_path / 'out' / 'bolus.csv')
+    np.testing.assert_allclose(sweep['Time Above Limit'], [np.log(2) / 0.1], atol=0.01)
+
+
+def test_population_pk_labels_a_regimen_dose(tmp_path):
+    regimen = {'times': [0, 12], 'doses': [100, 50], 'routes': 'iv'}
+    spec_path = tmp_path / 'spec.json'
+    spec_path.write_text(json.dumps({'jobs': [{'name': 'population', 'type': 'population_pk', 'seed': 1, 'parameters': {
+        'Dose': regimen, 'Population Clearance': 5.0, 'Population Volume of Distribution': 50.0, 'Population Bioavailability': 1.0,
+        'Number of Patients': 3, 'Omega CL': 0.2, 'Omega V': 0.2, 'Omega F': 0.0, 'sampling_points': 12}}]}))
+    assert main([str(spec_path), '-o', str(tmp_path / 'out'), '-w', '1']) == 0
+
+    # The rows carry the label of the regimen rather than a total dose, and the manifest maps the label back to the regimen
+    population = pd.read_csv(tmp_path / 'out' / 'population.csv')
+    record = json.loads((tmp_path / 'out' / 'manifest.jsonl').read_text())
+    assert population['Dose'].nunique() == 1
+    assert record['regimens'][population['Dose'][0]]['doses'] == [100.0, 50.0]
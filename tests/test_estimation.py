@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+
+from pkpd_sian.analysis import _bateman
+from pkpd_sian.estimation import population_estimation
+
+
+def test_population_estimation_recovers_simulated_population():
+    rng = np.random.default_rng(3)
+    n_subjects = 200
+    time = np.array([0.5, 1, 2, 4, 6, 8, 12, 24.0])
+    CL = 2.0 * np.exp(rng.normal(0, 0.25, n_subjects))
+    V = 50.0 * np.exp(rng.normal(0, 0.15, n_subjects))
+    ka = 1.0 * np.exp(rng.normal(0, 0.3, n_subjects))
+    conc = _bateman(time, ka[:, None], (CL / V)[:, None], V[:, None], 1.0, 100) + rng.normal(0, 0.02, (n_subjects, time.size))
+    df = pd.DataFrame({
+        'ID': np.repeat(np.arange(n_subjects), time.size),
+        'Time': np.tile(time, n_subjects),
+        'Conc': conc.ravel(),
+        'Dose': 100,
+    })
+
+    population, individuals = population_estimation(df, model='absorption', seed=1)
+
+    np.testing.assert_allclose(
+        [population['Population Clearance'], population['Population Volume of Distribution'], population['Population ka']],
+        [2.0, 50.0, 1.0],
+        rtol=0.1,
+    )
+    np.testing.assert_allclose([population['Omega CL'], population['Omega V'], population['Omega ka']], [0.25, 0.15, 0.3], atol=0.06)
+    np.testing.assert_allclose(population['Sigma Residual'], 0.02, rtol=0.15)
+    assert population['Number of Patients'] == n_subjects
+    assert np.corrcoef(np.log(individuals['CL']), np.log(CL))[0, 1] > 0.9
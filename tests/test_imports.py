@@ -0,0 +1,20 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+
+UI_MODULES = ('streamlit', 'plotly', 'thefuzz', 'scipy.stats')
+
+
+def test_numerical_core_does_not_import_the_ui_layers():
+    # A fresh interpreter, since the other tests may already have imported the UI layers
+    code = (
+        'import json, sys\n'
+        'import pkpd_sian.simulation, pkpd_sian.analysis, pkpd_sian.preprocessing, pkpd_sian.estimation\n'
+        'import pkpd_sian.bootstrap, pkpd_sian.storage, pkpd_sian.report, pkpd_sian.cli\n'
+        f'print(json.dumps(sorted(name for name in {UI_MODULES!r} if name in sys.modules)))\n'
+    )
+    result = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True,
+                            cwd=Path(__file__).resolve().parents[1])
+    assert json.loads(result.stdout.splitlines()[-1]) == []
@@ -0,0 +1,85 @@
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from pkpd_sian.analysis import PARALLEL_MIN_SUBJECTS, one_compartmental_im_analysis
+from pkpd_sian.jobs import JobManager, process_workers
+from pkpd_sian.simulation import population_pk_simulation
+from benchmarks.cases import synthetic_trial
+
+
+PARAMETERS = {'Dose': 100, 'Population Clearance': 5.0, 'Population Volume of Distribution': 50.0, 'Population ka': None,
+              'Population Bioavailability': 1.0, 'Number of Patients': 1200, 'Omega CL': 0.2, 'Omega V': 0.2, 'Omega ka': 0.0,
+              'Omega F': 0.0, 'Sigma Residual': 0.0, 'C Limit': None, 'sampling_points': 24.0, 'logit': False}
+
+
+def test_background_analysis_reports_progress_and_matches_the_direct_call():
+    df = synthetic_trial(30, 8)
+    reports = []
+    direct, _ = one_compartmental_im_analysis(df, 1.0, n_jobs=1, progress=lambda done, total: reports.append((done, total)))
+    assert reports[0] == (0, 30) and reports[-1] == (30, 30) and len(reports) > 2
+
+    job = JobManager().submit('im_analysis', one_compartmental_im_analysis, df=df, predefined_F=1.0, n_jobs=1)
+    assert job.wait(60) and job.status == 'done'
+    assert (job.done, job.total) == (30, 30)
+    pd.testing.assert_frame_equal(job.result[0], direct)
+
+
+def test_background_population_simulation_matches_the_direct_call():
+    for population_ka in (None, 1.2):
+        parameters = {**PARAMETERS, 'Population ka': population_ka, 'Omega ka': 0.3}
+        np.random.seed(0)
+        direct_C, direct_C_ln = population_pk_simulation(parameters, plot=False)
+
+        # Same seed, same population, although the concentrations are computed chunk by chunk to report the progress
+        np.random.seed(0)
+        job = JobManager().submit('population_pk', population_pk_simulation, parameters=parameters, plot=False)
+        assert job.wait(60) and job.status == 'done'
+        assert (job.done, job.total) == (1200, 1200)
+        pd.testing.assert_frame_equal(job.result[0], direct_C)
+        pd.testing.assert_frame_equal(job.result[1], direct_C_ln)
+
+
+def test_cancel_failure_and_replacement():
+    started, release = threading.Event(), threading.Event()
+
+    def slow(progress):
+        for i in range(100):
+            progress(i, 100)
+            started.set()
+            release.wait(0.05)
+        return 'finished'
+
+    def broken(progress):
+        raise ValueError('bad input')
+
+    manager = JobManager()
+    job = manager.submit('slow', slow)
+    assert started.wait(10)
+    manager.cancel('slow')
+    assert job.wait(10) and job.status == 'cancelled' and job.result is None
+
+    failed = manager.submit('broken', broken)
+    assert failed.wait(10) and failed.status == 'failed' and isinstance(failed.error, ValueError)
+
+    # Submitting under the same name cancels the previous job and keeps the new one
+    started.clear()
+    first = manager.submit('slow', slow)
+    assert started.wait(10)
+    release.set()
+    second = manager.submit('slow', slow)
+    assert second.wait(30) and second.status == 'done' and second.result == 'finished'
+    assert first.wait(10) and first.status == 'cancelled'
+    assert manager.get('slow') is second
+
+
+def test_parallel_analysis_in_a_job_spawns_its_workers():
+    df = synthetic_trial(PARALLEL_MIN_SUBJECTS, 8)
+    direct, _ = one_compartmental_im_analysis(df, 1.0, n_jobs=1)
+    # Outside the main thread the process pool is spawned, not forked from the multithreaded process
+    job = JobManager().submit('im_analysis', one_compartmental_im_analysis, df=df, predefined_F=1.0, n_jobs=2)
+    assert job.wait(120) and job.status == 'done'
+    pd.testing.assert_frame_equal(job.result[0], direct)
+    assert 1 <= process_workers() <= max(os.cpu_count() or 1, 1)
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+
+from pkpd_sian.analysis import non_compartmental_analysis
+from pkpd_sian.preprocessing import PKDataset, infer_schema, read_trial_csv, validate_dataset
+
+
+def _study():
+    rng = np.random.default_rng(11)
+    frames = []
+    for subject, dose in zip(range(12), [50, 100, 25] * 4):
+        time = np.sort(rng.uniform(0, 24, 8))
+        frames.append(pd.DataFrame({'ID': f'S{subject}', 'Time': time, 'Conc': dose / 10 * np.exp(-0.2 * time), 'Dose': dose, 'Age': 20 + subject}))
+    return pd.concat(frames).sample(frac=1, random_state=1)
+
+
+def test_dataset_slices_are_sorted_contiguous_views():
+    df = _study()
+    dataset = PKDataset(df)
+
+    assert dataset.doses.tolist() == [25, 50, 100]
+    assert dataset.n_subjects == 12 and len(dataset) == len(df)
+    for id, rows in dataset.iter_subjects():
+        expected = df[df['ID'] == id].sort_values('Time')
+        np.testing.assert_array_equal(rows['Time'], expected['Time'])
+    group = dataset.dose_group(50)
+    assert set(group['ID']) == set(df.loc[df['Dose'] == 50, 'ID']) and (group['Dose'] == 50).all()
+    assert np.shares_memory(dataset.subject('S3')['Conc'].to_numpy(), dataset.frame['Conc'].to_numpy())
+    assert dataset.covariates().set_index('ID')['Age'].to_dict() == {f'S{i}': 20 + i for i in range(12)}
+
+
+def test_analysis_accepts_dataset():
+    df = _study()
+    expected, _ = non_compartmental_analysis(df)
+    results, _ = non_compartmental_analysis(PKDataset(df))
+    pd.testing.assert_frame_equal(results.sort_values('ID').reset_index(drop=True), expected.sort_values('ID').reset_index(drop=True))
+
+
+def test_schema_inference_uses_synonyms_and_units():
+    columns = tuple(f'LAB{i}' for i in range(300)) + ('USUBJID', 'TAFD (h)', 'DV', 'AMT (mg)', 'WT [kg]', 'SEX', 'Conc flag')
+    schema = infer_schema(columns)
+
+    assert schema == {'ID': 'USUBJID', 'Time': 'TAFD (h)', 'Conc': 'DV', 'Dose': 'AMT (mg)', 'Age': None,
+                      'Weight': 'WT [kg]', 'Gender': 'SEX', 'CLCR': None}
+    # Mandatory columns always get a fuzzy default, covariates do not
+    assert set(infer_schema(('a', 'b', 'c', 'd')).values()) == {'a', 'b', 'c', 'd', None}
+
+
+def test_read_trial_csv_cleans_headers_and_types(tmp_path):
+    path = tmp_path / 'study.csv'
+    path.write_text('\ufeffID,Dose ,TIME (h),DV,NOTE\n' + ''.join(f'{i // 4},100,{i % 4},{"." if i % 4 == 0 else "#N/A" if i == 5 else i / 10},x\n' for i in range(40)),
+                    encoding='utf-8')
+
+    df = read_trial_csv(path, chunksize=7)
+    assert list(df.columns) == ['ID', 'Dose', 'TIME (h)', 'DV', 'NOTE']
+    # Integers stop at int32, so the edits of the data editor cannot overflow them
+    assert df['ID'].dtype == np.int32 and df['DV'].dtype == np.float64
+    assert df['DV'].isna().sum() == 11
+
+    projected = read_trial_csv(path, usecols='inferred')
+    assert list(projected.columns) == ['ID', 'Dose', 'TIME (h)', 'DV']
+    pd.testing.assert_frame_equal(read_trial_csv(path, usecols=['ID', 'DV'], float_dtype='float32'),
+                                  df[['ID', 'DV']].astype({'DV': 'float32'}))
+
+
+def test_read_trial_csv_widens_the_dtypes_of_the_first_chunk(tmp_path):
+    path = tmp_path / 'study.csv'
+    path.write_text('ID,AMT,WT\n' + ''.join(f'{i},{100 if i < 6 else 5_000_000_000},{70 if i != 8 else "."}\n' for i in range(10)))
+
+    df = read_trial_csv(path, chunksize=3)
+    assert df.dtypes.tolist() == [np.int32, np.int64, np.float64]
+    pd.testing.assert_frame_equal(df, read_trial_csv(path, chunksize=100))
+    assert read_trial_csv(path, chunksize=3, float_dtype='float32')['WT'].dtype == np.float32
+
+
+def test_validation_flags_every_subject_at_once():
+    df = pd.DataFrame({
+        'ID': [1, 1, 1, 1, 2, 2, 2, 3],
+        'Time': [0, 2, 1, 2, 0, 1, np.nan, 0],
+        'Conc': [0, 3, 2, 0, 5, -1, 4, 2],
+        'Dose': [10, 10, 10, 10, 10, 20, 20, 10],
+        'Age': [30, 30, np.nan, 30, 40, 40, 40, 50],
+    })
+    report = validate_dataset(df)
+
+    # A missing covariate keeps the row, a missing mandatory value or a negative concentration does not
+    np.testing.assert_array_equal(report.clean_mask, [True, True, True, True, True, False, False, True])
+    # A zero concentration is flagged after time 0 only, the pre-dose samples are expected to be zero
+    np.testing.assert_array_equal(report.row_flags['Zero Conc'], [False, False, False, True, False, False, False, False])
+    flags = report.subject_flags.set_index('ID')
+    assert flags.loc[1, ['Zero Conc', 'Non-monotonic Time', 'Duplicate Time']].tolist() == [1, 1, 1]
+    assert flags.loc[2, ['Missing Time', 'Negative Conc']].tolist() == [1, 1]
+    assert flags['Multiple Doses'].tolist() == [False, True, False]
+    np.testing.assert_array_equal(PKDataset(df).validation.clean_mask, validate_dataset(PKDataset(df).frame).clean_mask)
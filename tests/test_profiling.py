@@ -0,0 +1,68 @@
+import json
+import threading
+
+import pytest
+
+from pkpd_sian import profiling
+from pkpd_sian.analysis import non_compartmental_analysis, one_compartmental_im_analysis
+from pkpd_sian.jobs import JobManager
+from benchmarks.cases import synthetic_trial
+
+
+@pytest.fixture
+def recording():
+    profiling.reset()
+    profiling.enable()
+    yield
+    profiling.disable()
+    profiling.reset()
+
+
+def test_disabled_profiling_records_nothing():
+    profiling.disable()
+    profiling.reset()
+    non_compartmental_analysis(synthetic_trial(5, 8))
+    stages, counters = profiling.summary()
+    assert stages.empty and counters == {}
+    assert profiling.span('analysis.fit') is profiling.span('analysis.other')
+
+
+def test_stages_counters_and_logs(recording):
+    df = synthetic_trial(8, 8)
+    non_compartmental_analysis(df)
+    one_compartmental_im_analysis(df, 1.0, n_jobs=1)
+
+    stages, counters = profiling.summary()
+    calls = dict(zip(stages['Stage'], stages['Calls']))
+    assert calls['analysis.non_compartmental_analysis'] == 1
+    assert calls['analysis.sort_profiles'] >= 2 and 'analysis.curve_fit' in calls
+    assert counters['analysis.curve_fit_subjects'] == 8
+    assert stages['Share (%)'].sum() == pytest.approx(100)
+
+    records = [json.loads(line) for line in profiling.export_logs().splitlines()]
+    assert {record['type'] for record in records} == {'span', 'stage', 'counter'}
+    assert sum(record['type'] == 'span' for record in records) == stages['Calls'].sum()
+
+
+def test_session_recordings_are_isolated():
+    profiling.disable()
+    profiling.reset()
+    session = profiling.Recording()
+    try:
+        profiling.use(session)
+        non_compartmental_analysis(synthetic_trial(5, 8))
+        # Background jobs record into the session that submitted them
+        job = JobManager().submit('fit', one_compartmental_im_analysis, df=synthetic_trial(5, 8), predefined_F=1.0, n_jobs=1)
+        assert job.wait(60) and job.status == 'done'
+    finally:
+        profiling.use(None)
+
+    stages, _ = profiling.summary(session)
+    assert {'analysis.non_compartmental_analysis', 'analysis.curve_fit'} <= set(stages['Stage'])
+    # Neither the process recording nor another thread saw the session's spans
+    assert profiling.summary()[0].empty
+    other = []
+    thread = threading.Thread(target=lambda: other.append(profiling.span('analysis.fit')))
+    thread.start()
+    thread.join()
+    assert other[0] is profiling.span('analysis.other')
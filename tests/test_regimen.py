@@ -0,0 +1,80 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from pkpd_sian.regimen import Regimen
+from pkpd_sian.simulation import (
+    multiple_compartment_regimen_simulation,
+    pk_iv_dose,
+    pk_non_iv_dose,
+    pk_prolonged_iv_dose,
+    regimen_simulation,
+)
+
+
+def _page_records():
+    return [
+        {"time": 0.0, "dose": 10.0, "infusion_duration": None, "label": "iv"},
+        {"time": 5.0, "dose": 20.0, "infusion_duration": 2.0, "label": "iv"},
+        {"time": 3.0, "dose": 5.0, "F": 0.5, "label": "non_iv"},
+    ]
+
+
+def test_regimen_round_trips_through_json_pickle_and_records():
+    regimen = Regimen.from_records(_page_records())
+    assert Regimen.from_json(regimen.to_json()) == regimen
+    assert pickle.loads(pickle.dumps(regimen)) == regimen
+    assert Regimen.from_records(regimen.to_records()) == regimen
+    assert hash(Regimen.from_dict(regimen.to_dict())) == hash(regimen)
+
+
+def test_regimen_arrays_are_read_only():
+    regimen = Regimen.repeated(100, tau=12, n_doses=5)
+    with pytest.raises(ValueError):
+        regimen.doses[0] = 1.0
+
+
+def test_invalid_regimen_reports_all_problems():
+    with pytest.raises(ValueError, match="dose amounts.*infusion durations"):
+        Regimen([0, 1], [-1, 10], ["iv", "non_iv"], infusion_durations=[None, 1.0])
+
+
+def test_regimen_simulation_superposes_single_dose_engines():
+    time = np.arange(0, 24.1, 0.1)
+    ke, Vd, ka = 0.2, 30.0, 1.1
+    total, each = regimen_simulation(Regimen.from_records(_page_records()), time, ke, Vd, ka, each_dose=True)
+
+    expected = np.zeros((3, time.size))
+    expected[0] = pk_iv_dose(10.0, time, ke, Vd)
+    started = time >= 5.0
+    expected[1, started] = pk_prolonged_iv_dose(20.0, time[started] - 5.0, ke, Vd, 2.0)
+    started = time >= 3.0
+    expected[2, started] = pk_non_iv_dose(5.0, 0.5, time[started] - 3.0, ke, ka, Vd)
+
+    np.testing.assert_allclose(each, expected)
+    np.testing.assert_allclose(total, expected.sum(axis=0))
+    np.testing.assert_allclose(regimen_simulation(Regimen.from_records(_page_records()), time, ke, Vd, ka), total)
+
+
+def test_non_iv_regimen_requires_ka():
+    with pytest.raises(ValueError, match="ka"):
+        regimen_simulation(Regimen.single(100, route="non_iv"), np.arange(5.0), 0.2, 30.0)
+
+
+def test_multiple_compartment_regimen_matches_the_one_compartment_engine():
+    # Without peripheral compartments the ODE model is the one-compartment model
+    parameters = {'Compartment 0': {'C0': 0, 'k_in': None, 'k_out': 1.0, 'V': 50.0},
+                  'Compartment 1': {'C0': 0, 'k_in': 1.0, 'k_out': 0.2, 'V': 50.0}}
+    time = np.arange(0, 24.05, 0.1)
+    infusion = Regimen([0, 12], [100, 100], routes='iv', infusion_durations=[2, 2])
+    bolus = Regimen([0, 12], [100, 100], routes='iv')
+
+    infused = multiple_compartment_regimen_simulation(parameters, time, infusion)['C1']
+    np.testing.assert_allclose(infused, regimen_simulation(infusion, time, 0.2, 50.0), atol=1e-6)
+    assert np.abs(infused - multiple_compartment_regimen_simulation(parameters, time, bolus)['C1']).max() > 1
+
+    # A dose given before the first time point keeps decaying over the whole grid
+    late_time = np.linspace(10, 24, 50)
+    late = multiple_compartment_regimen_simulation(parameters, late_time, Regimen([0], [100], routes='iv'))['C1']
+    np.testing.assert_allclose(late, 2 * np.exp(-0.2 * late_time), atol=1e-6)
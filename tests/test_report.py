@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pkpd_sian import report
+from pkpd_sian.analysis import _bateman
+from pkpd_sian.preprocessing import apply_schema
+
+
+def _study(n_subjects, seed=3):
+    rng = np.random.default_rng(seed)
+    time = np.array([0.5, 1, 2, 4, 6, 8, 12, 24.0])
+    ka = 1.0 * np.exp(rng.normal(0, 0.2, n_subjects))
+    conc = _bateman(time, ka[:, None], 0.1, 50.0, 1.0, 100) * rng.lognormal(0, 0.05, (n_subjects, time.size))
+    return pd.DataFrame({
+        'Subject': np.repeat(np.arange(n_subjects), time.size),
+        'TIME': np.tile(time, n_subjects),
+        'DV': conc.ravel(),
+        'AMT': 100,
+    })
+
+
+def test_report_has_every_subject_and_table(tmp_path, monkeypatch):
+    df = apply_schema(_study(6))
+    assert list(df.columns) == ['ID', 'Time', 'Conc', 'Dose']
+
+    serial = report.generate_report(df, tmp_path / 'report.html', n_jobs=1)
+    assert (tmp_path / 'report.html').read_text(encoding='utf-8') == serial
+    assert serial.count('class="subject"') == 6
+    for section in ('Non-compartmental Analysis', 'One-compartmental IV Analysis', 'One-compartmental Non-IV Analysis'):
+        assert section in serial
+
+    # The worker processes render the same plots in the same order
+    monkeypatch.setattr(report, 'REPORT_PARALLEL_MIN_SUBJECTS', 1)
+    parallel = report.generate_report(df, analyses=('nca',), n_jobs=2)
+    assert parallel.count('class="subject"') == 6
+    positions = [parallel.index(f'<h3>ID {id} (Dose 100)</h3>') for id in range(6)]
+    assert positions == sorted(positions)
+    assert 'One-compartmental IV Analysis' not in parallel
+
+    with pytest.raises(ValueError):
+        report.generate_report(df, analyses=('pk',))
@@ -0,0 +1,117 @@
+import http.client
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pkpd_sian.analysis import non_compartmental_analysis
+from pkpd_sian.preprocessing import apply_schema
+from pkpd_sian.regimen import Regimen
+from pkpd_sian import service
+from pkpd_sian.service import ResultCache, create_server
+from pkpd_sian.simulation import regimen_simulation
+
+
+DATA = Path(__file__).resolve().parents[1] / 'testdata' / 'Phase_I_im_drug.csv'
+REGIMEN = {'times': [0, 12, 24], 'doses': [100, 100, 100], 'routes': 'non_iv'}
+
+
+@pytest.fixture
+def server():
+    server = create_server(port=0, workers=2, max_delay=0.02)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def _post(server, path, body):
+    data = body if isinstance(body, bytes) else json.dumps(body).encode()
+    request = urllib.request.Request(server.url + path, data, {'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.headers['X-Cache'], json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, None, json.loads(error.read())
+
+
+def test_concurrent_simulations_are_batched_and_cached(server):
+    ke = 0.05 + 0.01 * np.arange(32)
+    bodies = [{'regimen': REGIMEN, 'time': {'end': 48, 'step': 0.5}, 'ke': value, 'Vd': 50, 'ka': 1.5} for value in ke]
+    with ThreadPoolExecutor(len(bodies)) as executor:
+        answers = list(executor.map(lambda body: _post(server, '/simulate/regimen', body), bodies))
+
+    assert all(status == 200 for status, _, _ in answers)
+    expected = regimen_simulation(Regimen(**REGIMEN), np.linspace(0, 48, 97), ke, 50.0, 1.5)
+    np.testing.assert_allclose([payload['concentration'] for _, _, payload in answers], expected)
+    assert server.batcher.batches < len(bodies)
+
+    status, cache, payload = _post(server, '/simulate/regimen', bodies[3])
+    assert (status, cache) == (200, 'hit')
+    np.testing.assert_allclose(payload['concentration'], expected[3])
+
+
+def test_batched_nca_matches_the_direct_analysis(server):
+    df = apply_schema(pd.read_csv(DATA))[['ID', 'Time', 'Conc', 'Dose']]
+    ids = df['ID'].unique()
+    parts = [df[df['ID'].isin(ids[:10])], df[df['ID'].isin(ids[10:])]]
+    with ThreadPoolExecutor(2) as executor:
+        answers = list(executor.map(lambda part: _post(server, '/analysis/nca', {'data': part.to_dict('list')}), parts))
+
+    assert [status for status, _, _ in answers] == [200, 200]
+    result = pd.DataFrame([record for _, _, payload in answers for record in payload['results']])
+    expected, _ = non_compartmental_analysis(df)
+    pd.testing.assert_frame_equal(result.sort_values('ID', ignore_index=True), expected.sort_values('ID', ignore_index=True),
+                                  check_dtype=False)
+
+
+def test_invalid_requests_are_answered_with_client_errors(server):
+    assert _post(server, '/analysis/nca', b'not json')[0] == 400
+    assert _post(server, '/simulate/regimen', {'regimen': REGIMEN, 'time': [0, 1], 'ke': 0.1, 'Vd': 50})[0] == 400
+    assert _post(server, '/unknown', {})[0] == 404
+    with urllib.request.urlopen(server.url + '/health') as response:
+        assert json.loads(response.read())['status'] == 'ok'
+
+    # Without a valid length the body cannot be read, the request is refused rather than blocking or failing with 500
+    for length in ('-1', 'abc'):
+        connection = http.client.HTTPConnection(*server.server_address[:2], timeout=5)
+        connection.putrequest('POST', '/analysis/nca')
+        connection.putheader('Content-Length', length)
+        connection.endheaders()
+        assert connection.getresponse().status == 400
+        connection.close()
+
+
+def test_result_cache_is_bounded_by_bytes():
+    cache = ResultCache(size=100, max_bytes=100)
+    for key in 'abcd':
+        cache.put(key, b'x' * 29)
+    assert cache.get('a') is None and cache.get('b') == b'x' * 29 and cache.bytes == 90
+
+    # An entry larger than the whole cache is not kept, and does not evict the others
+    cache.put('e', b'x' * 100)
+    assert cache.get('e') is None and cache.bytes == 90
+
+
+def test_slow_batches_time_out_with_504(server, monkeypatch):
+    release = threading.Event()
+
+    def slow(key, inputs):
+        release.wait(5)
+        return [{} for _ in inputs]
+
+    monkeypatch.setattr(service, 'REQUEST_TIMEOUT', 0.05)
+    monkeypatch.setitem(service.ENDPOINTS, '/slow', (lambda body: ('slow', body), slow))
+    started = time.perf_counter()
+    assert _post(server, '/slow', {})[0] == 504
+    assert time.perf_counter() - started < 5
+    release.set()
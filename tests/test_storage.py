@@ -0,0 +1,19 @@
+import numpy as np
+import pandas as pd
+
+from pkpd_sian.preprocessing import PKDataset
+from pkpd_sian.storage import open_study, simulation_to_long, write_study
+
+
+def test_study_round_trip_with_index(tmp_path):
+    df_C = pd.DataFrame(np.arange(12.0).reshape(3, 4), columns=[0.0, 0.5, 1.0, 1.5])
+    df = simulation_to_long(df_C, 100)
+    df['Dose'] = np.repeat([50.0, 100.0, 50.0], 4)
+    path = tmp_path / 'study.arrow'
+    write_study(df, path)
+
+    study = open_study(path)
+    assert len(study) == 12 and study.ids.tolist() == [1, 3, 2]
+    pd.testing.assert_frame_equal(study.subject(2), df[df['ID'] == 2].reset_index(drop=True))
+    assert set(study.dose_group(50.0)['ID']) == {1, 3}
+    pd.testing.assert_frame_equal(open_study(write_study(df)).to_pandas(), PKDataset(df).frame)
@@ -0,0 +1,100 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.io
+import plotly.tools
+
+from pkpd_sian.visualization import (
+    _FigureSpec,
+    _cached_figure,
+    _decimate,
+    _frame_fingerprint,
+    _histogram,
+    _labelled_spec,
+    _percentile_summary,
+    _sorted_column,
+    FIGURE_CACHE_SIZE,
+    SORTED_CACHE_SIZE,
+)
+
+
+def test_decimation_keeps_one_point_per_occupied_cell():
+    rng = np.random.default_rng(0)
+    x = rng.uniform(0, 24, 200_000)
+    y = np.exp(-0.2 * x) * rng.lognormal(0, 0.3, x.size)
+    y[:10] = np.nan
+
+    kept = _decimate(x, y, grid=(50, 40))
+    assert kept.size <= 50 * 40 and np.all(np.diff(kept) > 0)
+    assert np.isfinite(y[kept]).all()
+    # Extreme points always survive, since their cells hold few points
+    assert np.argmax(np.where(np.isfinite(y), y, -np.inf)) in kept
+
+
+def test_percentile_summary_per_nominal_time():
+    time = np.repeat([0.5, 1.0, 2.0], 101)
+    conc = np.tile(np.arange(101.0), 3) * np.repeat([1, 2, 3], 101)
+    summary = _percentile_summary(time, conc)
+
+    assert summary.index.tolist() == [0.5, 1.0, 2.0]
+    np.testing.assert_allclose(summary[50], [50, 100, 150])
+    np.testing.assert_allclose(summary[5], [5, 10, 15])
+
+
+def test_server_side_histogram_matches_numpy():
+    values = np.random.default_rng(1).normal(70, 12, 100_000)
+    values[:5] = np.nan
+    sorted_values = _sorted_column(values)
+    assert _sorted_column(values.copy()) is sorted_values
+
+    for nbins in (1, 7, 20, 333):
+        counts, edges = _histogram(sorted_values, nbins)
+        expected_counts, expected_edges = np.histogram(values[np.isfinite(values)], bins=nbins)
+        np.testing.assert_array_equal(counts, expected_counts)
+        np.testing.assert_allclose(edges, expected_edges)
+
+
+def test_sorted_column_cache_is_safe_across_sessions():
+    columns = [np.arange(i, i + 50, dtype=float)[::-1] for i in range(4 * SORTED_CACHE_SIZE)]
+    # Concurrent lookups and evictions, as from the script threads of several sessions
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(_sorted_column, columns * 4))
+    for column, sorted_values in zip(columns * 4, results):
+        np.testing.assert_array_equal(sorted_values, np.sort(column))
+
+
+def test_figure_cache_builds_once_per_fingerprint():
+    df = pd.DataFrame({'ID': ['a', 'b', 'c'], 'Dose': [10, 10, 20]})
+    calls = []
+
+    def build():
+        calls.append(1)
+        return object()
+
+    key = (_frame_fingerprint(df, ['ID', 'Dose']), 'spec')
+    first = _cached_figure(key, build)
+    assert _cached_figure((_frame_fingerprint(df.copy(), ['ID', 'Dose']), 'spec'), build) is first
+    _cached_figure((_frame_fingerprint(df.assign(Dose=[10, 20, 20]), ['ID', 'Dose']), 'spec'), build)
+    assert len(calls) == 2
+
+
+def test_figure_cache_is_safe_across_sessions():
+    keys = [('concurrent', i) for i in range(4 * FIGURE_CACHE_SIZE)]
+    with ThreadPoolExecutor(8) as executor:
+        figures = list(executor.map(lambda key: _cached_figure(key, lambda: key), keys * 4))
+    assert figures == keys * 4
+
+
+def test_labelled_figure_spec_is_serialized_as_the_relabelled_figure():
+    fig = px.bar(pd.DataFrame({'Dose': ['10', '20'], 'Count': [3, 4]}), x='Count', y='Dose', title='Default')
+    spec = fig.to_dict()
+    original = plotly.io.to_json(spec, validate=False)
+    labelled = _labelled_spec(spec, 'Title', 'X', 'Y')
+
+    # The cached dictionary is left as is, and Streamlit serializes the relabelled one without rebuilding a figure
+    assert plotly.io.to_json(spec, validate=False) == original and labelled['data'] is spec['data']
+    assert plotly.tools.return_figure_from_figure_or_data(_FigureSpec(labelled), validate_figure=True) is labelled
+    fig.update_layout(title='Title', xaxis_title='X', yaxis_title='Y')
+    assert plotly.io.to_json(labelled, validate=False) == plotly.io.to_json(fig.to_dict(), validate=False)